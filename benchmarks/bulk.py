@@ -0,0 +1,227 @@
+"""Bulk ingestion benchmark.
+
+Indexes generated documents via :meth:`Elastic.bulk_insert`, :func:`helpers.streaming_bulk`
+and :func:`helpers.parallel_bulk` for every combination of chunk size, max chunk bytes,
+thread count and document size. Target is the in-process fake elastic by default,
+use ``--url`` to run against real cluster::
+
+    $ python -m benchmarks.bulk --docs 20000 --chunk-sizes 100,500,2000 --threads 1,4
+    $ python -m benchmarks.bulk --url http://localhost:9200 --modes parallel_bulk --save /tmp/bulk.json
+
+Reported ``rss`` is peak resident memory of the process so far, ``ser`` is share
+of process cpu time spent serializing documents. Fake elastic runs in the same
+process so its cpu time is included, use real cluster to get client side numbers.
+"""
+
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+import eve
+
+from eve_elastic import fake, helpers, instrumentation
+from eve_elastic.elastic import Elastic
+
+from .micro import DOMAIN, get_source
+
+
+MODES = ('bulk_insert', 'streaming_bulk', 'parallel_bulk')
+
+#: index used for benchmark, it's deleted after every run
+INDEX = 'eve_elastic_bench'
+
+
+class TimingSerializer(object):
+    """Serializer wrapper measuring time spent in ``dumps``."""
+
+    def __init__(self, serializer):
+        self.serializer = serializer
+        self.lock = threading.Lock()
+        self.duration = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.serializer, name)
+
+    def dumps(self, data):
+        started = time.time()
+        try:
+            return self.serializer.dumps(data)
+        finally:
+            duration = time.time() - started
+            with self.lock:
+                self.duration += duration
+
+    def loads(self, s):
+        return self.serializer.loads(s)
+
+
+class RequestBytes(object):
+    """Count bytes sent in bulk request bodies."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = 0
+
+    def __call__(self, event):
+        if event.kind == instrumentation.REQUEST and event.url.endswith('_bulk'):
+            with self.lock:
+                self.total += event.request_bytes
+
+
+def get_peak_rss():
+    """Get peak resident memory of the process in MB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024.0 / (1024.0 if sys.platform == 'darwin' else 1.0)
+
+
+def get_app(url):
+    return eve.Eve(settings={
+        'DOMAIN': DOMAIN,
+        'ELASTICSEARCH_URL': url,
+        'ELASTICSEARCH_INDEX': INDEX,
+    }, data=Elastic)
+
+
+def get_docs(count, fields):
+    return [dict(get_source(i, fields), _id=str(i)) for i in range(count)]
+
+
+def get_actions(docs):
+    for doc in docs:
+        action = dict(doc)
+        action['_index'] = INDEX
+        action['_type'] = 'items'
+        yield action
+
+
+def index_docs(app, mode, docs, chunk_size, max_chunk_bytes, thread_count):
+    """Index docs using given mode, returns number of indexed docs."""
+    es = app.data.elastic('items')
+    kwargs = {'chunk_size': chunk_size, 'max_chunk_bytes': max_chunk_bytes}
+    if mode == 'bulk_insert':
+        success, errors = app.data.bulk_insert('items', docs, **kwargs)
+        return success
+    elif mode == 'streaming_bulk':
+        results = helpers.streaming_bulk(es, get_actions(docs), **kwargs)
+    else:
+        results = helpers.parallel_bulk(es, get_actions(docs), thread_count=thread_count, **kwargs)
+    return sum(1 for ok, item in results if ok)
+
+
+def run_one(app, mode, docs, chunk_size, max_chunk_bytes, thread_count):
+    """Run single benchmark configuration and return its stats."""
+    es = app.data.elastic('items')
+    app.data.init_index()
+    serializer = TimingSerializer(es.transport.serializer)
+    es.transport.serializer = serializer
+    request_bytes = RequestBytes()
+    instrumentation.subscribe(request_bytes)
+
+    cpu = time.process_time()
+    started = time.time()
+    try:
+        indexed = index_docs(app, mode, docs, chunk_size, max_chunk_bytes, thread_count)
+    finally:
+        duration = time.time() - started
+        cpu = time.process_time() - cpu
+        instrumentation.unsubscribe(request_bytes)
+        es.transport.serializer = serializer.serializer
+        es.indices.delete(index=INDEX, ignore=(404,))
+
+    return {
+        'docs': indexed,
+        'duration': duration,
+        'docs_per_sec': indexed / duration if duration else None,
+        'mb_per_sec': request_bytes.total / 1024.0 / 1024.0 / duration if duration else None,
+        'peak_rss_mb': get_peak_rss(),
+        'serialization_share': serializer.duration / cpu if cpu else None,
+    }
+
+
+def get_configs(modes, chunk_sizes, max_bytes, threads, fields):
+    for doc_fields in fields:
+        for mode in modes:
+            for chunk_size in chunk_sizes:
+                for max_chunk_bytes in max_bytes:
+                    for thread_count in (threads if mode == 'parallel_bulk' else [1]):
+                        yield mode, doc_fields, chunk_size, max_chunk_bytes, thread_count
+
+
+def run(url, count, modes, chunk_sizes, max_bytes, threads, fields):
+    app = get_app(url)
+    results = []
+    print('%-15s %6s %6s %8s %3s %10s %8s %8s %6s' % (
+        'mode', 'fields', 'chunk', 'max_mb', 'thr', 'docs/s', 'MB/s', 'rss_mb', 'ser'))
+    with app.app_context():
+        for mode, doc_fields, chunk_size, max_chunk_bytes, thread_count in get_configs(
+                modes, chunk_sizes, max_bytes, threads, fields):
+            docs = get_docs(count, doc_fields)
+            stats = run_one(app, mode, docs, chunk_size, max_chunk_bytes, thread_count)
+            stats.update({
+                'mode': mode,
+                'fields': doc_fields,
+                'chunk_size': chunk_size,
+                'max_chunk_bytes': max_chunk_bytes,
+                'thread_count': thread_count,
+            })
+            results.append(stats)
+            print('%-15s %6d %6d %8.1f %3d %10.0f %8.2f %8.1f %5.1f%%' % (
+                mode, doc_fields, chunk_size, max_chunk_bytes / 1024.0 / 1024.0, thread_count,
+                stats['docs_per_sec'] or 0, stats['mb_per_sec'] or 0, stats['peak_rss_mb'] or 0,
+                (stats['serialization_share'] or 0) * 100))
+    return results
+
+
+def get_list(value, cast=int):
+    return [cast(item) for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Eve-Elastic bulk ingestion benchmark.')
+    parser.add_argument('--url', default='fake://localhost:9200', help='elastic url, fake by default')
+    parser.add_argument('--docs', type=int, default=10000, help='number of docs per run')
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--chunk-sizes', default='100,500,2000')
+    parser.add_argument('--max-bytes', default='104857600', help='comma separated max chunk bytes')
+    parser.add_argument('--threads', default='1,4', help='thread counts for parallel_bulk')
+    parser.add_argument('--fields', default='0,10', help='number of extra text fields per doc')
+    parser.add_argument('--latency', type=float, default=0, help='fake elastic latency in seconds')
+    parser.add_argument('--save', help='save results into json file')
+    args = parser.parse_args(argv)
+
+    modes = get_list(args.modes, str)
+    for mode in modes:
+        if mode not in MODES:
+            parser.error('unknown mode %s' % mode)
+
+    if args.url.startswith('fake://'):
+        fake.reset_clusters()
+        host, _, port = args.url[len('fake://'):].rstrip('/').partition(':')
+        fake.get_cluster(host or 'localhost', int(port or 9200)).latency = args.latency
+
+    results = run(args.url, args.docs, modes, get_list(args.chunk_sizes), get_list(args.max_bytes),
+                  get_list(args.threads), get_list(args.fields))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'time': time.time(),
+                'url': args.url,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""Micro benchmarks for data layer hot paths.
+
+Elastic is replaced by in-process connection returning canned responses so
+only python code is measured. Run it from repository root::
+
+    $ python -m benchmarks.micro --save /tmp/before.json
+    $ python -m benchmarks.micro --compare /tmp/before.json
+
+Comparison fails when some benchmark is slower than ``--threshold`` times the saved one.
+"""
+
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+
+import eve
+import elasticsearch
+
+from bson import ObjectId
+from datetime import datetime
+from eve.utils import ParsedRequest
+
+from eve_elastic.elastic import Elastic, ElasticJSONSerializer, parse_date, format_doc, get_dates, \
+    set_filters, set_sort
+from eve_elastic.helpers import expand_action, _chunk_actions
+from eve_elastic.serializer import FastJSONSerializer, orjson
+
+
+DOMAIN = {
+    'items': {
+        'schema': {
+            'uri': {'type': 'keyword'},
+            'name': {'type': 'text'},
+            'firstcreated': {'type': 'datetime'},
+            'versioncreated': {'type': 'datetime'},
+            'priority': {'type': 'integer'},
+            'dateline': {
+                'type': 'dict',
+                'schema': {
+                    'located': {'type': 'text'},
+                    'date': {'type': 'datetime'},
+                },
+            },
+        },
+        'datasource': {
+            'backend': 'elastic',
+            'default_sort': [('firstcreated', -1)],
+            'elastic_filter': {'exists': {'field': 'uri'}},
+            'aggregations': {'priority': {'terms': {'field': 'priority'}}},
+        },
+    },
+}
+
+
+def get_source(i, fields=0):
+    source = {
+        'uri': 'urn:item:%d' % i,
+        'name': 'item name %d' % i,
+        'firstcreated': '2018-10-%02dT11:12:13+0000' % (i % 28 + 1),
+        'versioncreated': '2018-10-%02dT11:12:13.123456+0000' % (i % 28 + 1),
+        '_created': '2018-10-10T11:12:13+0000',
+        '_updated': '2018-10-10T11:12:13+0000',
+        'priority': i % 6,
+        'dateline': {'located': 'Prague', 'date': '2018-10-10T11:12:13+0000'},
+    }
+    for field in range(fields):
+        source['extra_%d' % field] = 'lorem ipsum dolor sit amet ' * 4
+    return source
+
+
+def get_hits(count):
+    return {
+        'took': 1,
+        '_shards': {'total': 1, 'failed': 0},
+        'hits': {
+            'total': count,
+            'hits': [{'_id': str(i), '_type': 'doc', '_source': get_source(i)} for i in range(count)],
+        },
+    }
+
+
+class CannedConnection(elasticsearch.Connection):
+    """Connection returning the same serialized response for every request."""
+
+    response = json.dumps(get_hits(10))
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        return 200, {}, self.response
+
+
+def get_app():
+    app = eve.Eve(settings={'DOMAIN': DOMAIN}, data=Elastic)
+    app.data.kwargs['connection_class'] = CannedConnection
+    return app
+
+
+def get_benchmarks(app):
+    """Get dict of benchmark name and function to measure."""
+    benchmarks = {}
+    schema = app.config['DOMAIN']['items']['schema']
+    serializer = ElasticJSONSerializer()
+
+    benchmarks['parse_date'] = lambda: parse_date('2018-10-10T11:12:13+0000')
+    date_parser = app.data.date_parser
+    benchmarks['parse_date_memo'] = lambda: date_parser('2018-10-10T11:12:13+0000')
+    benchmarks['parse_date_fallback'] = lambda: parse_date('10 Oct 2018')
+    benchmarks['parse_date_memo_fallback'] = lambda: date_parser('10 Oct 2018')
+
+    with app.app_context():
+        dates = get_dates(schema)
+
+    def _format_doc():
+        format_doc({'_id': '1', '_type': 'doc', '_source': get_source(1)}, schema, dates)
+    benchmarks['format_doc'] = _format_doc
+
+    for count in (10, 100, 1000):
+        raw = json.dumps(get_hits(count))
+
+        def _parse_hits(raw=raw):
+            app.data._parse_hits(json.loads(raw), 'items')
+        benchmarks['parse_hits_%d' % count] = _parse_hits
+
+    def _set_filters():
+        query = {'query': {'bool': {}}}
+        set_filters(query, [{'term': {'uri': 'foo'}}, None], [{'exists': {'field': 'uri'}}, None])
+    benchmarks['set_filters'] = _set_filters
+
+    benchmarks['set_sort'] = lambda: set_sort({}, [('firstcreated', -1), ('name', 1)])
+
+    def _find():
+        req = ParsedRequest()
+        req.args = {'q': 'foo', 'filter': '{"term": {"uri": "foo"}}'}
+        req.max_results = 25
+        req.page = 2
+        app.data.find('items', req, {'name': 'foo'})
+    benchmarks['find_10'] = _find
+
+    for fields in (0, 10, 100):
+        docs = [dict(get_source(i, fields), _id=ObjectId(), _created=datetime.now()) for i in range(100)]
+
+        def _expand_action(docs=docs):
+            for doc in docs:
+                expand_action(doc)
+        benchmarks['expand_action_100x%d' % fields] = _expand_action
+
+        def _chunk(docs=docs):
+            for chunk in _chunk_actions(map(expand_action, docs), 500, 100 * 1024 * 1024, serializer):
+                pass
+        benchmarks['chunk_actions_100x%d' % fields] = _chunk
+
+    doc = dict(get_source(1, 10), _id=ObjectId(), _created=datetime.now())
+    benchmarks['serializer_dumps'] = lambda: serializer.dumps(doc)
+    raw_doc = serializer.dumps(doc)
+    benchmarks['serializer_loads'] = lambda: serializer.loads(raw_doc)
+
+    if orjson is not None:
+        fast_serializer = FastJSONSerializer()
+        benchmarks['fast_serializer_dumps'] = lambda: fast_serializer.dumps(doc)
+        benchmarks['fast_serializer_loads'] = lambda: fast_serializer.loads(raw_doc)
+    return benchmarks
+
+
+def measure(func, repeat=5, min_time=0.2):
+    """Get best time per call in seconds."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(pattern=None, repeat=5):
+    app = get_app()
+    results = {}
+    with app.app_context():
+        for name, func in sorted(get_benchmarks(app).items()):
+            if pattern and pattern not in name:
+                continue
+            results[name] = measure(func, repeat)
+            print('%-28s %12.2f us' % (name, results[name] * 1000000))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print comparison with baseline and return names of regressed benchmarks."""
+    regressions = []
+    for name, value in sorted(results.items()):
+        if name not in baseline.get('results', {}):
+            continue
+        ratio = value / baseline['results'][name]
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print('%-28s %6.2fx%s' % (name, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Eve-Elastic micro benchmarks.')
+    parser.add_argument('--filter', help='run only benchmarks containing given string')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', help='save results into json file')
+    parser.add_argument('--compare', help='compare results with saved json file')
+    parser.add_argument('--threshold', type=float, default=1.25, help='max allowed slowdown ratio')
+    args = parser.parse_args(argv)
+
+    results = run(args.filter, args.repeat)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'time': time.time(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
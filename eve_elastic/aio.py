@@ -0,0 +1,616 @@
+"""Asyncio counterpart of :class:`~eve_elastic.elastic.Elastic`.
+
+:class:`AsyncElastic` has coroutine versions of data layer methods and shares
+query building and hits parsing with :class:`~eve_elastic.elastic.Elastic`.
+Requests are sent via :class:`AsyncTransport` using single ``aiohttp`` session
+per client, so connections are pooled across hosts and tasks. Pool size is
+set via ``maxsize`` argument::
+
+    data = AsyncElastic(app, maxsize=1000)
+
+    async def search(req):
+        return await data.find('items', req, None)
+
+Methods must be awaited within flask app context. ``aiohttp`` is required
+unless ``fake://`` urls are used.
+"""
+
+import time
+import asyncio
+import elasticsearch
+
+from elasticsearch import Connection
+from elasticsearch.compat import urlencode
+from elasticsearch.exceptions import TransportError, ConnectionError, ConnectionTimeout, ImproperlyConfigured
+from elasticsearch.helpers import BulkIndexError
+from eve.utils import config
+
+from . import instrumentation
+from .elastic import Elastic, FAKE_SCHEME, get_es, get_lookup_query, is_found, is_routing_missing, \
+    is_routing_missing_hit, group_keys, get_mget_body, get_msearch_body, get_docs_cursor, unique, generate_index_name, \
+    logger
+from .fake import AsyncFakeConnection
+from .helpers import expand_action, _chunk_actions
+from .instrumentation import instrumented, reset_response_size
+from .loader import AsyncBatchLoader, SearchKey
+from .metrics import BulkClient
+from .transport import ElasticTransport, ResponseTooLarge, max_response_bytes
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class SharedSession(object):
+    """``aiohttp`` session shared by all connections of a transport.
+
+    It's created on first use, so it's bound to the event loop running at that time.
+
+    :param maxsize: max number of open connections
+    :param keep_alive: seconds idle connections are kept open
+    """
+
+    def __init__(self, maxsize=100, keep_alive=None):
+        self.maxsize = maxsize
+        self.keep_alive = keep_alive
+        self.session = None
+
+    def get(self):
+        if self.session is None or self.session.closed:
+            options = {'limit': self.maxsize}
+            if self.keep_alive is not None:
+                options['keepalive_timeout'] = self.keep_alive
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(**options))
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class AIOHttpConnection(Connection):
+    """Coroutine connection sending requests via :class:`SharedSession`."""
+
+    def __init__(self, host='localhost', port=9200, session=None, http_auth=None, headers=None, **kwargs):
+        if aiohttp is None:
+            raise ImproperlyConfigured('aiohttp is required for async connections')
+        super(AIOHttpConnection, self).__init__(host=host, port=port, **kwargs)
+        self.session = session if session is not None else SharedSession()
+        if isinstance(http_auth, str):
+            http_auth = http_auth.split(':', 1)
+        self.auth = aiohttp.BasicAuth(*http_auth) if http_auth else None
+        self.headers = {'content-type': 'application/json'}
+        self.headers.update(headers or {})
+        self.base_url = self.host + self.url_prefix
+
+    async def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        url_path = url
+        if params:
+            url_path = '%s?%s' % (url, urlencode(params))
+        full_url = self.base_url + url_path
+        request_headers = dict(self.headers, **headers) if headers else self.headers
+
+        start = time.time()
+        try:
+            async with self.session.get().request(
+                    method, full_url, data=body, headers=request_headers, auth=self.auth,
+                    timeout=aiohttp.ClientTimeout(total=timeout or self.timeout)) as response:
+                status = response.status
+                response_headers = response.headers
+                raw_data = await response.text()
+        except Exception as e:
+            self.log_request_fail(method, full_url, url_path, body, time.time() - start, exception=e)
+            if isinstance(e, asyncio.TimeoutError):
+                raise ConnectionTimeout('TIMEOUT', str(e), e)
+            raise ConnectionError('N/A', str(e), e)
+        duration = time.time() - start
+
+        if not (200 <= status < 300) and status not in ignore:
+            self.log_request_fail(method, full_url, url_path, body, duration, status, raw_data)
+            self._raise_error(status, raw_data)
+
+        self.log_request_success(method, full_url, url_path, body, status, raw_data, duration)
+        return status, response_headers, raw_data
+
+
+class AsyncTransport(ElasticTransport):
+    """Transport awaiting coroutine connections, client methods return coroutines.
+
+    All connections share single :class:`SharedSession` limited to ``maxsize`` connections.
+    Sniffing is not supported.
+    """
+
+    def __init__(self, hosts, maxsize=100, keep_alive=None, **kwargs):
+        self.session = SharedSession(maxsize, keep_alive)
+        kwargs.setdefault('connection_class', AIOHttpConnection)
+        super(AsyncTransport, self).__init__(hosts, session=self.session, **kwargs)
+
+    def get_connection(self):
+        return self.connection_pool.get_connection()
+
+    async def perform_request(self, method, url, headers=None, params=None, body=None):
+        opaque_id = instrumentation.get_opaque_id()
+        if opaque_id is not None:
+            headers = dict(headers or {})
+            headers.setdefault(instrumentation.OPAQUE_ID_HEADER, opaque_id)
+
+        if body is not None:
+            body = self._encode(body)
+            if method in ('HEAD', 'GET') and self.send_get_body_as == 'POST':
+                method = 'POST'
+
+        metrics = self.metrics
+        if metrics is None:
+            return await self._perform_request(method, url, headers, params, body)
+
+        if body is not None and url.endswith('_bulk'):
+            metrics.bulk_bytes.inc(len(body), prefix=self.prefix)
+
+        metrics.in_flight.inc(prefix=self.prefix)
+        try:
+            return await self._perform_request(method, url, headers, params, body)
+        finally:
+            metrics.in_flight.dec(prefix=self.prefix)
+
+    async def _perform_request(self, method, url, headers, params, body):
+        if not instrumentation.is_enabled():
+            return await self._send(method, url, headers, params, body)
+
+        opaque_id = headers.get(instrumentation.OPAQUE_ID_HEADER) if headers else None
+        timer = instrumentation.RequestTimer(method, url, body, opaque_id)
+        try:
+            data = await self._send(method, url, headers, params, body)
+        except Exception as e:
+            timer.finish(error=e)
+            raise
+        timer.finish(data)
+        return data
+
+    async def _send(self, method, url, headers, params, body):
+        """Send request with retries, same as :meth:`elasticsearch.Transport.perform_request`."""
+        ignore = ()
+        timeout = None
+        if params:
+            timeout = params.pop('request_timeout', None)
+            ignore = params.pop('ignore', ())
+            if isinstance(ignore, int):
+                ignore = (ignore, )
+
+        for attempt in range(self.max_retries + 1):
+            connection = self.get_connection()
+            if attempt:
+                await asyncio.sleep(2 ** attempt - 1)
+
+            try:
+                status, headers_response, data = await connection.perform_request(
+                    method, url, params, body, headers=headers, ignore=ignore, timeout=timeout)
+            except TransportError as e:
+                if method == 'HEAD' and e.status_code == 404:
+                    return False
+
+                retry = False
+                if isinstance(e, ConnectionTimeout):
+                    retry = self.retry_on_timeout
+                elif isinstance(e, ConnectionError):
+                    retry = True
+                elif e.status_code in self.retry_on_status:
+                    retry = True
+
+                if retry:
+                    self.mark_dead(connection)
+                    if attempt == self.max_retries:
+                        raise
+                else:
+                    raise
+            else:
+                self.connection_pool.mark_live(connection)
+
+                if method == 'HEAD':
+                    return 200 <= status < 300
+
+                if data:
+                    data = self.deserializer.loads(data, headers_response.get('content-type'))
+                return data
+
+    async def close(self):
+        """Close shared session."""
+        await self.session.close()
+
+
+def get_async_es(url, **kwargs):
+    """Create elasticsearch client with :class:`AsyncTransport`, its methods return coroutines.
+
+    :param url: elasticsearch url, use ``fake://`` scheme for in-process :mod:`~eve_elastic.fake` cluster
+    """
+    urls = [url] if isinstance(url, str) else url
+    if any(u.startswith(FAKE_SCHEME) for u in urls):
+        kwargs.setdefault('connection_class', AsyncFakeConnection)
+    kwargs.setdefault('connection_class', AIOHttpConnection)
+    kwargs.setdefault('transport_class', AsyncTransport)
+    return get_es(url, **kwargs)
+
+
+class AsyncBulkClient(BulkClient):
+    """Async client proxy counting items in bulk responses."""
+
+    async def bulk(self, *args, **kwargs):
+        response = await self.client.bulk(*args, **kwargs)
+        self.items += len(response.get('items', []))
+        return response
+
+
+async def async_bulk(client, actions, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, raise_on_error=True,
+                     max_retries=0, initial_backoff=2, max_backoff=600, expand_action_callback=expand_action,
+                     **kwargs):
+    """Coroutine version of :func:`elasticsearch.helpers.bulk`, returns number of indexed docs and errors.
+
+    Items rejected with ``429`` status are retried up to ``max_retries`` times with exponential
+    backoff. Errors are raised once all chunks are sent.
+    """
+    success, errors = 0, []
+    actions = map(expand_action_callback, actions)
+    for bulk_actions in _chunk_actions(actions, chunk_size, max_chunk_bytes, client.transport.serializer):
+        for attempt in range(max_retries + 1):
+            if attempt:
+                await asyncio.sleep(min(max_backoff, initial_backoff * 2 ** (attempt - 1)))
+
+            response = await client.bulk('\n'.join(bulk_actions) + '\n', **kwargs)
+            lines = iter(bulk_actions)
+            to_retry = []
+            for item in response['items']:
+                op_type, info = next(iter(item.items()))
+                item_lines = [next(lines)] if op_type == 'delete' else [next(lines), next(lines)]
+                status = info.get('status', 500)
+                if 200 <= status < 300:
+                    success += 1
+                elif status == 429 and attempt < max_retries:
+                    to_retry.extend(item_lines)
+                else:
+                    errors.append({op_type: info})
+
+            if not to_retry:
+                break
+            bulk_actions = to_retry
+
+    if errors and raise_on_error:
+        raise BulkIndexError('%i document(s) failed to index.' % len(errors), errors)
+    return success, errors
+
+
+class AsyncElastic(Elastic):
+    """Asyncio ElasticSearch data layer.
+
+    Data layer methods are coroutines, other methods like mapping generation,
+    query building and hits parsing are shared with :class:`~eve_elastic.elastic.Elastic`.
+    """
+
+    def __init__(self, app=None, **kwargs):
+        super(AsyncElastic, self).__init__(app, **kwargs)
+        self.id_loader = AsyncBatchLoader(self._find_by_ids)
+        self.search_loader = AsyncBatchLoader(self._msearch_batch)
+
+    def _create_client(self, url, **options):
+        return get_async_es(url, **options)
+
+    async def close(self):
+        """Close connections of all clients."""
+        for es in self.clients.all():
+            await es.transport.close()
+
+    async def init_index(self, app=None):
+        """Create indexes and put mapping."""
+        for index, settings in self._get_indexes().items():
+            es = settings['resource']
+            if not await es.indices.exists(index):
+                await self.create_index(index, {'mappings': settings.get('mappings')}, settings.get('settings'), es)
+            else:
+                await self.put_settings(app, index, None, es)
+
+    async def create_index(self, index=None, mappings=None, settings=None, es=None):
+        """Create new index and ignore if it exists already."""
+        if index is None:
+            index = self.index
+        if es is None:
+            es = self.es
+        try:
+            alias = generate_index_name(index)
+
+            args = {'index': index}
+            if mappings:
+                args['body'] = mappings
+
+            if settings:
+                args['body']['settings'] = settings
+
+            await es.indices.create(**args)
+            await es.indices.put_alias(index, alias)
+            logger.info('created index alias=%s index=%s' % (alias, index))
+        except elasticsearch.TransportError as e:
+            logger.exception(e)
+
+    async def put_mapping(self, app, index=None):
+        """Put mapping for elasticsearch for current schema."""
+        for resource, resource_config in self._get_elastic_resources().items():
+            kwargs = {
+                'index': index or self._resource_index(resource),
+                'doc_type': 'doc',
+                'body': self._get_mapping_properties(resource_config),
+            }
+
+            try:
+                await self.elastic(resource).indices.put_mapping(**kwargs)
+            except elasticsearch.exceptions.RequestError:
+                logger.exception('mapping error, updating settings resource=%s' % resource)
+
+    async def get_mapping(self, index=None, doc_type=None):
+        """Get mapping for index."""
+        mapping = await self.es.indices.get_mapping(index=self._get_index_prefix(index), doc_type=doc_type)
+        if index is None:
+            return mapping
+        return next(iter(mapping.values()))
+
+    async def get_settings(self, index):
+        """Get settings for index."""
+        settings = await self.es.indices.get_settings(index=self._get_index_prefix(index))
+        return next(iter(settings.values()))
+
+    async def get_index_by_alias(self, alias):
+        """Get index name for given alias, if there is no alias assume it's an index."""
+        try:
+            info = await self.es.indices.get_alias(name=alias)
+            return next(iter(info.keys()))
+        except elasticsearch.exceptions.NotFoundError:
+            return alias
+
+    async def put_settings(self, app=None, index=None, settings=None, es=None):
+        """Modify index settings, index must exist already."""
+        if not settings:
+            return
+
+        if not index:
+            index = self.index
+
+        if not es:
+            es = self.es
+
+        await es.indices.close(index=index)
+        await es.indices.put_settings(index=index, body=settings)
+        await es.indices.open(index=index)
+
+    @instrumented
+    async def find(self, resource, req, sub_resource_lookup):
+        """Find documents for resource."""
+        query, args = self._find_query(resource, req, sub_resource_lookup)
+        cache_key, aggregations = self._cached_aggregations(resource, query, args)
+        try:
+            hits = await self._load_search(resource, query, args, page=req.page)
+        except (ResponseTooLarge, elasticsearch.exceptions.RequestError) as e:
+            hits = self._search_error(resource, e)
+        self._cache_aggregations(resource, cache_key, aggregations, hits)
+        return self._find_cursor(resource, req, query, hits)
+
+    async def find_many(self, queries):
+        """Find documents for list of ``(resource, req, lookup)`` using single msearch per elastic prefix."""
+        results, searches = self._find_searches(queries)
+        responses = await self._msearch(list(searches.values()))
+        return self._find_results(queries, results, searches, responses)
+
+    async def _load_search(self, resource, query, args, page=None):
+        window = self._resource_config(resource, 'MSEARCH_WINDOW')
+        if window is None:
+            return await self._search(resource, query, args, page)
+        return await self.search_loader.load(SearchKey(resource, query, args, page), window)
+
+    async def _msearch_batch(self, searches):
+        return dict(zip(searches, await self._msearch(searches)))
+
+    async def _msearch(self, searches):
+        responses = [None] * len(searches)
+        for positions in self._group_searches(searches):
+            group = [searches[i] for i in positions]
+            try:
+                if self._resource_limit(group[0].resource, 'max_response_bytes') is not None:
+                    search = group[0]
+                    hits = [await self._search(search.resource, search.query, search.args, search.page)]
+                else:
+                    reset_response_size()
+                    started = time.time()
+                    response = await self.elastic(group[0].resource).msearch(body=get_msearch_body(group))
+                    hits = self._msearch_responses(group, response, time.time() - started)
+            except (elasticsearch.TransportError, ResponseTooLarge) as e:
+                hits = [e] * len(group)
+            for i, hit in zip(positions, hits):
+                responses[i] = hit
+        return responses
+
+    async def _search(self, resource, query, args, page=None):
+        reset_response_size()
+        started = time.time()
+        with max_response_bytes(self._resource_limit(resource, 'max_response_bytes')):
+            hits = await self.elastic(resource).search(body=query, **args)
+        self._record_search(resource, query, hits, time.time() - started, page)
+        return hits
+
+    @instrumented
+    async def find_one(self, resource, req, **lookup):
+        """Find single document, if there is _id in lookup use that, otherwise filter."""
+        if config.ID_FIELD in lookup:
+            return await self._load_by_id(resource, lookup[config.ID_FIELD], lookup.get('parent'))
+
+        args = self._es_args(resource)
+        args['size'] = 1
+        try:
+            hits = await self.elastic(self._get_index_prefix(resource)).search(body=get_lookup_query(lookup), **args)
+        except elasticsearch.NotFoundError:
+            return
+        return self._parse_hits(hits, resource).first()
+
+    async def _find_by_id(self, resource, _id, parent=None):
+        """Find the document by Id, search for it if it requires routing and parent is not provided."""
+        args = self._es_args(resource)
+        if parent:
+            args['parent'] = parent
+
+        try:
+            hit = await self.elastic(resource).get(id=_id, **args)
+        except elasticsearch.NotFoundError:
+            return
+        except elasticsearch.TransportError as e:
+            if not is_routing_missing(e):
+                return
+            args = self._es_args(resource)
+            args['size'] = 1
+            query = {'query': {'bool': {'must': [{'term': {'_id': _id}}]}}}
+            try:
+                hits = await self.elastic(resource).search(body=query, **args)
+            except elasticsearch.NotFoundError:
+                return
+            return self._parse_hits(hits, resource).first()
+
+        if is_found(hit):
+            return self._parse_hits({'hits': {'hits': [hit]}}, resource).first()
+
+    @instrumented
+    async def find_one_raw(self, resource, _id):
+        """Find document by id."""
+        return await self._load_by_id(resource, _id)
+
+    async def _load_by_id(self, resource, _id, parent=None):
+        """Find the document by Id, batched with lookups made in same loop iteration if ``BATCH_WINDOW`` is set."""
+        cached = self._cached_docs(resource, [_id])
+        if _id in cached:
+            return cached[_id]
+        window = self._resource_config(resource, 'BATCH_WINDOW')
+        if window is None:
+            doc = await self._find_by_id(resource, _id, parent)
+        else:
+            doc = await self.id_loader.load((resource, _id, parent), window)
+        self._cache_docs(resource, {_id: doc})
+        return doc
+
+    async def _find_by_ids(self, keys):
+        """Find documents for ``(resource, _id, parent)`` keys using single mget per resource."""
+        docs = {}
+        for resource, resource_keys in group_keys(keys).items():
+            try:
+                response = await self.elastic(resource).mget(body=get_mget_body(resource_keys),
+                                                             **self._es_args(resource))
+            except elasticsearch.NotFoundError:
+                continue
+            found = []
+            for key, hit in zip(resource_keys, response.get('docs', [])):
+                if is_routing_missing_hit(hit):
+                    docs[key] = await self._find_by_id(*key)
+                elif is_found(hit):
+                    found.append((key, hit))
+            docs.update(self._parse_found(resource, found))
+        return docs
+
+    @instrumented
+    async def find_list_of_ids(self, resource, ids, client_projection=None):
+        """Find documents by ids in order of ids, docs not found are skipped."""
+        return get_docs_cursor([doc async for doc in self.iter_list_of_ids(resource, ids, client_projection)])
+
+    async def iter_list_of_ids(self, resource, ids, client_projection=None):
+        """Find documents by ids, yields them in order of ids as chunks of ids are fetched.
+
+        Up to ``MGET_CONCURRENCY`` chunks are fetched concurrently.
+        """
+        docs = {} if client_projection else self._cached_docs(resource, ids)
+        es, args, chunks = self._mget_args(resource, [_id for _id in unique(ids) if _id not in docs],
+                                           client_projection)
+        semaphore = asyncio.Semaphore(self._resource_config(resource, 'MGET_CONCURRENCY') or 1)
+
+        async def fetch(chunk):
+            async with semaphore:
+                return self._parse_mget(resource, chunk, await es.mget(body={'ids': chunk}, **args))
+
+        tasks = [asyncio.ensure_future(fetch(chunk)) for chunk in chunks]
+        pending = iter(tasks)
+        try:
+            for _id in ids:
+                while _id not in docs:
+                    fetched = await next(pending)
+                    if not client_projection:
+                        self._cache_docs(resource, fetched)
+                    docs.update(fetched)
+                if docs[_id] is not None:
+                    yield docs[_id]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @instrumented
+    async def insert(self, resource, doc_or_docs, **kwargs):
+        """Insert document, it must be new if there is ``_id`` in it."""
+        ids = []
+        kwargs.update(self._es_args(resource))
+        self._invalidate_docs(resource, [doc['_id'] for doc in doc_or_docs if doc.get('_id')])
+
+        for doc in doc_or_docs:
+            self._update_parent_join_args(kwargs, doc)
+            _id = doc.pop('_id', None)
+            res = await self.elastic(resource).index(body=doc, id=_id, **kwargs)
+            doc.setdefault('_id', res.get('_id', _id))
+            ids.append(doc.get('_id'))
+        self.metrics.docs_indexed.inc(len(ids), resource=resource)
+        await self._refresh_resource_index(resource)
+        return ids
+
+    @instrumented
+    async def bulk_insert(self, resource, docs, **kwargs):
+        """Bulk insert documents, see :func:`async_bulk`."""
+        raise_on_error = self._bulk_kwargs(resource, kwargs)
+        client = AsyncBulkClient(self.elastic(resource))
+        self._invalidate_docs(resource)
+        success, errors = await async_bulk(client, docs, **kwargs)
+        self._bulk_result(resource, success, errors, client.items, raise_on_error)
+        await self._refresh_resource_index(resource)
+        return success, errors
+
+    @instrumented
+    async def update(self, resource, id_, updates, original=None):
+        """Update document in index."""
+        args = self._update_args(resource, updates)
+        self._invalidate_docs(resource, [id_])
+        res = await self.elastic(resource).update(id=id_, body={'doc': updates}, **args)
+        self.metrics.docs_indexed.inc(resource=resource)
+        return res
+
+    @instrumented
+    async def replace(self, resource, id_, document):
+        """Replace document in index."""
+        args = self._doc_args(resource, document)
+        self._invalidate_docs(resource, [id_])
+        res = await self.elastic(resource).index(body=document, id=id_, **args)
+        self.metrics.docs_indexed.inc(resource=resource)
+        return res
+
+    @instrumented
+    async def remove(self, resource, lookup=None, parent=None, **kwargs):
+        """Remove docs for resource."""
+        kwargs.update(self._es_args(resource))
+        if parent:
+            kwargs['parent'] = parent
+        if lookup and lookup.get('_id'):
+            self._invalidate_docs(resource, [lookup['_id']])
+            try:
+                return await self.elastic(resource).delete(id=lookup.get('_id'), refresh=True, **kwargs)
+            except elasticsearch.NotFoundError:
+                return
+        return ValueError('there must be `lookup._id` specified')
+
+    @instrumented
+    async def is_empty(self, resource):
+        """Test if there is no document for resource."""
+        resource = self._get_index_prefix(resource)
+        args = self._es_args(resource)
+        res = await self.elastic(resource).count(body={'query': {'match_all': {}}}, terminate_after=1, **args)
+        return res.get('count', 0) == 0
+
+    async def _refresh_resource_index(self, resource):
+        if self._resource_config(resource, 'FORCE_REFRESH', True):
+            await self.elastic(resource).indices.refresh(self._resource_index(resource))
+            self.metrics.refreshes.inc(resource=resource)
@@ -0,0 +1,60 @@
+"""Time limited cache of search response parts, eg. aggregations.
+
+Entries are stored with their own ttl, expired ones are removed when read or
+when the cache gets full. Oldest entries are removed to make space otherwise.
+"""
+
+import json
+import time
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+
+def get_search_key(index, query):
+    """Get hash of search body for given index."""
+    body = json.dumps([index, query], sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+
+class TTLCache(object):
+    """Thread safe cache with ttl per entry.
+
+    :param max_size: max number of entries
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Get value for key, ``None`` if it's missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self.entries[key]
+                return None
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        """Store value for ``ttl`` seconds."""
+        with self.lock:
+            self.entries.pop(key, None)
+            if len(self.entries) >= self.max_size:
+                self._evict()
+            self.entries[key] = (time.time() + ttl, value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _evict(self):
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if entry[0] <= now]:
+            del self.entries[key]
+        while len(self.entries) >= self.max_size:
+            self.entries.popitem(last=False)
@@ -0,0 +1,111 @@
+"""Registry of elasticsearch clients shared by elastic prefixes.
+
+Prefixes using same url and options get clients sharing connection pool, every
+prefix has its own transport so it can be configured separately (eg. metrics label).
+Clients are created lazily and forgotten when process id changes, so forked
+workers open their own sockets instead of using ones inherited from parent.
+"""
+
+import os
+import copy
+import threading
+import elasticsearch
+from urllib.parse import urlsplit
+
+
+DEFAULT_PORTS = {'https': 443}
+
+#: guards reset of registries in forked process
+_fork_lock = threading.Lock()
+
+
+def _reinit_fork_lock():
+    # lock might be held by thread which doesn't exist after fork
+    global _fork_lock
+    _fork_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reinit_fork_lock)
+
+
+def normalize_url(url):
+    """Get url with lowercase scheme and host, explicit port and no trailing slash."""
+    if '://' not in url:
+        url = 'http://' + url
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    port = parts.port or DEFAULT_PORTS.get(scheme, 9200)
+    auth = parts.netloc.rpartition('@')[0]
+    return '%s://%s%s:%d%s' % (scheme, auth + '@' if auth else '', (parts.hostname or 'localhost').lower(), port,
+                               parts.path.rstrip('/'))
+
+
+def get_client_key(url, options):
+    """Get registry key for url (or list of urls) and client options."""
+    urls = [url] if isinstance(url, str) else url
+    return (tuple(sorted(normalize_url(u) for u in urls)),
+            tuple(sorted((key, repr(value)) for key, value in options.items())))
+
+
+def share_client(client):
+    """Get new client with copy of ``client`` transport using same connections."""
+    transport = copy.copy(client.transport)
+    return elasticsearch.Elasticsearch(transport_class=lambda hosts, **kwargs: transport)
+
+
+class ClientRegistry(object):
+    """Thread safe registry of clients created via ``factory(url, **options)``.
+
+    :param factory: client factory, eg. :func:`~eve_elastic.elastic.get_es`
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._reset()
+
+    def _reset(self):
+        # lock might be held by thread which doesn't exist after fork, so it's replaced
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.names = {}
+        self.pid = os.getpid()
+
+    def get(self, name):
+        """Get client for given name, ``None`` if it was not created in current process yet.
+
+        :param name: name client is cached by, eg. elastic prefix
+        """
+        self._check_pid()
+        return self.names.get(name)
+
+    def _check_pid(self):
+        """Forget clients inherited from parent process, once per process."""
+        if self.pid != os.getpid():
+            with _fork_lock:
+                if self.pid != os.getpid():
+                    # inherited sockets are left open, closing them could break parent connections
+                    self._reset()
+
+    def create(self, name, url, **options):
+        """Create client for given name, it shares connections with other names using same url and options.
+
+        :param name: name client is cached by, eg. elastic prefix
+        :param url: url or list of urls
+        :param options: client options
+        """
+        key = get_client_key(url, options)
+        self._check_pid()
+        with self.lock:
+            if key not in self.clients:
+                client = self.clients[key] = self.factory(url, **options)
+            else:
+                client = share_client(self.clients[key])
+            self.names[name] = client
+            return client
+
+    def all(self):
+        """Get clients created via factory in current process, one per connection pool."""
+        if self.pid != os.getpid():
+            return []
+        return list(self.clients.values())
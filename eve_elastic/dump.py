@@ -0,0 +1,333 @@
+"""Export resources into compressed NDJSON or CSV files and import them back.
+
+Documents are streamed from elastic using :func:`~eve_elastic.helpers.scan`,
+formatted same way like documents returned by :meth:`Elastic.find` and written
+line by line so memory usage doesn't depend on resource size.
+
+It can be used from code::
+
+    with app.app_context():
+        export_resource(app.data, 'items', '/tmp/items', compression='gzip', slices=4)
+
+or via command line::
+
+    $ eve-elastic --settings settings.py export items /tmp/items --slices 4
+
+Uncompressed NDJSON files can be imported via :func:`import_resource`::
+
+    $ eve-elastic --settings settings.py import items /tmp/items-00-0000.ndjson --threads 4
+"""
+
+import io
+import os
+import csv
+import gzip
+import json
+import argparse
+
+from eve.utils import config
+
+from .elastic import Elastic, format_doc
+from .serializer import get_serializer
+from .helpers import scan, get_version, ndjson_bulk
+
+
+FORMATS = ('ndjson', 'csv')
+COMPRESSIONS = (None, 'gzip', 'zstd')
+
+#: default max size of single file on disk, new part file is started when exceeded
+MAX_FILE_SIZE = 1024 * 1024 * 1024
+
+
+def open_compressed(path, compression=None, level=None):
+    """Open binary file for writing with given compression.
+
+    :param path: file path
+    :param compression: ``None``, ``'gzip'`` or ``'zstd'`` (requires ``zstandard`` package)
+    :param level: compression level
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError('unknown compression %s' % compression)
+
+    raw = open(path, 'wb')
+    if compression == 'gzip':
+        return raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level or 6)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raw.close()
+            raise RuntimeError('zstd compression requires zstandard package')
+        return raw, zstandard.ZstdCompressor(level=level or 3).stream_writer(raw)
+    return raw, raw
+
+
+def get_extension(format, compression=None):
+    """Get file extension for given format and compression."""
+    extension = format
+    if compression == 'gzip':
+        extension += '.gz'
+    elif compression == 'zstd':
+        extension += '.zst'
+    return extension
+
+
+class PartWriter(object):
+    """Write lines into part files, starting new part once file gets bigger than ``max_file_size``.
+
+    Part files are named ``<path>-<slice>-<part>.<extension>``.
+    """
+
+    def __init__(self, path, format='ndjson', compression=None, max_file_size=MAX_FILE_SIZE,
+                 slice_id=0, header=None, level=None):
+        self.path = path
+        self.format = format
+        self.compression = compression
+        self.max_file_size = max_file_size
+        self.slice_id = slice_id
+        self.header = header
+        self.level = level
+        self.files = []
+        self.raw = None
+        self.stream = None
+        self.count = 0
+
+    def _open(self):
+        filename = '%s-%02d-%04d.%s' % (self.path, self.slice_id, len(self.files),
+                                        get_extension(self.format, self.compression))
+        self.raw, self.stream = open_compressed(filename, self.compression, self.level)
+        self.files.append(filename)
+        if self.header:
+            self.stream.write(self.header)
+
+    def write(self, line):
+        """Write single line, ``line`` must be encoded and contain line separator."""
+        if self.stream is None:
+            self._open()
+        elif self.raw.tell() >= self.max_file_size:
+            self.close()
+            self._open()
+        self.stream.write(line)
+        self.count += 1
+
+    def close(self):
+        """Close current part file."""
+        if self.stream is not None:
+            self.stream.close()
+            if not self.raw.closed:
+                self.raw.close()
+            self.raw = None
+            self.stream = None
+
+
+def get_csv_value(value, serializer):
+    """Convert document value into csv cell."""
+    if value is None:
+        return ''
+    if isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, (dict, list)):
+        return serializer.dumps(value)
+    return serializer.default(value)
+
+
+def get_csv_fields(schema):
+    """Get csv columns for given resource schema."""
+    fields = [config.ID_FIELD, config.DATE_CREATED, config.LAST_UPDATED]
+    fields.extend(field for field in sorted(schema) if field not in fields)
+    return fields
+
+
+class LineFormatter(object):
+    """Format docs into encoded lines of given format."""
+
+    def __init__(self, format, fields=None, serializer=None):
+        if format not in FORMATS:
+            raise ValueError('unknown format %s' % format)
+        self.format = format
+        self.fields = fields
+        self.serializer = serializer or get_serializer()
+
+    def header(self):
+        if self.format == 'csv':
+            return self._csv_line(self.fields)
+
+    def _csv_line(self, values):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(values)
+        return buffer.getvalue().encode('utf-8')
+
+    def __call__(self, doc):
+        if self.format == 'csv':
+            return self._csv_line([get_csv_value(doc.get(field), self.serializer) for field in self.fields])
+
+        # write id as first key so it can be used on import without parsing docs
+        _id = doc.pop(config.ID_FIELD, None)
+        doc.pop('_type', None)
+        line = self.serializer.dumps(doc)
+        if _id is not None:
+            line = '{"_id":%s%s%s' % (json.dumps(str(_id)), ',' if doc else '', line[1:])
+        return (line + '\n').encode('utf-8')
+
+
+def get_export_query(resource, query=None):
+    """Get query for export, adding resource ``elastic_filter`` if any."""
+    body = {'query': query or {'match_all': {}}}
+    elastic_filter = config.SOURCES[resource].get('elastic_filter')
+    if elastic_filter:
+        body['query'] = {'bool': {'must': [body['query']], 'filter': [elastic_filter]}}
+    return body
+
+
+def export_resource(data, resource, path, format='ndjson', compression='gzip', query=None, fields=None,
+                    max_file_size=MAX_FILE_SIZE, slices=1, size=1000, scroll='5m', level=None):
+    """Export all resource documents into files.
+
+    It must run within app context. Returns list of files written.
+
+    :param data: :class:`Elastic` instance
+    :param resource: resource name
+    :param path: path prefix for part files
+    :param format: ``ndjson`` or ``csv``
+    :param compression: ``None``, ``gzip`` or ``zstd``
+    :param query: query dsl to filter documents, all documents are exported by default
+    :param fields: csv columns, defaults to resource schema fields
+    :param max_file_size: max size of single file
+    :param slices: number of slices scanned in parallel, each writing its own files
+    :param size: number of docs fetched per shard in single request
+    :param scroll: scroll keep alive
+    :param level: compression level
+    """
+    schema = data._get_schema(resource)
+    transform = data._get_transform(resource)
+    es = data.elastic(resource)
+    version = get_version(es)
+    body = get_export_query(resource, query)
+    formatter = LineFormatter(format, fields or get_csv_fields(schema), es.transport.serializer)
+    args = data._es_args(resource)
+    app = data.app
+
+    def export_slice(slice_id):
+        writer = PartWriter(path, format, compression, max_file_size, slice_id, formatter.header(), level)
+        hits = scan(es, body, scroll=scroll, size=size, slice_id=slice_id, slice_max=slices, version=version,
+                    **args)
+        try:
+            with app.app_context():
+                for hit in hits:
+                    writer.write(formatter(format_doc(hit, schema, None, transform)))
+        finally:
+            hits.close()
+            writer.close()
+        return writer.files
+
+    if slices > 1:
+        # Avoid importing multiprocessing unless it's used, same as in parallel_bulk
+        from multiprocessing.dummy import Pool
+        pool = Pool(slices)
+        try:
+            files = pool.map(export_slice, range(slices))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        files = [export_slice(0)]
+
+    return [filename for slice_files in files for filename in slice_files]
+
+
+def import_resource(data, resource, path, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, thread_count=1,
+                    op_type='index', raise_on_error=False):
+    """Import documents from uncompressed ndjson file into resource index.
+
+    Documents are sent as they are in the file, ids are taken from files
+    written by :func:`export_resource`. It must run within app context.
+    Returns tuple with number of imported docs and list of errors.
+
+    :param data: :class:`Elastic` instance
+    :param resource: resource name
+    :param path: ndjson file path
+    :param chunk_size: number of docs in single bulk request
+    :param max_chunk_bytes: max size of single bulk request
+    :param thread_count: number of threads sending bulk requests
+    :param op_type: ``index`` or ``create``
+    :param raise_on_error: raise ``BulkIndexError`` on failed docs
+    """
+    args = data._es_args(resource)
+    success, errors = 0, []
+    for ok, item in ndjson_bulk(data.elastic(resource), path, chunk_size=chunk_size,
+                                max_chunk_bytes=max_chunk_bytes, thread_count=thread_count,
+                                op_type=op_type, id_prefix=True, raise_on_error=raise_on_error, **args):
+        if ok:
+            success += 1
+        else:
+            errors.append(item)
+    data._refresh_resource_index(resource)
+    return success, errors
+
+
+def get_app(settings=None):
+    """Create eve app using elastic data layer."""
+    import eve
+    return eve.Eve(settings=os.path.abspath(settings) if settings else None, data=Elastic)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='eve-elastic', description='Eve-Elastic data tools.')
+    parser.add_argument('--settings', help='eve settings file')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    export_parser = commands.add_parser('export', help='export resource into files')
+    export_parser.add_argument('resource')
+    export_parser.add_argument('path', help='path prefix for exported files')
+    export_parser.add_argument('--format', choices=FORMATS, default='ndjson')
+    export_parser.add_argument('--compression', choices=['none', 'gzip', 'zstd'], default='gzip')
+    export_parser.add_argument('--level', type=int, help='compression level')
+    export_parser.add_argument('--query', type=json.loads, help='query dsl as json')
+    export_parser.add_argument('--fields', help='comma separated list of csv columns')
+    export_parser.add_argument('--max-file-size', type=int, default=MAX_FILE_SIZE)
+    export_parser.add_argument('--slices', type=int, default=1)
+    export_parser.add_argument('--size', type=int, default=1000)
+
+    import_parser = commands.add_parser('import', help='import resource from ndjson file')
+    import_parser.add_argument('resource')
+    import_parser.add_argument('path', help='uncompressed ndjson file')
+    import_parser.add_argument('--chunk-size', type=int, default=500)
+    import_parser.add_argument('--max-chunk-bytes', type=int, default=100 * 1024 * 1024)
+    import_parser.add_argument('--threads', type=int, default=1)
+    import_parser.add_argument('--op-type', choices=['index', 'create'], default='index')
+    return parser
+
+
+def main(argv=None):
+    """Command line entry point."""
+    args = get_parser().parse_args(argv)
+    app = get_app(args.settings)
+    with app.app_context():
+        if args.command == 'export':
+            files = export_resource(
+                app.data, args.resource, args.path,
+                format=args.format,
+                compression=None if args.compression == 'none' else args.compression,
+                query=args.query,
+                fields=args.fields.split(',') if args.fields else None,
+                max_file_size=args.max_file_size,
+                slices=args.slices,
+                size=args.size,
+                level=args.level,
+            )
+            for filename in files:
+                print(filename)
+        elif args.command == 'import':
+            success, errors = import_resource(
+                app.data, args.resource, args.path,
+                chunk_size=args.chunk_size,
+                max_chunk_bytes=args.max_chunk_bytes,
+                thread_count=args.threads,
+                op_type=args.op_type,
+            )
+            print('imported %d docs, %d failed' % (success, len(errors)))
+
+
+if __name__ == '__main__':
+    main()
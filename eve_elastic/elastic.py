@@ -1,6 +1,7 @@
 
 import ast
 import json
+import time
 import arrow
 import ciso8601
 import pytz  # NOQA
@@ -8,14 +9,28 @@ import logging
 import elasticsearch
 
 from bson import ObjectId
-from elasticsearch.helpers import bulk, reindex as reindex_new
+from bson.errors import InvalidId
+from elasticsearch.helpers import bulk, reindex as reindex_new, BulkIndexError
 from .helpers import reindex as reindex_old
-
+from .instrumentation import instrumented, reset_response_size, get_response_size, copy_context
+from .metrics import DataLayerMetrics, BulkClient, get_metrics_view
+from .slowlog import SlowQueryLog
+from .transport import ElasticTransport, ElasticConnection, ResponseTooLarge, max_response_bytes
+from .cache import TTLCache, get_search_key
+from .clients import ClientRegistry
+from .loader import BatchLoader, SearchKey, MISSING, get_identity_map
+from .fake import FakeConnection
+from .serializer import ElasticJSONSerializer, get_serializer  # NOQA
+from .where import WhereTranslator
+
+from copy import deepcopy
 from uuid import uuid4
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from flask import request, abort
 from eve.utils import config
 from eve.io.base import DataLayer
-from eve.io.mongo.parser import parse, ParseError
+from eve.io.mongo import MongoJSONEncoder
 from arrow.parser import ParserError
 
 logging.basicConfig()
@@ -28,16 +43,57 @@ def parse_date(date_str):
         return None
 
     try:
-        date = ciso8601.parse_datetime(date_str)
+        try:
+            date = ciso8601.parse_datetime(date_str)
+        except ValueError:  # ciso8601 2.x raises instead of returning None
+            date = None
         if not date:
             date = arrow.get(date_str).datetime
     except TypeError:
         date = arrow.get(date_str[0]).datetime
-    except ParserError:
+    except (ParserError, ValueError):
         return None
     return date
 
 
+class DateParser(object):
+    """Date parser with memo for values ``ciso8601`` can't parse.
+
+    Values ``ciso8601`` can parse are not memoized, it's faster than memo lookup.
+    Others are parsed by ``arrow`` once and memoized including failures, so the slow
+    fallback runs once per value. Memo is cleared once it reaches ``max_size``.
+
+    Use bound :meth:`parse` as serializer, calling the instance is slower.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.dates = {}
+
+    def parse(self, value):
+        try:
+            date = ciso8601.parse_datetime(value)
+            if date:
+                return date
+        except ValueError:
+            pass
+        except TypeError:
+            return parse_date(value)
+
+        try:
+            return self.dates[value]
+        except KeyError:
+            pass
+
+        date = parse_date(value)
+        if len(self.dates) >= self.max_size:
+            self.dates.clear()
+        self.dates[value] = date
+        return date
+
+    __call__ = parse
+
+
 def get_dates(schema):
     """Return list of datetime fields for given schema."""
     dates = [config.LAST_UPDATED, config.DATE_CREATED]
@@ -48,14 +104,92 @@ def get_dates(schema):
     return dates
 
 
-def format_doc(hit, schema, dates):
-    """Format given doc to match given schema."""
+def _compile_value(field_schema, serializers):
+    """Get function converting value of given field schema, ``None`` if there is nothing to convert."""
+    field_type = field_schema.get('type')
+    if isinstance(field_type, list):
+        # multiple types, use serializers of known ones on string values
+        converters = [serializers[_type] for _type in field_type if isinstance(_type, str) and _type in serializers]
+        if converters:
+            def convert_any(value):
+                if isinstance(value, str):
+                    for convert in converters:
+                        try:
+                            converted = convert(value)
+                        except (TypeError, ValueError, InvalidId):
+                            continue
+                        if converted is not None:
+                            return converted
+                return value
+            return convert_any
+    elif field_type == 'datetime':
+        return serializers['datetime']
+    elif field_type in serializers:
+        convert = serializers[field_type]
+
+        def convert_string(value):
+            if isinstance(value, str):
+                try:
+                    return convert(value)
+                except (TypeError, ValueError, InvalidId):
+                    pass
+            return value
+        return convert_string
+    elif field_type == 'dict' and field_schema.get('schema'):
+        transform = compile_transform(field_schema['schema'], serializers)
+        if transform is not None:
+            def convert_dict(value):
+                return transform(value) if isinstance(value, dict) else value
+            return convert_dict
+    elif field_type == 'list' and isinstance(field_schema.get('schema'), dict):
+        convert_item = _compile_value(field_schema['schema'], serializers)
+        if convert_item is not None:
+            def convert_list(value):
+                if isinstance(value, list):
+                    return [convert_item(item) for item in value]
+                return convert_item(value)
+            return convert_list
+
+
+def compile_transform(schema, serializers):
+    """Compile function converting document fields in place using ``serializers`` per field type.
+
+    Nested ``dict`` and ``list`` schemas are handled, fields without anything
+    to convert are skipped. Returns ``None`` if there is nothing to convert.
+    """
+    fields = []
+    for field, field_schema in schema.items():
+        convert = _compile_value(field_schema, serializers) if isinstance(field_schema, dict) else None
+        if convert is not None:
+            fields.append((field, convert))
+
+    if not fields:
+        return None
+
+    def transform(doc):
+        for field, convert in fields:
+            value = doc.get(field)
+            if value is not None:
+                doc[field] = convert(value)
+        return doc
+    return transform
+
+
+def format_doc(hit, schema, dates, transform=None):
+    """Format given doc to match given schema.
+
+    If ``transform`` from :func:`compile_transform` is provided it's used instead of ``dates``.
+    """
     doc = hit.get('_source', {})
     doc.setdefault(config.ID_FIELD, hit.get('_id'))
     doc.setdefault('_type', hit.get('_type'))
     if hit.get('highlight'):
         doc['es_highlight'] = hit.get('highlight')
 
+    if transform is not None:
+        transform(doc)
+        return doc
+
     for key in dates:
         if key in doc:
             doc[key] = parse_date(doc[key])
@@ -63,11 +197,55 @@ def format_doc(hit, schema, dates):
     return doc
 
 
+#: query clauses which only filter docs
+FILTER_CLAUSES = frozenset(['term', 'terms', 'range', 'exists', 'ids'])
+
+
 def noop():
     """no-op."""
     pass
 
 
+#: aggregations with ``size`` param and its default
+SIZED_AGGREGATIONS = {'terms': 10, 'significant_terms': 10, 'composite': 10, 'top_hits': 3}
+
+
+def get_bucket_count(aggs):
+    """Get max number of buckets requested by aggregations.
+
+    Aggregations without ``size`` like histograms count as single bucket.
+    """
+    count = 0
+    for agg in (aggs or {}).values():
+        size = 1
+        for key, params in agg.items():
+            if key in SIZED_AGGREGATIONS:
+                size = params.get('size', SIZED_AGGREGATIONS[key])
+            elif key == 'filters':
+                size = len(params.get('filters', []))
+            elif key in ('range', 'date_range'):
+                size = len(params.get('ranges', []))
+        count += size + size * get_bucket_count(agg.get('aggs', agg.get('aggregations')))
+    return count
+
+
+def count_buckets(aggregations):
+    """Get number of buckets in aggregations response."""
+    count = 0
+    for agg in (aggregations or {}).values():
+        if not isinstance(agg, dict):
+            continue
+        buckets = agg.get('buckets', [])
+        if isinstance(buckets, dict):
+            buckets = list(buckets.values())
+        count += len(buckets)
+        for bucket in buckets:
+            count += count_buckets(bucket)
+        if 'buckets' not in agg:
+            count += count_buckets(agg)
+    return count
+
+
 def is_elastic(datasource):
     """Detect if given resource uses elastic."""
     return datasource.get('backend') == 'elastic' or datasource.get('search_backend') == 'elastic'
@@ -98,15 +276,6 @@ class InvalidIndexSettings(Exception):
     pass
 
 
-class ElasticJSONSerializer(elasticsearch.JSONSerializer):
-    """Customize the JSON serializer used in Elastic."""
-    def default(self, value):
-        """Convert mongo.ObjectId."""
-        if isinstance(value, ObjectId):
-            return str(value)
-        return super(ElasticJSONSerializer, self).default(value)
-
-
 class ElasticCursor(object):
     """Search results cursor."""
 
@@ -116,6 +285,7 @@ class ElasticCursor(object):
         """Parse hits into docs."""
         self.hits = hits if hits else self.no_hits
         self.docs = docs if docs else []
+        self.query = None
 
     def __getitem__(self, key):
         """Return a specific document item."""
@@ -135,24 +305,77 @@ class ElasticCursor(object):
             response['_facets'] = self.hits['facets']
         if 'aggregations' in self.hits:
             response['_aggregations'] = self.hits['aggregations']
+        if 'profile' in self.hits:
+            response['_profile'] = get_profile_summary(self.hits['profile'])
+            response['_profile']['body'] = self.query
 
 
-def set_filters(query, must_filter, base_filters=None):
+def _nanos_to_ms(nanos):
+    return round(nanos / 1000000.0, 3)
+
+
+def get_profile_summary(profile):
+    """Condense search profile into timings per shard.
+
+    Times are in milliseconds, ``queries`` contains top level queries with their timings.
+    """
+    shards = []
+    for shard in profile.get('shards', []):
+        summary = {'id': shard.get('id'), 'query': 0, 'rewrite': 0, 'collector': 0, 'aggregations': 0, 'queries': []}
+        for search in shard.get('searches', []):
+            for query in search.get('query', []):
+                summary['query'] += query.get('time_in_nanos', 0)
+                summary['queries'].append({
+                    'type': query.get('type'),
+                    'description': query.get('description'),
+                    'time': _nanos_to_ms(query.get('time_in_nanos', 0)),
+                })
+            summary['rewrite'] += search.get('rewrite_time', 0)
+            summary['collector'] += sum(collector.get('time_in_nanos', 0) for collector in search.get('collector', []))
+        summary['aggregations'] += sum(agg.get('time_in_nanos', 0) for agg in shard.get('aggregations', []))
+        for key in ('query', 'rewrite', 'collector', 'aggregations'):
+            summary[key] = _nanos_to_ms(summary[key])
+        shards.append(summary)
+    return {'shards': shards}
+
+
+def is_filter_clause(clause):
+    """Test if query clause only filters docs, so it doesn't have to be scored and can be cached."""
+    if not isinstance(clause, dict) or len(clause) != 1:
+        return False
+    key, value = next(iter(clause.items()))
+    if key == 'bool':
+        return bool(value) and all(occur in ('filter', 'must_not') for occur in value)
+    return key in FILTER_CLAUSES
+
+
+def set_filters(query, must_filter, base_filters=None, legacy=False):
     """Put together must_filters and base_filters that are requested and set them as filter or accordingly.
 
     :param query: elastic query being constructed
     :param base_filters: all filters defined in the mapping already (elastic_filter_callback, elastic_filter)
     :param must_filters: all filters set inside the query (eg. resource config, sub_resource_lookup)
+    :param legacy: keep all must_filters in ``bool.must``, otherwise filter clauses are moved to ``bool.filter``
     """
 
-    filters = [f for f in base_filters if f is not None]
-    must_filters = [f for f in must_filter if f is not None]
+    filters = [f for f in base_filters or [] if f is not None]
+    must_filters = []
+    for f in must_filter:
+        if isinstance(f, list):
+            must_filters.extend(f)
+        elif f is not None:
+            must_filters.append(f)
 
     query_filter = query['query'].get('filter', None)
 
     if query_filter is not None:
         filters = query_filter
 
+    if not legacy and any(is_filter_clause(f) for f in must_filters):
+        filters = filters if isinstance(filters, list) else [filters]
+        filters = filters + [f for f in must_filters if is_filter_clause(f)]
+        must_filters = [f for f in must_filters if not is_filter_clause(f)]
+
     if 'bool' not in query['query'] and (must_filters or filters):
         query['query']['bool'] = {}
 
@@ -162,6 +385,15 @@ def set_filters(query, must_filter, base_filters=None):
         query['query']['bool']['filter'] = filters
 
 
+def set_count_only(query):
+    """Update search body to return only hits total."""
+    for key in ('from', 'sort', 'highlight', 'aggs', 'facets'):
+        query.pop(key, None)
+    query['size'] = 0
+    query['_source'] = False
+    query['track_total_hits'] = True
+
+
 def set_sort(query, sort):
     """Set the sorting on the sorted value to the field.
 
@@ -179,13 +411,21 @@ def set_sort(query, sort):
         query['sort'].append(sort_dict)
 
 
+FAKE_SCHEME = 'fake://'
+
+
 def get_es(url, **kwargs):
     """Create elasticsearch client instance.
 
-    :param url: elasticsearch url
+    :param url: elasticsearch url, use ``fake://`` scheme for in-process :mod:`~eve_elastic.fake` cluster
     """
     urls = [url] if isinstance(url, str) else url
-    kwargs.setdefault('serializer', ElasticJSONSerializer())
+    if any(u.startswith(FAKE_SCHEME) for u in urls):
+        urls = ['http://' + u[len(FAKE_SCHEME):] if u.startswith(FAKE_SCHEME) else u for u in urls]
+        kwargs.setdefault('connection_class', FakeConnection)
+    kwargs.setdefault('connection_class', ElasticConnection)
+    kwargs.setdefault('serializer', get_serializer())
+    kwargs.setdefault('transport_class', ElasticTransport)
     es = elasticsearch.Elasticsearch(urls, **kwargs)
     return es
 
@@ -195,6 +435,14 @@ def get_indices(es):
     return es.indices
 
 
+#: client options configurable per elastic prefix, eg. ``ELASTICSEARCH_POOL_SIZE``
+CLIENT_OPTIONS = (
+    ('POOL_SIZE', 'maxsize'),
+    ('TIMEOUT', 'timeout'),
+    ('KEEP_ALIVE', 'keep_alive'),
+)
+
+
 class Elastic(DataLayer):
     """ElasticSearch data layer."""
 
@@ -204,11 +452,22 @@ class Elastic(DataLayer):
         'objectid': ObjectId,
     }
 
+    # objectid fields are converted to ObjectId when parsing hits
+    json_encoder_class = MongoJSONEncoder
+
     def __init__(self, app=None, **kwargs):
         """Let user specify extra arguments for Elasticsearch."""
         self.app = app
         self.kwargs = kwargs
-        self.elastics = {}
+        self.clients = ClientRegistry(self._create_client)
+        self.id_loader = BatchLoader(self._find_by_ids)
+        self.search_loader = BatchLoader(self._msearch_batch)
+        self.transforms = {}
+        self.date_parser = DateParser().parse
+        self.where_translator = WhereTranslator()
+        self.slow_queries = SlowQueryLog()
+        self.aggregations = TTLCache()
+        self.metrics = DataLayerMetrics()
         super(Elastic, self).__init__(app)
 
     def init_app(self, app):
@@ -225,9 +484,36 @@ class Elastic(DataLayer):
 
         app.config.setdefault('ELASTICSEARCH_FORCE_REFRESH', True)
         app.config.setdefault('ELASTICSEARCH_AUTO_AGGREGATIONS', True)
+        app.config.setdefault('ELASTICSEARCH_AGGREGATIONS_FIRST_PAGE', False)
+        app.config.setdefault('ELASTICSEARCH_AGGREGATIONS_CACHE_TTL', None)
+        app.config.setdefault('ELASTICSEARCH_SLOW_QUERY_THRESHOLD', None)
+        app.config.setdefault('ELASTICSEARCH_PROFILE', False)
+        app.config.setdefault('ELASTICSEARCH_BULK_MAX_RETRIES', 0)
+        app.config.setdefault('ELASTICSEARCH_METRICS_URL', None)
+        app.config.setdefault('ELASTICSEARCH_MAX_SIZE', None)
+        app.config.setdefault('ELASTICSEARCH_MAX_RESULT_WINDOW', None)
+        app.config.setdefault('ELASTICSEARCH_MAX_BUCKETS', None)
+        app.config.setdefault('ELASTICSEARCH_MAX_RESPONSE_BYTES', None)
+        app.config.setdefault('ELASTICSEARCH_TRACK_TOTAL_HITS', None)
+        app.config.setdefault('ELASTICSEARCH_LEGACY_FILTERS', False)
+        app.config.setdefault('ELASTICSEARCH_POOL_SIZE', None)
+        app.config.setdefault('ELASTICSEARCH_TIMEOUT', None)
+        app.config.setdefault('ELASTICSEARCH_KEEP_ALIVE', None)
+        app.config.setdefault('ELASTICSEARCH_BATCH_WINDOW', None)
+        app.config.setdefault('ELASTICSEARCH_REQUEST_CACHE', False)
+        app.config.setdefault('ELASTICSEARCH_MSEARCH_WINDOW', None)
+        app.config.setdefault('ELASTICSEARCH_MGET_CHUNK_SIZE', 1000)
+        app.config.setdefault('ELASTICSEARCH_MGET_CONCURRENCY', 4)
+
+        if app.config['ELASTICSEARCH_METRICS_URL']:
+            app.add_url_rule(app.config['ELASTICSEARCH_METRICS_URL'], 'elastic_metrics', self.metrics_view)
 
         self.app = app
-        self.es = get_es(app.config['ELASTICSEARCH_URL'], **self.kwargs)
+
+    @property
+    def es(self):
+        """Get ElasticSearch instance for default prefix."""
+        return self.elastic()
 
     def init_index(self, app=None):
         """Create indexes and put mapping."""
@@ -458,9 +744,120 @@ class Elastic(DataLayer):
         except elasticsearch.exceptions.NotFoundError:
             return alias
 
+    @instrumented
     def find(self, resource, req, sub_resource_lookup):
         """Find documents for resource."""
+        query, args = self._find_query(resource, req, sub_resource_lookup)
+        cache_key, aggregations = self._cached_aggregations(resource, query, args)
+        try:
+            hits = self._load_search(resource, query, args, page=req.page)
+        except (ResponseTooLarge, elasticsearch.exceptions.RequestError) as e:
+            hits = self._search_error(resource, e)
+        self._cache_aggregations(resource, cache_key, aggregations, hits)
+        return self._find_cursor(resource, req, query, hits)
+
+    def find_many(self, queries):
+        """Find documents for list of ``(resource, req, lookup)`` using single msearch per elastic prefix.
+
+        Search bodies are built same way as in :meth:`find`. Returns list with cursor for every query,
+        queries which failed get exception instead.
+        """
+        results, searches = self._find_searches(queries)
+        responses = self._msearch(list(searches.values()))
+        return self._find_results(queries, results, searches, responses)
+
+    def _find_searches(self, queries):
+        """Get list of results with exceptions for queries which can't be searched and dict of searches to run."""
+        results = [None] * len(queries)
+        searches = {}
+        for i, (resource, req, lookup) in enumerate(queries):
+            try:
+                query, args = self._find_query(resource, req, lookup)
+            except Exception as e:
+                results[i] = e
+            else:
+                searches[i] = SearchKey(resource, query, args, req.page)
+        return results, searches
+
+    def _find_results(self, queries, results, searches, responses):
+        """Fill results of :meth:`find_many` with cursors for search responses."""
+        for (i, search), hits in zip(searches.items(), responses):
+            try:
+                if isinstance(hits, (ResponseTooLarge, elasticsearch.exceptions.RequestError)):
+                    hits = self._search_error(search.resource, hits)
+                elif isinstance(hits, Exception):
+                    raise hits
+                results[i] = self._find_cursor(search.resource, queries[i][1], search.query, hits)
+            except Exception as e:
+                results[i] = e
+        return results
+
+    def _load_search(self, resource, query, args, page=None):
+        """Run search, batched with concurrent searches into msearch if ``MSEARCH_WINDOW`` is set."""
+        window = self._resource_config(resource, 'MSEARCH_WINDOW')
+        if window is None:
+            return self._search(resource, query, args, page)
+        return self.search_loader.load(SearchKey(resource, query, args, page), window)
+
+    def _msearch_batch(self, searches):
+        """Run searches collected by :attr:`search_loader`, returns dict of search and response."""
+        return dict(zip(searches, self._msearch(searches)))
+
+    def _msearch(self, searches):
+        """Run searches using single msearch per elastic prefix.
+
+        Searches of resources with ``max_response_bytes`` limit are sent separately,
+        so the limit applies to their response only.
+
+        Returns list of search responses, failed searches get exception instead.
+
+        :param searches: list of :class:`~eve_elastic.loader.SearchKey`
+        """
+        responses = [None] * len(searches)
+        for positions in self._group_searches(searches):
+            group = [searches[i] for i in positions]
+            try:
+                if self._resource_limit(group[0].resource, 'max_response_bytes') is not None:
+                    search = group[0]
+                    hits = [self._search(search.resource, search.query, search.args, search.page)]
+                else:
+                    reset_response_size()
+                    started = time.time()
+                    response = self.elastic(group[0].resource).msearch(body=get_msearch_body(group))
+                    hits = self._msearch_responses(group, response, time.time() - started)
+            except (elasticsearch.TransportError, ResponseTooLarge) as e:
+                hits = [e] * len(group)
+            for i, hit in zip(positions, hits):
+                responses[i] = hit
+        return responses
+
+    def _group_searches(self, searches):
+        """Get positions of searches grouped by elastic prefix, searches with response size limit are not grouped."""
+        groups = {}
+        for i, search in enumerate(searches):
+            if self._resource_limit(search.resource, 'max_response_bytes') is None:
+                groups.setdefault(self._resource_prefix(search.resource), []).append(i)
+            else:
+                groups[i] = [i]
+        return list(groups.values())
+
+    def _msearch_responses(self, searches, response, duration):
+        """Record searches of msearch response, returns responses with exceptions for failed searches.
+
+        Response size is split evenly between searches.
+        """
+        size = get_response_size() // len(searches)
+        responses = []
+        for search, hits in zip(searches, response.get('responses', [])):
+            if 'error' in hits:
+                responses.append(get_search_error(hits))
+            else:
+                self._record_search(search.resource, search.query, hits, duration, search.page, size)
+                responses.append(hits)
+        return responses
 
+    def _find_query(self, resource, req, sub_resource_lookup):
+        """Get search body and args for :meth:`find`, aborts if search exceeds resource limits."""
         args = getattr(req, 'args', request.args if request else {}) or {}
         source_config = config.SOURCES[resource]
 
@@ -511,14 +908,11 @@ class Elastic(DataLayer):
 
         if req.where:
             try:
-                filters.append({'term': json.loads(req.where)})
+                filters.append(self.where_translator(req.where))
             except ValueError:
-                try:
-                    filters.append({'term': parse(req.where)})
-                except ParseError:
-                    abort(400)
+                abort(400)
 
-        set_filters(query, must_filter, filters)
+        set_filters(query, must_filter, filters, legacy=self._resource_config(resource, 'LEGACY_FILTERS'))
 
         if 'facets' in source_config:
             query['facets'] = source_config['facets']
@@ -535,32 +929,140 @@ class Elastic(DataLayer):
                 query['highlight'] = highlights
                 query['highlight'].setdefault('require_field_match', False)
 
+        if self.should_profile(req):
+            query['profile'] = True
+
         source_projections = None
-        if self.should_project(req):
-            source_projections = self.get_projected_fields(req)
+        if self.should_count(req):
+            set_count_only(query)
+        else:
+            track_total_hits = self._resource_limit(resource, 'track_total_hits')
+            if track_total_hits is not None:
+                query.setdefault('track_total_hits', track_total_hits)
+            if self.should_project(req):
+                source_projections = self.get_projected_fields(req)
 
         args = self._es_args(resource, source_projections=source_projections)
+        self._check_query_limits(resource, query)
+        return query, args
 
-        try:
-            hits = self.elastic(resource).search(body=query, **args)
-        except elasticsearch.exceptions.RequestError as e:
-            if e.status_code == 400 and "No mapping found for" in e.error:
-                hits = {}
-            elif e.status_code == 400 and 'SearchParseException' in e.error:
-                raise InvalidSearchString
-            else:
-                raise
+    def _cached_aggregations(self, resource, query, args):
+        """Get cache key and cached aggregations for search if ``AGGREGATIONS_CACHE_TTL`` is set.
 
-        return self._parse_hits(hits, resource)
+        Aggregations are removed from search body when these are cached.
+        """
+        if 'aggs' not in query or not self._resource_config(resource, 'AGGREGATIONS_CACHE_TTL'):
+            return None, None
+        # hits paging and sorting don't change aggregations
+        key = get_search_key(args['index'], {'query': query.get('query'), 'aggs': query['aggs']})
+        aggregations = self.aggregations.get(key)
+        if aggregations is not None:
+            del query['aggs']
+        return key, aggregations
+
+    def _cache_aggregations(self, resource, key, aggregations, hits):
+        """Add cached aggregations to search response or store aggregations returned."""
+        if key is None or 'hits' not in hits:
+            return
+        if aggregations is not None:
+            hits['aggregations'] = deepcopy(aggregations)
+        elif 'aggregations' in hits:
+            self.aggregations.set(key, deepcopy(hits['aggregations']),
+                                  self._resource_config(resource, 'AGGREGATIONS_CACHE_TTL'))
+
+    def _search_error(self, resource, error):
+        """Get hits to return for failed search or raise."""
+        if isinstance(error, ResponseTooLarge):
+            self._reject(resource, 'max_response_bytes', str(error))
+        if error.status_code == 400 and "No mapping found for" in error.error:
+            return {}
+        elif error.status_code == 400 and 'SearchParseException' in error.error:
+            raise InvalidSearchString
+        raise error
+
+    def _find_cursor(self, resource, req, query, hits):
+        """Check buckets limit and parse search response for :meth:`find`."""
+        max_buckets = self._resource_limit(resource, 'max_buckets')
+        if max_buckets is not None and 'aggregations' in hits and count_buckets(hits['aggregations']) > max_buckets:
+            self._reject(resource, 'max_buckets', 'aggregations returned more than %d buckets' % max_buckets)
+
+        cursor = self._parse_hits(hits, resource)
+        if self.should_profile(req):
+            cursor.query = query
+        return cursor
+
+    def _search(self, resource, query, args, page=None):
+        """Run search and log it if it's slow."""
+        reset_response_size()
+        started = time.time()
+        with max_response_bytes(self._resource_limit(resource, 'max_response_bytes')):
+            hits = self.elastic(resource).search(body=query, **args)
+        self._record_search(resource, query, hits, time.time() - started, page)
+        return hits
+
+    def _record_search(self, resource, query, hits, duration, page=None, size=None):
+        """Record search metrics and log it if it's slow."""
+        threshold = self._slow_query_threshold(resource)
+        if threshold is not None and duration >= threshold:
+            self.slow_queries.record(resource, query, duration, took=hits.get('took'), page=page)
+        if size is None:
+            size = get_response_size()
+        self.metrics.searches.inc(resource=resource)
+        self.metrics.hits.inc(len(hits.get('hits', {}).get('hits', [])), resource=resource)
+        self.metrics.response_bytes.inc(size, resource=resource)
+        self.metrics.max_response_bytes.set_max(size, resource=resource)
+
+    def _resource_limit(self, resource, key):
+        """Get search limit for resource.
+
+        It can be set per resource via ``key`` in datasource, otherwise it's taken
+        from config using uppercase ``key``, eg. ``ELASTICSEARCH_MAX_SIZE``.
+        """
+        return config.SOURCES[resource].get(key, self._resource_config(resource, key.upper()))
+
+    def _check_query_limits(self, resource, query):
+        """Reject search which could return more than resource limits allow."""
+        size = int(query.get('size', 10))
+        max_size = self._resource_limit(resource, 'max_size')
+        if max_size is not None and size > max_size:
+            self._reject(resource, 'max_size', 'size %d exceeds limit %d' % (size, max_size))
+
+        window = int(query.get('from', 0)) + size
+        max_window = self._resource_limit(resource, 'max_result_window')
+        if max_window is not None and window > max_window:
+            self._reject(resource, 'max_result_window', 'from + size %d exceeds limit %d' % (window, max_window))
+
+        max_buckets = self._resource_limit(resource, 'max_buckets')
+        if max_buckets is not None:
+            buckets = get_bucket_count(query.get('aggs', query.get('aggregations')))
+            if buckets > max_buckets:
+                self._reject(resource, 'max_buckets', 'aggregations request %d buckets, limit is %d' % (
+                    buckets, max_buckets))
+
+    def _reject(self, resource, limit, message):
+        """Abort request which exceeds given limit."""
+        logger.warning('search rejected resource=%s limit=%s: %s', resource, limit, message)
+        self.metrics.limit_rejections.inc(resource=resource, limit=limit)
+        abort(400, description=message)
+
+    def _slow_query_threshold(self, resource):
+        """Get slow query threshold in seconds for resource.
+
+        It can be set per resource via ``slow_query_threshold`` in datasource.
+        """
+        return config.SOURCES[resource].get('slow_query_threshold',
+                                            self._resource_config(resource, 'SLOW_QUERY_THRESHOLD'))
 
     def should_aggregate(self, req):
         """Check the environment variable and the given argument parameter to decide if aggregations needed.
 
-        argument value is expected to be '0' or '1'
+        argument value is expected to be '0' or '1', with ``ELASTICSEARCH_AGGREGATIONS_FIRST_PAGE``
+        aggregations are added automatically only for the first page
         """
         try:
-            return self.app.config.get('ELASTICSEARCH_AUTO_AGGREGATIONS') or \
-                   bool(req.args and int(req.args.get('aggregations')))
+            first_page_only = self.app.config.get('ELASTICSEARCH_AGGREGATIONS_FIRST_PAGE')
+            auto = self.app.config.get('ELASTICSEARCH_AUTO_AGGREGATIONS') and not (first_page_only and req.page > 1)
+            return auto or bool(req.args and int(req.args.get('aggregations')))
         except Exception:
             return False
 
@@ -574,6 +1076,28 @@ class Elastic(DataLayer):
         except Exception:
             return False
 
+    def should_count(self, req):
+        """Check the given argument parameter to decide if only hits total is needed.
+
+        argument value is expected to be '0' or '1'
+        """
+        try:
+            return bool(req.args and int(req.args.get('count', 0)))
+        except Exception:
+            return False
+
+    def should_profile(self, req):
+        """Check the config and the given argument parameter to decide if search should be profiled.
+
+        argument value is expected to be '0' or '1', it's ignored unless ``ELASTICSEARCH_PROFILE`` is enabled
+        """
+        try:
+            if not self.app.config.get('ELASTICSEARCH_PROFILE'):
+                return False
+            return bool(req.args and int(req.args.get('profile', 0)))
+        except Exception:
+            return False
+
     def should_project(self, req):
         """Check the given argument parameter to decide if projections needed.
 
@@ -593,16 +1117,15 @@ class Elastic(DataLayer):
         except Exception:
             return None
 
+    @instrumented
     def find_one(self, resource, req, **lookup):
         """Find single document, if there is _id in lookup use that, otherwise filter."""
 
         if config.ID_FIELD in lookup:
-            return self._find_by_id(resource=resource, _id=lookup[config.ID_FIELD], parent=lookup.get('parent'))
+            return self._load_by_id(resource=resource, _id=lookup[config.ID_FIELD], parent=lookup.get('parent'))
         else:
             args = self._es_args(resource)
-
-            filters = [{'term': {key: val}} for key, val in lookup.items()]
-            query = {'query': {'bool': {'filter': filters}}}
+            query = get_lookup_query(lookup)
 
             try:
                 args['size'] = 1
@@ -617,11 +1140,6 @@ class Elastic(DataLayer):
 
         If parent is not provided then on routing exception try to find using search.
         """
-        def is_found(hit):
-            if 'exists' in hit:
-                hit['found'] = hit['exists']
-            return hit.get('found', False)
-
         args = self._es_args(resource)
         try:
             # set the parent if available
@@ -639,7 +1157,7 @@ class Elastic(DataLayer):
         except elasticsearch.NotFoundError:
             return
         except elasticsearch.TransportError as tex:
-            if tex.error == 'routing_missing_exception' or 'RoutingMissingException' in tex.error:
+            if is_routing_missing(tex):
                 # search for the item
                 args = self._es_args(resource)
                 query = {'query': {'bool': {'must': [{'term': {'_id': _id}}]}}}
@@ -651,19 +1169,147 @@ class Elastic(DataLayer):
                 except elasticsearch.NotFoundError:
                     return
 
+    @instrumented
     def find_one_raw(self, resource, _id):
         """Find document by id."""
-        return self._find_by_id(resource=resource, _id=_id)
+        return self._load_by_id(resource=resource, _id=_id)
+
+    def _load_by_id(self, resource, _id, parent=None):
+        """Find the document by Id.
+
+        It's taken from identity map of current request if ``REQUEST_CACHE`` is enabled
+        and batched with concurrent lookups if ``BATCH_WINDOW`` is set.
+        """
+        cached = self._cached_docs(resource, [_id])
+        if _id in cached:
+            return cached[_id]
+        window = self._resource_config(resource, 'BATCH_WINDOW')
+        if window is None:
+            doc = self._find_by_id(resource=resource, _id=_id, parent=parent)
+        else:
+            doc = self.id_loader.load((resource, _id, parent), window)
+        self._cache_docs(resource, {_id: doc})
+        return doc
 
+    def _find_by_ids(self, keys):
+        """Find documents for ``(resource, _id, parent)`` keys using single mget per resource.
+
+        Docs requiring routing which was not provided are searched via :meth:`_find_by_id`.
+        """
+        docs = {}
+        for resource, resource_keys in group_keys(keys).items():
+            try:
+                response = self.elastic(resource).mget(body=get_mget_body(resource_keys), **self._es_args(resource))
+            except elasticsearch.NotFoundError:
+                continue
+            found = []
+            for key, hit in zip(resource_keys, response.get('docs', [])):
+                if is_routing_missing_hit(hit):
+                    docs[key] = self._find_by_id(*key)
+                elif is_found(hit):
+                    found.append((key, hit))
+            docs.update(self._parse_found(resource, found))
+        return docs
+
+    def _parse_found(self, resource, found):
+        """Parse list of key and hit pairs into key and document pairs."""
+        cursor = self._parse_hits({'hits': {'hits': [hit for _key, hit in found]}}, resource)
+        return zip([key for key, _hit in found], cursor.docs)
+
+    @instrumented
     def find_list_of_ids(self, resource, ids, client_projection=None):
-        """Find documents by ids."""
-        args = self._es_args(resource)
-        return self._parse_hits(self.elastic(resource).mget(body={'ids': ids}, **args), resource)
+        """Find documents by ids in order of ids, docs not found are skipped.
+
+        :param client_projection: eve projection, eg. ``{'headline': 1}``
+        """
+        return get_docs_cursor(list(self.iter_list_of_ids(resource, ids, client_projection)))
 
+    def iter_list_of_ids(self, resource, ids, client_projection=None):
+        """Find documents by ids, yields them in order of ids as chunks of ids are fetched.
+
+        Ids are fetched using ``mget`` in chunks of ``MGET_CHUNK_SIZE`` ids,
+        up to ``MGET_CONCURRENCY`` chunks are fetched in parallel.
+        """
+        # projected docs are not complete so these are not taken from or stored in identity map
+        docs = {} if client_projection else self._cached_docs(resource, ids)
+        chunks = self._mget_chunks(resource, [_id for _id in unique(ids) if _id not in docs], client_projection)
+        for _id in ids:
+            while _id not in docs:
+                fetched = next(chunks)
+                if not client_projection:
+                    self._cache_docs(resource, fetched)
+                docs.update(fetched)
+            if docs[_id] is not None:
+                yield docs[_id]
+
+    def _mget_chunks(self, resource, ids, client_projection=None):
+        """Fetch ids using mget per chunk, yields dict of id and document for every chunk in order."""
+        es, args, chunks = self._mget_args(resource, ids, client_projection)
+
+        def fetch(chunk):
+            return es.mget(body={'ids': chunk}, **args)
+
+        concurrency = min(self._resource_config(resource, 'MGET_CONCURRENCY') or 1, len(chunks))
+        if concurrency > 1:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                # run workers in context of current operation and request
+                futures = [executor.submit(copy_context().run, fetch, chunk) for chunk in chunks]
+                for chunk, future in zip(chunks, futures):
+                    yield self._parse_mget(resource, chunk, future.result())
+        else:
+            for chunk in chunks:
+                yield self._parse_mget(resource, chunk, fetch(chunk))
+
+    def _mget_args(self, resource, ids, client_projection=None):
+        """Get client, args and list of id chunks for fetching ids."""
+        args = self._es_args(resource)
+        args.update(get_source_params(client_projection))
+        size = self._resource_config(resource, 'MGET_CHUNK_SIZE') or len(ids) or 1
+        return self.elastic(resource), args, [ids[i:i + size] for i in range(0, len(ids), size)]
+
+    def _parse_mget(self, resource, ids, response):
+        """Get dict of id and document from mget response, ``None`` for docs not found."""
+        docs = dict.fromkeys(ids)
+        docs.update(self._parse_found(resource, [(_id, hit) for _id, hit in zip(ids, response.get('docs', []))
+                                                 if is_found(hit)]))
+        return docs
+
+    def _identity_map(self, resource):
+        """Get identity map of current request, ``None`` outside of request or if ``REQUEST_CACHE`` is off."""
+        if self._resource_config(resource, 'REQUEST_CACHE'):
+            return get_identity_map()
+
+    def _cached_docs(self, resource, ids):
+        """Get dict of id and document for ids in identity map of current request."""
+        identity_map = self._identity_map(resource)
+        if identity_map is None:
+            return {}
+        index = self._resource_index(resource)
+        docs = {_id: identity_map.get(index, resource, _id) for _id in ids}
+        return {_id: doc for _id, doc in docs.items() if doc is not MISSING}
+
+    def _cache_docs(self, resource, docs):
+        """Store dict of id and document in identity map of current request."""
+        identity_map = self._identity_map(resource)
+        if identity_map is not None:
+            index = self._resource_index(resource)
+            for _id, doc in docs.items():
+                identity_map.set(index, resource, _id, doc)
+
+    def _invalidate_docs(self, resource, ids=None):
+        """Remove docs about to be written from identity map of current request, all docs of index if no ids."""
+        identity_map = get_identity_map(create=False)
+        if identity_map is not None:
+            index = self._resource_index(resource)
+            for _id in ids if ids is not None else [None]:
+                identity_map.invalidate(index, _id)
+
+    @instrumented
     def insert(self, resource, doc_or_docs, **kwargs):
         """Insert document, it must be new if there is ``_id`` in it."""
         ids = []
         kwargs.update(self._es_args(resource))
+        self._invalidate_docs(resource, [doc['_id'] for doc in doc_or_docs if doc.get('_id')])
 
         for doc in doc_or_docs:
             self._update_parent_join_args(kwargs, doc)
@@ -671,9 +1317,11 @@ class Elastic(DataLayer):
             res = self.elastic(resource).index(body=doc, id=_id, **kwargs)
             doc.setdefault('_id', res.get('_id', _id))
             ids.append(doc.get('_id'))
+        self.metrics.docs_indexed.inc(len(ids), resource=resource)
         self._refresh_resource_index(resource)
         return ids
 
+    @instrumented
     def bulk_insert(self, resource, docs, **kwargs):
         """Bulk insert documents.
 
@@ -682,31 +1330,73 @@ class Elastic(DataLayer):
         the same shard.
         """
 
-        kwargs.update(self._es_args(resource))
+        raise_on_error = self._bulk_kwargs(resource, kwargs)
+        client = BulkClient(self.elastic(resource))
+        self._invalidate_docs(resource)
 
         # if a join field exists a routing has to be added, see test_bulk_insert for example
-        res = bulk(self.elastic(resource), docs, stats_only=False, **kwargs)
+        try:
+            success, errors = bulk(client, docs, stats_only=False, **kwargs)
+        except BulkIndexError as e:
+            self.metrics.docs_failed.inc(len(e.errors), resource=resource)
+            raise
+        self._bulk_result(resource, success, errors, client.items, raise_on_error)
         self._refresh_resource_index(resource)
-        return res
+        return success, errors
 
+    def _bulk_kwargs(self, resource, kwargs):
+        """Update bulk kwargs for resource, returns if errors should be raised."""
+        kwargs.update(self._es_args(resource))
+        kwargs.setdefault('max_retries', self._resource_config(resource, 'BULK_MAX_RETRIES', 0))
+
+        # rejected docs are only retried when errors are not raised per chunk
+        raise_on_error = kwargs.get('raise_on_error', True)
+        if kwargs['max_retries']:
+            kwargs['raise_on_error'] = False
+        return raise_on_error
+
+    def _bulk_result(self, resource, success, errors, items, raise_on_error):
+        """Record bulk metrics, ``items`` is number of items in all bulk responses."""
+        self.metrics.docs_indexed.inc(success, resource=resource)
+        self.metrics.docs_failed.inc(len(errors), resource=resource)
+        self.metrics.docs_retried.inc(items - success - len(errors), resource=resource)
+        if errors and raise_on_error:
+            raise BulkIndexError('%i document(s) failed to index.' % len(errors), errors)
+
+    @instrumented
     def update(self, resource, id_, updates, original=None):
         """Update document in index."""
-        args = self._es_args(resource, refresh=True)
-        if self._get_retry_on_conflict():
-            args['retry_on_conflict'] = self._get_retry_on_conflict()
-        updates.pop('_id', None)
-        updates.pop('_type', None)
-        self._update_parent_join_args(args, updates)
-        return self.elastic(resource).update(id=id_, body={'doc': updates}, **args)
+        args = self._update_args(resource, updates)
+        self._invalidate_docs(resource, [id_])
+        res = self.elastic(resource).update(id=id_, body={'doc': updates}, **args)
+        self.metrics.docs_indexed.inc(resource=resource)
+        return res
 
+    @instrumented
     def replace(self, resource, id_, document):
         """Replace document in index."""
+        args = self._doc_args(resource, document)
+        self._invalidate_docs(resource, [id_])
+        res = self.elastic(resource).index(body=document, id=id_, **args)
+        self.metrics.docs_indexed.inc(resource=resource)
+        return res
+
+    def _update_args(self, resource, updates):
+        """Get args for update, removes metadata from ``updates``."""
+        args = self._doc_args(resource, updates)
+        if self._get_retry_on_conflict():
+            args['retry_on_conflict'] = self._get_retry_on_conflict()
+        return args
+
+    def _doc_args(self, resource, document):
+        """Get args for indexing document, removes metadata from ``document``."""
         args = self._es_args(resource, refresh=True)
         document.pop('_id', None)
         document.pop('_type', None)
         self._update_parent_join_args(args, document)
-        return self.elastic(resource).index(body=document, id=id_, **args)
+        return args
 
+    @instrumented
     def remove(self, resource, lookup=None, parent=None, **kwargs):
         """Remove docs for resource.
 
@@ -719,12 +1409,14 @@ class Elastic(DataLayer):
             kwargs['parent'] = parent
         if lookup:
             if lookup.get('_id'):
+                self._invalidate_docs(resource, [lookup['_id']])
                 try:
                     return self.elastic(resource).delete(id=lookup.get('_id'), refresh=True, **kwargs)
                 except elasticsearch.NotFoundError:
                     return
         return ValueError('there must be `lookup._id` specified')
 
+    @instrumented
     def is_empty(self, resource):
         """Test if there is no document for resource.
 
@@ -732,7 +1424,8 @@ class Elastic(DataLayer):
         """
         resource = self._get_index_prefix(resource)
         args = self._es_args(resource)
-        res = self.elastic(resource).count(body={'query': {'match_all': {}}}, **args)
+        # shards stop counting after first match
+        res = self.elastic(resource).count(body={'query': {'match_all': {}}}, terminate_after=1, **args)
         return res.get('count', 0) == 0
 
     def put_settings(self, app=None, index=None, settings=None, es=None):
@@ -756,16 +1449,32 @@ class Elastic(DataLayer):
         es.indices.put_settings(index=index, body=settings)
         es.indices.open(index=index)
 
-    def _parse_hits(self, hits, resource):
-        """Parse hits response into documents."""
+    def _get_schema(self, resource):
+        """Get schema for given resource merged with schema of its source resource."""
         datasource = self.get_datasource(resource)
         schema = {}
         schema.update(config.DOMAIN[datasource[0]].get('schema', {}))
         schema.update(config.DOMAIN[resource].get('schema', {}))
-        dates = get_dates(schema)
+        return schema
+
+    def _get_transform(self, resource):
+        """Get document transform compiled for resource schema."""
+        if resource not in self.transforms:
+            schema = {
+                config.DATE_CREATED: {'type': 'datetime'},
+                config.LAST_UPDATED: {'type': 'datetime'},
+            }
+            schema.update(self._get_schema(resource))
+            serializers = dict(self.serializers, datetime=self.date_parser)
+            self.transforms[resource] = compile_transform(schema, serializers) or (lambda doc: doc)
+        return self.transforms[resource]
+
+    def _parse_hits(self, hits, resource):
+        """Parse hits response into documents."""
+        transform = self._get_transform(resource)
         docs = []
         for hit in hits.get('hits', {}).get('hits', []):
-            docs.append(format_doc(hit, schema, dates))
+            docs.append(format_doc(hit, None, None, transform))
         return ElasticCursor(hits, docs)
 
     def _es_args(self, resource, refresh=None, source_projections=None):
@@ -835,6 +1544,7 @@ class Elastic(DataLayer):
         """
         if self._resource_config(resource, 'FORCE_REFRESH', True):
             self.elastic(resource).indices.refresh(self._resource_index(resource))
+            self.metrics.refreshes.inc(resource=resource)
 
     def _resource_prefix(self, resource=None):
         """Get elastic prefix for given resource.
@@ -842,7 +1552,7 @@ class Elastic(DataLayer):
         Resource can specify ``elastic_prefix`` which behaves same like ``mongo_prefix``.
         """
         px = 'ELASTICSEARCH'
-        if self.app.config['ELASTICSEARCH_INDEX_PREFIX']:
+        if resource and self.app.config['ELASTICSEARCH_INDEX_PREFIX']:
             resource = resource.replace(self.app.config['ELASTICSEARCH_INDEX_PREFIX'],'')
         if resource and config.DOMAIN[resource].get('elastic_prefix'):
             px = config.DOMAIN[resource].get('elastic_prefix')
@@ -871,21 +1581,134 @@ class Elastic(DataLayer):
 
 
     def elastic(self, resource=None):
-        """Get ElasticSearch instance for given resource."""
-        px = self._resource_prefix(resource)
+        """Get ElasticSearch instance for given resource.
 
-        if px not in self.elastics:
+        Prefixes with same url and client options share connections.
+        """
+        px = self._resource_prefix(resource)
+        es = self.clients.get(px)
+        if es is None:
             url = self._resource_config(resource, 'URL')
             assert url, 'no url for %s' % px
-            self.elastics[px] = get_es(url, **self.kwargs)
-
-        return self.elastics[px]
+            es = self.clients.create(px, url, **self._client_options(resource))
+            if isinstance(es.transport, ElasticTransport):
+                es.transport.metrics = self.metrics
+                es.transport.prefix = px
+        return es
+
+    def _client_options(self, resource=None):
+        """Get client options for resource prefix, config set via :data:`CLIENT_OPTIONS` overrides kwargs."""
+        options = dict(self.kwargs)
+        for key, option in CLIENT_OPTIONS:
+            value = self._resource_config(resource, key)
+            if value is not None:
+                options[option] = value
+        return options
+
+    def _create_client(self, url, **options):
+        """Create client for given url."""
+        return get_es(url, **options)
+
+    def metrics_view(self):
+        """Render metrics, served on ``ELASTICSEARCH_METRICS_URL`` if set."""
+        return get_metrics_view(self.metrics.registry)()
 
     def _get_retry_on_conflict(self):
         """Get the retry on settings."""
         return self.app.config.get('ELASTICSEARCH_RETRY_ON_CONFLICT', 5)
 
 
+def get_lookup_query(lookup):
+    """Get query filtering docs by all lookup terms."""
+    filters = [{'term': {key: val}} for key, val in lookup.items()]
+    return {'query': {'bool': {'filter': filters}}}
+
+
+def is_found(hit):
+    """Test if document was found by get or mget."""
+    if 'exists' in hit:
+        hit['found'] = hit['exists']
+    return hit.get('found', False)
+
+
+def is_routing_missing(error):
+    """Test if request failed because it requires routing."""
+    return error.error == 'routing_missing_exception' or 'RoutingMissingException' in error.error
+
+
+def get_docs_cursor(docs):
+    """Get cursor for list of docs not coming from search."""
+    return ElasticCursor({'hits': {'total': len(docs), 'hits': []}}, docs)
+
+
+def unique(values):
+    """Get list of values without duplicates keeping their order."""
+    return list(OrderedDict.fromkeys(values))
+
+
+def get_source_params(projection):
+    """Get ``_source_include`` and ``_source_exclude`` params for eve projection."""
+    params = {}
+    if projection:
+        includes = [field for field, value in projection.items() if value]
+        excludes = [field for field, value in projection.items() if not value]
+        if includes:
+            params['_source_include'] = ','.join(includes)
+        if excludes:
+            params['_source_exclude'] = ','.join(excludes)
+    return params
+
+
+def get_msearch_body(searches):
+    """Get msearch body for list of :class:`~eve_elastic.loader.SearchKey`."""
+    body = []
+    for search in searches:
+        body.append({'index': search.args['index'], 'type': search.args['doc_type']})
+        if search.args.get('_source'):
+            body.append(dict(search.query, _source=search.args['_source'].split(',')))
+        else:
+            body.append(search.query)
+    return body
+
+
+def get_search_error(response):
+    """Get exception for failed search in msearch response."""
+    status = response.get('status', 500)
+    error = response['error']
+    if isinstance(error, dict):
+        reasons = [error.get('reason')] + [cause.get('reason') for cause in error.get('root_cause') or []]
+        reasons = [reason for reason in unique(reasons) if reason]
+        error = '%s: %s' % (error.get('type'), '; '.join(reasons)) if reasons else error.get('type', error)
+    return elasticsearch.exceptions.HTTP_EXCEPTIONS.get(status, elasticsearch.TransportError)(status, error, response)
+
+
+def group_keys(keys):
+    """Group ``(resource, _id, parent)`` keys by resource."""
+    groups = {}
+    for key in keys:
+        groups.setdefault(key[0], []).append(key)
+    return groups
+
+
+def get_mget_body(keys):
+    """Get mget body for ``(resource, _id, parent)`` keys of single resource."""
+    docs = []
+    for _resource, _id, parent in keys:
+        doc = {'_id': _id}
+        if parent:
+            doc['parent'] = parent
+        docs.append(doc)
+    return {'docs': docs}
+
+
+def is_routing_missing_hit(hit):
+    """Test if mget failed to get doc because it requires routing."""
+    error = hit.get('error')
+    if isinstance(error, dict):
+        error = error.get('type')
+    return bool(error) and ('routing_missing_exception' in error or 'RoutingMissingException' in error)
+
+
 def build_elastic_query(doc):
     """Build a query which follows ElasticSearch syntax from doc.
 
@@ -968,4 +1791,4 @@ def _build_query_string(q, default_field=None, default_operator='AND'):
 
 
 def _build_lookup_filter(lookup):
-    return [{'term': {key: val}} for key, val in lookup.items()]
+    return [{'terms': {key: val}} if isinstance(val, list) else {'term': {key: val}} for key, val in lookup.items()]
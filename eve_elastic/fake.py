@@ -0,0 +1,768 @@
+"""In-process fake elasticsearch for load testing and CI without a cluster.
+
+It implements a subset of elasticsearch api used by :class:`~eve_elastic.elastic.Elastic`
+(index, get, mget, search, scroll, count, bulk, update, delete and index management)
+with basic query dsl support - ``bool``, ``term``, ``terms``, ``range``, ``exists``,
+``ids``, ``regexp``, ``match``, ``match_phrase`` and ``query_string``. Searches can be
+sliced, search body keys it doesn't implement are rejected.
+
+Use ``fake://`` url to plug it in::
+
+    app.config['ELASTICSEARCH_URL'] = 'fake://localhost:9200'
+
+Clients using same host and port share the data. Latency and failures can be injected
+to test throughput and retry behavior::
+
+    cluster = get_cluster('localhost', 9200)
+    cluster.latency = 0.005
+    cluster.fail_next(2, status=429)
+"""
+
+import re
+import json
+import time
+import zlib
+import asyncio
+import random
+import socket
+import threading
+
+from copy import deepcopy
+from uuid import uuid4
+from urllib.parse import unquote
+
+from elasticsearch import Connection
+from elasticsearch.exceptions import ConnectionTimeout
+
+
+#: fake cluster version
+VERSION = '6.4.0'
+
+ENDPOINTS = frozenset([
+    '_search', '_count', '_bulk', '_mget', '_msearch', '_mapping', '_settings', '_alias', '_aliases',
+    '_refresh', '_open', '_close', '_update', '_create',
+])
+
+_clusters = {}
+_clusters_lock = threading.Lock()
+
+
+def get_cluster(host='localhost', port=9200):
+    """Get fake cluster for given host and port."""
+    key = '%s:%s' % (host, port)
+    with _clusters_lock:
+        if key not in _clusters:
+            _clusters[key] = FakeCluster()
+        return _clusters[key]
+
+
+def reset_clusters():
+    """Remove all fake clusters and their data."""
+    with _clusters_lock:
+        _clusters.clear()
+
+
+class FakeError(Exception):
+    """Error response with http status."""
+
+    def __init__(self, status, error_type, reason=''):
+        super(FakeError, self).__init__(status, error_type, reason)
+        self.status = status
+        self.body = {'error': {'type': error_type, 'reason': reason, 'root_cause': [{'type': error_type}]},
+                     'status': status}
+
+
+class UnsupportedQuery(FakeError):
+
+    def __init__(self, query):
+        super(UnsupportedQuery, self).__init__(400, 'parsing_exception', 'unsupported query %s' % query)
+
+
+#: search body keys fake cluster handles, ``highlight`` and ``facets`` are ignored
+SEARCH_BODY_KEYS = {'query', 'size', 'from', 'sort', '_source', 'aggs', 'aggregations', 'track_total_hits',
+                    'profile', 'highlight', 'facets', 'slice', 'timeout'}
+
+
+def get_value(source, field):
+    """Get list of values for dotted field path, lists are flattened."""
+    values = [source]
+    for key in field.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, dict) and key in value:
+                value = value[key]
+                next_values.extend(value if isinstance(value, list) else [value])
+        values = next_values
+    return [value for value in values if value is not None]
+
+
+def get_tokens(value):
+    """Split text into lowercase tokens."""
+    return re.findall(r'\w+', value.lower(), re.UNICODE)
+
+
+def get_strings(source):
+    """Get all string values from doc."""
+    if isinstance(source, dict):
+        for value in source.values():
+            for string in get_strings(value):
+                yield string
+    elif isinstance(source, list):
+        for value in source:
+            for string in get_strings(value):
+                yield string
+    elif isinstance(source, str):
+        yield source
+
+
+def term_matches(values, term):
+    for value in values:
+        if value == term:
+            return True
+        if isinstance(value, str) and isinstance(term, str) and term.lower() in get_tokens(value):
+            return True
+        if isinstance(value, bool) and str(value).lower() == str(term).lower():
+            return True
+    return False
+
+
+def text_matches(values, text, operator='or'):
+    tokens = set()
+    for value in values:
+        if isinstance(value, str):
+            tokens.update(get_tokens(value))
+        else:
+            tokens.add(str(value).lower())
+    wanted = [token.strip('*') for token in get_tokens(text) if token.strip('*')]
+    if not wanted:
+        return True
+    found = [any(t.startswith(token) if text.endswith('*') else t == token for t in tokens) for token in wanted]
+    return all(found) if operator.lower() == 'and' else any(found)
+
+
+def get_text_values(doc, field=None):
+    if not field or field in ('all', '_all', '*'):
+        return list(get_strings(doc['_source']))
+    return get_value(doc['_source'], field)
+
+
+def range_matches(values, conditions):
+    ops = {
+        'gt': lambda a, b: a > b,
+        'gte': lambda a, b: a >= b,
+        'lt': lambda a, b: a < b,
+        'lte': lambda a, b: a <= b,
+    }
+    for value in values:
+        try:
+            if all(ops[op](value, bound) for op, bound in conditions.items() if op in ops):
+                return True
+        except TypeError:
+            continue
+    return False
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def matches(doc, query):
+    """Test if doc matches given query."""
+    if not query:
+        return True
+    if len(query) != 1:
+        raise UnsupportedQuery(query)
+
+    query_type, params = next(iter(query.items()))
+    source = doc['_source']
+
+    if query_type == 'match_all':
+        return True
+    elif query_type == 'match_none':
+        return False
+    elif query_type == 'bool':
+        must = as_list(params.get('must')) + as_list(params.get('filter'))
+        should = as_list(params.get('should'))
+        if not all(matches(doc, clause) for clause in must):
+            return False
+        if any(matches(doc, clause) for clause in as_list(params.get('must_not'))):
+            return False
+        if should:
+            minimum = params.get('minimum_should_match', 0 if must else 1)
+            return sum(1 for clause in should if matches(doc, clause)) >= int(minimum)
+        return True
+    elif query_type == 'constant_score':
+        return matches(doc, params.get('filter'))
+    elif query_type == 'term':
+        field, value = next(iter(params.items()))
+        if isinstance(value, dict):
+            value = value.get('value')
+        if field == '_id':
+            return doc['_id'] == value
+        return term_matches(get_value(source, field), value)
+    elif query_type == 'terms':
+        field, values = next(iter(params.items()))
+        if field == '_id':
+            return doc['_id'] in values
+        return any(term_matches(get_value(source, field), value) for value in values)
+    elif query_type == 'ids':
+        return doc['_id'] in params.get('values', [])
+    elif query_type == 'regexp':
+        field, value = next(iter(params.items()))
+        if isinstance(value, dict):
+            value = value.get('value')
+        pattern = re.compile(value)
+        values = [doc['_id']] if field == '_id' else get_value(source, field)
+        return any(isinstance(v, str) and pattern.fullmatch(v) for v in values)
+    elif query_type == 'exists':
+        return bool(get_value(source, params['field']))
+    elif query_type == 'range':
+        field, conditions = next(iter(params.items()))
+        return range_matches(get_value(source, field), conditions)
+    elif query_type in ('match', 'match_phrase'):
+        field, value = next(iter(params.items()))
+        operator = 'or'
+        if isinstance(value, dict):
+            operator = value.get('operator', operator)
+            value = value.get('query')
+        values = get_text_values(doc, field)
+        if query_type == 'match_phrase':
+            phrase = ' '.join(get_tokens(str(value)))
+            return any(phrase in ' '.join(get_tokens(v)) for v in values if isinstance(v, str))
+        return text_matches(values, str(value), operator)
+    elif query_type == 'query_string':
+        text = params.get('query', '*')
+        if text.strip() in ('', '*'):
+            return True
+        values = get_text_values(doc, params.get('default_field'))
+        return text_matches(values, text, params.get('default_operator', 'or'))
+    raise UnsupportedQuery(query_type)
+
+
+def get_sort_key(doc, field):
+    if field == '_id':
+        return [doc['_id']]
+    return get_value(doc['_source'], field)
+
+
+def sort_docs(docs, sort):
+    """Sort docs in place using elastic sort definition."""
+    for spec in reversed(as_list(sort)):
+        if isinstance(spec, str):
+            field, order = spec, 'asc'
+        else:
+            field, order = next(iter(spec.items()))
+            if isinstance(order, dict):
+                order = order.get('order', 'asc')
+        if field in ('_doc', '_score', '_shard_doc'):
+            continue
+        reverse = order == 'desc'
+        present = [doc for doc in docs if get_sort_key(doc, field)]
+        missing = [doc for doc in docs if not get_sort_key(doc, field)]
+        present.sort(key=lambda doc: min(get_sort_key(doc, field)), reverse=reverse)
+        docs[:] = present + missing
+
+
+def filter_source(source, includes):
+    if not includes:
+        return source
+    filtered = {}
+    for field in includes:
+        if field in source:
+            filtered[field] = source[field]
+    return filtered
+
+
+def aggregate(docs, aggs):
+    """Compute ``terms`` aggregations, other types return empty buckets."""
+    result = {}
+    for name, agg in (aggs or {}).items():
+        if 'terms' in agg:
+            counts = {}
+            for doc in docs:
+                for value in set(str(v) if isinstance(v, bool) else v
+                                 for v in get_value(doc['_source'], agg['terms']['field'])):
+                    counts[value] = counts.get(value, 0) + 1
+            buckets = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))
+            size = agg['terms'].get('size', 10)
+            result[name] = {
+                'doc_count_error_upper_bound': 0,
+                'sum_other_doc_count': sum(count for key, count in buckets[size:]),
+                'buckets': [{'key': key, 'doc_count': count} for key, count in buckets[:size]],
+            }
+        else:
+            result[name] = {'buckets': []}
+    return result
+
+
+class FakeIndex(object):
+
+    def __init__(self, name, mappings=None, settings=None):
+        self.name = name
+        self.docs = {}
+        self.mappings = mappings or {}
+        self.settings = settings or {}
+        self.aliases = set()
+        self.closed = False
+
+
+class FakeCluster(object):
+    """In-memory cluster state and request handlers.
+
+    :param latency: seconds added to every request, or tuple of min and max
+    :param failure_rate: probability of failing request with ``failure_status``
+    :param failure_status: http status of injected failures, ``429`` by default
+    :param timeout_rate: probability of request timing out
+    """
+
+    def __init__(self, latency=0, failure_rate=0, failure_status=429, timeout_rate=0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.timeout_rate = timeout_rate
+        self.random = random.Random(seed)
+        self.indices = {}
+        self.scrolls = {}
+        self.requests = 0
+        self.failures = []
+        self.rejections = 0
+        self.lock = threading.RLock()
+
+    def fail_next(self, count=1, status=429, timeout=False):
+        """Make next ``count`` requests fail with given status or timeout."""
+        with self.lock:
+            self.failures.extend([None if timeout else status] * count)
+
+    def reject_next_items(self, count=1):
+        """Make next ``count`` bulk items fail with ``429`` status."""
+        with self.lock:
+            self.rejections += count
+
+    def reset(self):
+        """Remove all indices and injected failures."""
+        with self.lock:
+            self.indices.clear()
+            self.scrolls.clear()
+            self.failures = []
+            self.rejections = 0
+            self.requests = 0
+
+    def _inject(self):
+        """Get injected failure status, ``None`` for timeout, ``False`` for success."""
+        with self.lock:
+            self.requests += 1
+            if self.failures:
+                return self.failures.pop(0)
+        if self.timeout_rate and self.random.random() < self.timeout_rate:
+            return None
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            return self.failure_status
+        return False
+
+    def get_latency(self):
+        """Get latency in seconds for next request."""
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            latency = self.random.uniform(*latency)
+        return latency
+
+    def perform(self, method, path, params, body, wait=True):
+        """Handle request, returns tuple of status and response body.
+
+        :param wait: sleep for latency, async connection awaits it instead
+        """
+        latency = self.get_latency() if wait else 0
+        if latency:
+            time.sleep(latency)
+        failure = self._inject()
+        if failure is None:
+            raise ConnectionTimeout('TIMEOUT', 'fake request timed out', socket.timeout('timed out'))
+        elif failure:
+            return failure, FakeError(failure, 'es_rejected_execution_exception', 'injected failure').body
+
+        segments = [unquote(segment) for segment in path.split('?')[0].split('/') if segment]
+        try:
+            with self.lock:
+                return self.route(method, segments, params or {}, body)
+        except FakeError as e:
+            return e.status, e.body
+
+    def route(self, method, segments, params, body):
+        if not segments:
+            return 200, {'name': 'fake', 'cluster_name': 'fake', 'version': {'number': VERSION}}
+
+        if segments[:2] == ['_search', 'scroll']:
+            if method == 'DELETE':
+                return self.clear_scroll(segments[2:], body)
+            return self.scroll(segments[2:], params, body)
+
+        position = next((i for i, segment in enumerate(segments) if segment in ENDPOINTS), None)
+        if position is None:
+            before, endpoint, after = segments, None, []
+        else:
+            before, endpoint, after = segments[:position], segments[position], segments[position + 1:]
+
+        index = before[0] if before else None
+        doc_id = before[2] if len(before) > 2 else None
+
+        if endpoint is None:
+            if len(before) == 1:
+                return self.index_api(method, index, body)
+            if len(before) == 2 and method == 'POST':
+                return self.index_doc(index, str(uuid4()), params, body)
+            if len(before) == 3:
+                return self.doc_api(method, index, doc_id, params, body)
+        elif endpoint == '_search':
+            return 200, self.search(index, params, body)
+        elif endpoint == '_count':
+            return 200, self.count(index, params, body)
+        elif endpoint == '_bulk':
+            return 200, self.bulk(index, params, body)
+        elif endpoint == '_mget':
+            return 200, self.mget(index, params, body)
+        elif endpoint == '_msearch':
+            return 200, self.msearch(index, body)
+        elif endpoint == '_update':
+            return self.update_doc(index, doc_id, params, body)
+        elif endpoint == '_create':
+            return self.index_doc(index, doc_id, params, body, create=True)
+        elif endpoint == '_refresh':
+            self.resolve(index)
+            return 200, {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+        elif endpoint in ('_open', '_close'):
+            self.get_index(index).closed = endpoint == '_close'
+            return 200, {'acknowledged': True}
+        elif endpoint == '_mapping':
+            return self.mapping_api(method, index, body)
+        elif endpoint == '_settings':
+            return self.settings_api(method, index, body)
+        elif endpoint in ('_alias', '_aliases'):
+            return self.alias_api(method, index, after)
+        raise FakeError(400, 'illegal_argument_exception', 'unsupported request %s %s' % (method, segments))
+
+    def resolve(self, name):
+        """Get list of indices for index name, alias or wildcard."""
+        if not name or name in ('_all', '*'):
+            return list(self.indices.values())
+        found = []
+        for part in name.split(','):
+            if part in self.indices:
+                found.append(self.indices[part])
+            elif '*' in part:
+                pattern = re.compile('^%s$' % re.escape(part).replace('\\*', '.*'))
+                found.extend(index for index in self.indices.values() if pattern.match(index.name))
+            else:
+                aliased = [index for index in self.indices.values() if part in index.aliases]
+                if not aliased:
+                    raise FakeError(404, 'index_not_found_exception', 'no such index [%s]' % part)
+                found.extend(aliased)
+        return found
+
+    def get_index(self, name, create=False):
+        try:
+            indices = self.resolve(name)
+        except FakeError:
+            if not create:
+                raise
+            self.indices[name] = FakeIndex(name)
+            indices = [self.indices[name]]
+        if len(indices) != 1:
+            raise FakeError(400, 'illegal_argument_exception', 'alias [%s] has more than one index' % name)
+        return indices[0]
+
+    def index_api(self, method, name, body):
+        if method == 'HEAD':
+            try:
+                self.resolve(name)
+                return 200, None
+            except FakeError:
+                return 404, None
+        elif method == 'PUT':
+            if name in self.indices:
+                raise FakeError(400, 'resource_already_exists_exception', 'index [%s] already exists' % name)
+            body = body or {}
+            self.indices[name] = FakeIndex(name, deepcopy(body.get('mappings')), deepcopy(body.get('settings')))
+            return 200, {'acknowledged': True, 'index': name}
+        elif method == 'DELETE':
+            for index in self.resolve(name):
+                del self.indices[index.name]
+            return 200, {'acknowledged': True}
+        elif method == 'GET':
+            return 200, dict((index.name, {
+                'aliases': dict((alias, {}) for alias in index.aliases),
+                'mappings': index.mappings,
+                'settings': {'index': index.settings},
+            }) for index in self.resolve(name))
+        raise FakeError(405, 'method_not_allowed', method)
+
+    def mapping_api(self, method, name, body):
+        if method == 'GET':
+            return 200, dict((index.name, {'mappings': index.mappings}) for index in self.resolve(name))
+        for index in self.resolve(name):
+            mapping = index.mappings.setdefault('doc', {})
+            mapping.setdefault('properties', {}).update(deepcopy((body or {}).get('properties', {})))
+        return 200, {'acknowledged': True}
+
+    def settings_api(self, method, name, body):
+        if method == 'GET':
+            return 200, dict((index.name, {'settings': {'index': index.settings}}) for index in self.resolve(name))
+        settings = (body or {}).get('settings', body or {})
+        for index in self.resolve(name):
+            index.settings.update(deepcopy(settings))
+        return 200, {'acknowledged': True}
+
+    def alias_api(self, method, name, after):
+        alias = after[0] if after else None
+        if method in ('PUT', 'POST'):
+            for index in self.resolve(name):
+                index.aliases.add(alias)
+            return 200, {'acknowledged': True}
+        elif method == 'DELETE':
+            for index in self.resolve(name):
+                index.aliases.discard(alias)
+            return 200, {'acknowledged': True}
+        indices = [index for index in self.resolve(name) if not alias or alias in index.aliases]
+        if not indices:
+            raise FakeError(404, 'aliases_not_found_exception', 'alias [%s] missing' % alias)
+        return 200, dict((index.name, {'aliases': dict((a, {}) for a in index.aliases)}) for index in indices)
+
+    def hit(self, index, doc, includes=None):
+        return {
+            '_index': index.name,
+            '_type': 'doc',
+            '_id': doc['_id'],
+            '_version': doc['_version'],
+            '_score': 1.0,
+            '_source': filter_source(deepcopy(doc['_source']), includes),
+        }
+
+    def doc_api(self, method, name, doc_id, params, body):
+        if method in ('PUT', 'POST'):
+            return self.index_doc(name, doc_id, params, body, create=params.get('op_type') == 'create')
+        index = self.get_index(name)
+        doc = index.docs.get(doc_id)
+        if method == 'DELETE':
+            if doc is None:
+                return 404, {'_index': index.name, '_type': 'doc', '_id': doc_id, 'result': 'not_found'}
+            del index.docs[doc_id]
+            return 200, {'_index': index.name, '_type': 'doc', '_id': doc_id, 'result': 'deleted',
+                         '_version': doc['_version'] + 1}
+        if doc is None:
+            return 404, {'_index': index.name, '_type': 'doc', '_id': doc_id, 'found': False}
+        hit = self.hit(index, doc, self.get_includes(params))
+        hit['found'] = True
+        return 200, hit
+
+    def index_doc(self, name, doc_id, params, body, create=False):
+        index = self.get_index(name, create=True)
+        current = index.docs.get(doc_id)
+        if current is not None and create:
+            raise FakeError(409, 'version_conflict_engine_exception', '[doc][%s]: document already exists' % doc_id)
+        version = current['_version'] + 1 if current else 1
+        index.docs[doc_id] = {'_id': doc_id, '_version': version, '_source': deepcopy(body or {}),
+                              '_routing': params.get('routing')}
+        return 200 if current else 201, {
+            '_index': index.name, '_type': 'doc', '_id': doc_id, '_version': version,
+            'result': 'updated' if current else 'created',
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+        }
+
+    def update_doc(self, name, doc_id, params, body):
+        index = self.get_index(name)
+        doc = index.docs.get(doc_id)
+        body = body or {}
+        if doc is None:
+            if 'upsert' in body or body.get('doc_as_upsert'):
+                return self.index_doc(name, doc_id, params, body.get('upsert', body.get('doc')))
+            raise FakeError(404, 'document_missing_exception', '[doc][%s]: document missing' % doc_id)
+        doc['_source'].update(deepcopy(body.get('doc', {})))
+        doc['_version'] += 1
+        return 200, {'_index': index.name, '_type': 'doc', '_id': doc_id, '_version': doc['_version'],
+                     'result': 'updated', '_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    def get_includes(self, params):
+        includes = params.get('_source') or params.get('_source_include')
+        if includes and includes not in ('true', 'false'):
+            return includes.split(',')
+
+    def mget(self, name, params, body):
+        includes = self.get_includes(params)
+        excludes = [field for field in params.get('_source_exclude', '').split(',') if field]
+        specs = [{'_id': _id} for _id in body.get('ids', [])] or body.get('docs', [])
+        docs = []
+        for spec in specs:
+            index = self.get_index(spec.get('_index', name))
+            doc = index.docs.get(spec['_id'])
+            if doc is None:
+                docs.append({'_index': index.name, '_type': 'doc', '_id': spec['_id'], 'found': False})
+            else:
+                hit = self.hit(index, doc, spec.get('_source', includes))
+                for field in excludes:
+                    hit['_source'].pop(field, None)
+                hit['found'] = True
+                docs.append(hit)
+        return {'docs': docs}
+
+    def find(self, name, body):
+        docs = []
+        for index in self.resolve(name):
+            docs.extend((index, doc) for doc in index.docs.values() if matches(doc, body.get('query')))
+        return docs
+
+    def search(self, name, params, body):
+        body = body or {}
+        unsupported = set(body) - SEARCH_BODY_KEYS
+        if unsupported:
+            raise UnsupportedQuery(', '.join(sorted(unsupported)))
+        found = self.find(name, body)
+        if body.get('slice'):
+            # docs are split between slices by hash of id
+            found = [(index, doc) for index, doc in found
+                     if zlib.crc32(str(doc['_id']).encode('utf-8')) % body['slice']['max'] == body['slice']['id']]
+        size = int(params.get('size', body.get('size', 10)))
+        offset = int(params.get('from', body.get('from', 0)))
+        sortable = [dict(doc, _index=index) for index, doc in found]
+        sort_docs(sortable, body.get('sort'))
+        includes = self.get_includes(params)
+        if includes is None and isinstance(body.get('_source'), list):
+            includes = body['_source']
+        hits = [self.hit(doc['_index'], doc, includes) for doc in sortable]
+
+        response = {
+            'took': 1,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': len(hits), 'max_score': 1.0 if hits else None, 'hits': hits[offset:offset + size]},
+        }
+        if body.get('track_total_hits') is False:
+            response['hits']['total'] = -1
+        aggs = body.get('aggs', body.get('aggregations'))
+        if aggs:
+            response['aggregations'] = aggregate([doc for index, doc in found], aggs)
+        if body.get('profile'):
+            response['profile'] = {'shards': []}
+        if params.get('scroll'):
+            scroll_id = str(uuid4())
+            self.scrolls[scroll_id] = hits[offset + size:]
+            response['_scroll_id'] = scroll_id
+        return response
+
+    def scroll(self, path, params, body):
+        scroll_id = path[0] if path else (body or {}).get('scroll_id', params.get('scroll_id'))
+        if scroll_id not in self.scrolls:
+            raise FakeError(404, 'search_context_missing_exception', 'No search context found')
+        hits = self.scrolls[scroll_id]
+        page, self.scrolls[scroll_id] = hits[:1000], hits[1000:]
+        return 200, {
+            '_scroll_id': scroll_id,
+            'took': 1,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {'total': len(hits), 'hits': page},
+        }
+
+    def clear_scroll(self, path, body):
+        scroll_ids = path[0].split(',') if path else as_list((body or {}).get('scroll_id'))
+        for scroll_id in scroll_ids:
+            self.scrolls.pop(scroll_id, None)
+        return 200, {'succeeded': True, 'num_freed': len(scroll_ids)}
+
+    def count(self, name, params, body):
+        count = len(self.find(name, body or {}))
+        if params.get('terminate_after'):
+            count = min(count, int(params['terminate_after']))
+        return {'count': count, '_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    def msearch(self, name, body):
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        responses = []
+        for header, query in zip(lines[::2], lines[1::2]):
+            try:
+                responses.append(self.search(header.get('index', name), {}, query))
+            except FakeError as e:
+                error = e.body
+                error['status'] = e.status
+                responses.append(error)
+        return {'took': 1, 'responses': responses}
+
+    def bulk(self, name, params, body):
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        items = []
+        errors = False
+        i = 0
+        while i < len(lines):
+            op_type, meta = next(iter(lines[i].items()))
+            i += 1
+            source = None
+            if op_type != 'delete':
+                source = lines[i]
+                i += 1
+            index_name = meta.get('_index', name)
+            doc_id = meta.get('_id', str(uuid4()))
+            doc_params = {'routing': meta.get('_routing', meta.get('routing'))}
+            try:
+                if self.rejections:
+                    self.rejections -= 1
+                    raise FakeError(429, 'es_rejected_execution_exception', 'injected rejection')
+                if op_type in ('index', 'create'):
+                    status, result = self.index_doc(index_name, doc_id, doc_params, source, op_type == 'create')
+                elif op_type == 'update':
+                    status, result = self.update_doc(index_name, doc_id, doc_params, source)
+                else:
+                    status, result = self.doc_api('DELETE', index_name, doc_id, doc_params, None)
+            except FakeError as e:
+                status, result = e.status, {'_index': index_name, '_type': 'doc', '_id': doc_id,
+                                            'error': e.body['error']}
+            result['status'] = status
+            errors = errors or status >= 300
+            items.append({op_type: result})
+        return {'took': 1, 'errors': errors, 'items': items}
+
+
+class FakeConnection(Connection):
+    """Connection to in-process :class:`FakeCluster`.
+
+    :param cluster: cluster to use, by default shared cluster for host and port
+    """
+
+    def __init__(self, host='localhost', port=9200, cluster=None, **kwargs):
+        super(FakeConnection, self).__init__(host=host, port=port, **kwargs)
+        self.cluster = cluster if cluster is not None else get_cluster(host, port)
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        return self._perform_request(method, url, params, body, ignore, time.time())
+
+    def _perform_request(self, method, url, params, body, ignore, start, wait=True):
+        if body is not None and not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        data = body.decode('utf-8') if body else None
+        if data and not url.split('?')[0].endswith(('_bulk', '_msearch')):
+            data = json.loads(data)
+        # client encodes string params to bytes
+        params = dict((key, value.decode('utf-8') if isinstance(value, bytes) else value)
+                      for key, value in (params or {}).items())
+        status, response = self.cluster.perform(method, url, params, data, wait=wait)
+        raw_data = json.dumps(response) if response is not None else ''
+        duration = time.time() - start
+
+        if not (200 <= status < 300) and status not in ignore:
+            self.log_request_fail(method, url, url, body, duration, status, raw_data)
+            self._raise_error(status, raw_data)
+
+        self.log_request_success(method, url, url, body, status, raw_data, duration)
+        return status, {'content-type': 'application/json'}, raw_data
+
+
+class AsyncFakeConnection(FakeConnection):
+    """Coroutine connection to in-process :class:`FakeCluster` used by :class:`~eve_elastic.aio.AsyncTransport`.
+
+    Latency is awaited, so concurrent requests don't block each other.
+    """
+
+    async def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        start = time.time()
+        latency = self.cluster.get_latency()
+        if latency:
+            await asyncio.sleep(latency)
+        return self._perform_request(method, url, params, body, ignore, start, wait=False)
@@ -5,11 +5,19 @@ See: https://github.com/elastic/elasticsearch-py/blob/1.x/elasticsearch/helpers/
 
 from __future__ import unicode_literals
 
+import os
+import re
+import mmap
 import logging
+import weakref
+import threading
 from operator import methodcaller
+from collections import deque
+from queue import Queue, Full
 
 from elasticsearch.exceptions import ElasticsearchException, TransportError
 from elasticsearch.compat import map, string_types
+from elasticsearch.client.utils import _make_path
 
 logger = logging.getLogger('elasticsearch.helpers')
 
@@ -80,9 +88,6 @@ def _chunk_actions(actions, chunk_size, max_chunk_bytes, serializer):
 
 def _process_bulk_chunk(client, bulk_actions, raise_on_exception=True, raise_on_error=True, **kwargs):
     """Send a bulk request to elasticsearch and process the output."""
-    # if raise on error is set, we need to collect errors per chunk before raising them
-    errors = []
-
     try:
         # send the actual request
         resp = client.bulk('\n'.join(bulk_actions) + '\n', **kwargs)
@@ -120,6 +125,15 @@ def _process_bulk_chunk(client, bulk_actions, raise_on_exception=True, raise_on_
                 yield False, err
             return
 
+    for result in _process_bulk_response(resp, raise_on_error):
+        yield result
+
+
+def _process_bulk_response(resp, raise_on_error=True):
+    """Yield result for every action in bulk response."""
+    # if raise on error is set, we need to collect errors per chunk before raising them
+    errors = []
+
     # go through request-reponse pairs and detect failures
     for op_type, item in map(methodcaller('popitem'), resp['items']):
         ok = 200 <= item.get('status', 500) < 300
@@ -161,6 +175,154 @@ def streaming_bulk(client, actions, chunk_size=500, max_chunk_bytes=100 * 1014 *
         for result in _process_bulk_chunk(client, bulk_actions, raise_on_exception, raise_on_error, **kwargs):
             yield result
 
+
+#: matches ``_id`` when it's the first key of serialized document, as written by export
+ID_PREFIX_RE = re.compile(br'^\{"_id":("(?:[^"\\]|\\.)*")(,?)')
+
+#: matches blank line
+BLANK_LINE_RE = re.compile(br'^[ \t\r]*\n', re.MULTILINE)
+
+
+def _chunk_ndjson(buffer, chunk_size, max_chunk_bytes, op_type='index', id_prefix=False):
+    """
+    Split ndjson buffer on line boundaries into bulk request bodies by number
+    of docs or size, documents are used as they are without any parsing.
+
+    Yields tuples of number of docs and request body.
+    :arg buffer: bytes like object, eg. :class:`mmap.mmap`
+    :arg op_type: bulk operation, ``index`` or ``create``
+    :arg id_prefix: move ``_id`` into action line when it's the first key of a doc
+    """
+    action_line = ('{"%s":{}}\n' % op_type).encode('utf-8')
+    id_action = ('{"%s":{"_id":' % op_type).encode('utf-8')
+    length = len(buffer)
+    start = 0
+    while start < length:
+        end = start
+        count, size = 0, 0
+        while end < length and count < chunk_size:
+            line_end = buffer.find(b'\n', end)
+            line_end = length if line_end == -1 else line_end + 1
+            line_size = line_end - end + len(action_line)
+            # full chunk, send it and start a new one
+            if count and size + line_size > max_chunk_bytes:
+                break
+            size += line_size
+            count += 1
+            end = line_end
+
+        data = buffer[start:end]
+        start = end
+        if not data.strip():
+            continue
+        if not data.endswith(b'\n'):
+            data += b'\n'
+
+        if id_prefix or BLANK_LINE_RE.search(data):
+            lines = []
+            for line in data.splitlines(True):
+                match = ID_PREFIX_RE.match(line) if id_prefix else None
+                if match:
+                    lines.append(id_action + match.group(1) + b'}}\n')
+                    lines.append(b'{' + line[match.end():])
+                elif line.strip():
+                    lines.append(action_line)
+                    lines.append(line)
+            yield len(lines) // 2, b''.join(lines)
+        else:
+            # prepend action line to every doc line
+            yield count, action_line + data.replace(b'\n', b'\n' + action_line, count - 1)
+
+
+def _process_bulk_body(client, count, body, raise_on_exception=True, raise_on_error=True,
+                       index=None, doc_type=None, **kwargs):
+    """Send serialized bulk request body to elasticsearch and process the output."""
+    params = dict((key, str(value).lower() if isinstance(value, bool) else value) for key, value in kwargs.items())
+    try:
+        resp = client.transport.perform_request(
+            'POST', _make_path(index, doc_type, '_bulk'), params=params, body=body,
+            headers={'content-type': 'application/x-ndjson'},
+        )
+    except TransportError as e:
+        # default behavior - just propagate exception
+        if raise_on_exception:
+            raise e
+
+        # docs are not parsed so there are no details about failed actions
+        exc_errors = [{'index': {'error': str(e), 'status': e.status_code, 'exception': e}}] * count
+        if raise_on_error:
+            raise BulkIndexError('%i document(s) failed to index.' % len(exc_errors), exc_errors)
+        for err in exc_errors:
+            yield False, err
+        return
+
+    for result in _process_bulk_response(resp, raise_on_error):
+        yield result
+
+
+def ndjson_bulk(client, path, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, thread_count=1,
+                op_type='index', id_prefix=False, raise_on_error=True, raise_on_exception=True, **kwargs):
+    """
+    Bulk index documents from ndjson file with a document per line.
+
+    The file is memory mapped and split on line boundaries into chunks which
+    are sent to elasticsearch without parsing and serializing documents again.
+    Yields results per action same as :func:`streaming_bulk`.
+    :arg client: instance of :class:`~elasticsearch.Elasticsearch` to use
+    :arg path: path to uncompressed ndjson file
+    :arg chunk_size: number of docs in one chunk sent to es (default: 500)
+    :arg max_chunk_bytes: the maximum size of the request in bytes (default: 100MB)
+    :arg thread_count: number of threads sending chunks in parallel
+    :arg op_type: bulk operation, ``index`` or ``create``
+    :arg id_prefix: use ``_id`` of documents starting with it as document id,
+        files written by :func:`eve_elastic.dump.export_resource` are such
+    :arg raise_on_error: raise ``BulkIndexError`` containing errors (as `.errors`)
+        from the execution of the last chunk when some occur. By default we raise.
+    :arg raise_on_exception: if ``False`` then don't propagate exceptions from
+        call to ``bulk`` and just report the items that failed as failed.
+    Any additional keyword arguments (eg. ``index``) are used as bulk api params.
+    """
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def send(chunk):
+        return list(_process_bulk_body(client, chunk[0], chunk[1], raise_on_exception, raise_on_error, **kwargs))
+
+    try:
+        chunks = _chunk_ndjson(buffer, chunk_size, max_chunk_bytes, op_type, id_prefix)
+        if thread_count > 1:
+            # Avoid importing multiprocessing unless parallel sending is used
+            from multiprocessing.dummy import Pool
+            pool = Pool(thread_count)
+            # keep only few chunks in flight, so the file is not read into memory at once
+            pending = deque()
+            try:
+                for chunk in chunks:
+                    pending.append(pool.apply_async(send, (chunk, )))
+                    if len(pending) >= thread_count * 2:
+                        for item in pending.popleft().get():
+                            yield item
+                while pending:
+                    for item in pending.popleft().get():
+                        yield item
+            except BaseException:
+                # error or generator closed, drop chunks not sent yet
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+        else:
+            for chunk in chunks:
+                for item in send(chunk):
+                    yield item
+    finally:
+        buffer.close()
+
+
 def bulk(client, actions, stats_only=False, **kwargs):
     """
     Helper for the :meth:`~elasticsearch.Elasticsearch.bulk` api that provides
@@ -229,28 +391,157 @@ def parallel_bulk(client, actions, thread_count=4, chunk_size=500,
     pool.close()
     pool.join()
 
+
+#: first version without ``search_type=scan``, scrolling is sorted by ``_doc`` instead
+SORT_BY_DOC_VERSION = (2, 1)
+
+#: first version with point in time api and ``_shard_doc`` tiebreaker
+POINT_IN_TIME_VERSION = (7, 12)
+
+
+def get_version(client):
+    """Get version of the cluster as tuple of ints, eg. ``(6, 4, 0)``."""
+    number = client.info().get('version', {}).get('number', '')
+    version = []
+    for part in number.split('-')[0].split('.'):
+        if not part.isdigit():
+            break
+        version.append(int(part))
+    return tuple(version)
+
+
+#: cluster versions by client, so that every scan does not need an info call
+_versions = weakref.WeakKeyDictionary()
+
+
+def _get_cached_version(client):
+    try:
+        return _versions[client]
+    except KeyError:
+        version = _versions[client] = get_version(client)
+        return version
+
+
+def _check_shards(resp, shard_failures):
+    """Log shard failures from given response and remember them."""
+    shards = resp.get('_shards', {})
+    if shards.get('failed'):
+        logger.warning(
+            'Scroll request has failed on %d shards out of %d.',
+            shards['failed'], shards['total']
+        )
+        shard_failures.append(shards)
+
+
+def _clear_scroll(client, scroll_id):
+    try:
+        client.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404, ))
+    except TransportError:
+        logger.warning('Failed to clear scroll %s', scroll_id, exc_info=True)
+
+
+def _close_point_in_time(client, pit_id):
+    try:
+        client.transport.perform_request('DELETE', '/_pit', body={'id': pit_id}, params={'ignore': 404})
+    except TransportError:
+        logger.warning('Failed to close point in time %s', pit_id, exc_info=True)
+
+
+def _scroll_hits(client, body, scroll, size, preserve_order, version, shard_failures, kwargs):
+    if not preserve_order:
+        if version and version < SORT_BY_DOC_VERSION:
+            kwargs['search_type'] = 'scan'
+        else:
+            body['sort'] = ['_doc']
+
+    # initial search
+    resp = client.search(body=body, scroll=scroll, size=size, **kwargs)
+    scroll_id = resp.get('_scroll_id')
+    try:
+        # with search_type=scan initial search contains no data
+        if kwargs.get('search_type') == 'scan':
+            if scroll_id is None:
+                return
+            resp = client.scroll(scroll_id=scroll_id, scroll=scroll)
+
+        while True:
+            _check_shards(resp, shard_failures)
+            for hit in resp['hits']['hits']:
+                yield hit
+
+            scroll_id = resp.get('_scroll_id') or scroll_id
+            # end of scroll
+            if scroll_id is None or not resp['hits']['hits']:
+                break
+
+            resp = client.scroll(scroll_id=scroll_id, scroll=scroll)
+    finally:
+        if scroll_id is not None:
+            _clear_scroll(client, scroll_id)
+
+
+def _point_in_time_hits(client, body, scroll, size, preserve_order, shard_failures, kwargs):
+    index = kwargs.pop('index')
+    kwargs.pop('doc_type', None)
+    resp = client.transport.perform_request('POST', '/%s/_pit' % index, params={'keep_alive': scroll})
+    pit_id = resp['id']
+    try:
+        if not preserve_order or 'sort' not in body:
+            body['sort'] = [{'_shard_doc': 'asc'}]
+        body['size'] = size
+        while True:
+            body['pit'] = {'id': pit_id, 'keep_alive': scroll}
+            resp = client.search(body=body, **kwargs)
+            pit_id = resp.get('pit_id', pit_id)
+            _check_shards(resp, shard_failures)
+
+            hits = resp['hits']['hits']
+            for hit in hits:
+                yield hit
+
+            if len(hits) < size:
+                break
+            body['search_after'] = hits[-1]['sort']
+    finally:
+        _close_point_in_time(client, pit_id)
+
+
 def scan(client, query=None, scroll='5m', raise_on_error=True,
-         preserve_order=False, size=1000, **kwargs):
+         preserve_order=False, size=1000, slice_id=None, slice_max=None,
+         use_point_in_time=True, version=None, **kwargs):
     """
     Simple abstraction on top of the
     :meth:`~elasticsearch.Elasticsearch.scroll` api - a simple iterator that
     yields all hits as returned by underlining scroll requests.
-    By default scan does not return results in any pre-determined order. To
-    have a standard order in the returned documents (either by score or
-    explicit sort definition) when scrolling, use ``preserve_order=True``. This
-    may be an expensive operation and will negate the performance benefits of
-    using ``scan``.
+    By default scan does not return results in any pre-determined order, hits
+    are sorted by ``_doc`` which is the most efficient order (on clusters
+    older than 2.1 ``search_type=scan`` is used instead). To have a standard
+    order in the returned documents (either by score or explicit sort
+    definition) when scrolling, use ``preserve_order=True``. This may be an
+    expensive operation and will negate the performance benefits of using
+    ``scan``.
+    On clusters supporting it scan uses point in time with ``search_after``
+    instead of scroll. The scroll context or point in time is released when
+    the iteration is finished, fails or the generator is closed.
     :arg client: instance of :class:`~elasticsearch.Elasticsearch` to use
     :arg query: body for the :meth:`~elasticsearch.Elasticsearch.search` api
     :arg scroll: Specify how long a consistent view of the index should be
         maintained for scrolled search
     :arg raise_on_error: raises an exception (``ScanError``) if an error is
-        encountered (some shards fail to execute). By default we raise.
-    :arg preserve_order: don't set the ``search_type`` to ``scan`` - this will
-        cause the scroll to paginate with preserving the order. Note that this
-        can be an extremely expensive operation and can easily lead to
-        unpredictable results, use with caution.
+        encountered (some shards fail to execute). Failures are logged as they
+        happen and the error is raised only once all available hits were
+        yielded. By default we raise.
+    :arg preserve_order: don't sort by ``_doc`` - this will cause the scroll
+        to paginate with preserving the order. Note that this can be an
+        extremely expensive operation and can easily lead to unpredictable
+        results, use with caution.
     :arg size: size (per shard) of the batch send at each iteration.
+    :arg slice_id: id of the slice to scan when using sliced scroll
+    :arg slice_max: total number of slices, see :func:`parallel_scan`
+    :arg use_point_in_time: use point in time if supported by the cluster
+        and ``index`` is set
+    :arg version: cluster version tuple, fetched from cluster once per client
+        if not set
     Any additional keyword arguments will be passed to the initial
     :meth:`~elasticsearch.Elasticsearch.search` call::
         scan(es,
@@ -259,42 +550,94 @@ def scan(client, query=None, scroll='5m', raise_on_error=True,
             doc_type="books"
         )
     """
-    if not preserve_order:
-        kwargs['search_type'] = 'scan'
-    # initial search
-    resp = client.search(body=query, scroll=scroll, size=size, **kwargs)
+    body = dict(query) if query else {}
+    if slice_max and slice_max > 1:
+        body['slice'] = {'id': slice_id or 0, 'max': slice_max}
 
-    scroll_id = resp.get('_scroll_id')
-    if scroll_id is None:
-        return
+    if version is None:
+        version = _get_cached_version(client)
 
-    first_run = True
-    while True:
-        # if we didn't set search_type to scan initial search contains data
-        if preserve_order and first_run:
-            first_run = False
-        else:
-            resp = client.scroll(scroll_id, scroll=scroll)
+    shard_failures = []
+    if use_point_in_time and version >= POINT_IN_TIME_VERSION and kwargs.get('index'):
+        hits = _point_in_time_hits(client, body, scroll, size, preserve_order, shard_failures, kwargs)
+    else:
+        hits = _scroll_hits(client, body, scroll, size, preserve_order, version, shard_failures, kwargs)
 
-        for hit in resp['hits']['hits']:
+    try:
+        for hit in hits:
             yield hit
+    finally:
+        hits.close()
+
+    if shard_failures and raise_on_error:
+        raise ScanError(
+            'Scroll request has failed on %d shards out of %d.' %
+            (shard_failures[-1]['failed'], shard_failures[-1]['total'])
+        )
+
+
+def parallel_scan(client, query=None, slices=4, queue_size=10000, **kwargs):
+    """
+    Sliced version of :func:`scan` scanning every slice in its own thread.
+
+    Hits are yielded in no particular order as they are fetched. The number
+    of hits waiting to be consumed is bounded by ``queue_size``.
+    :arg client: instance of :class:`~elasticsearch.Elasticsearch` to use
+    :arg query: body for the :meth:`~elasticsearch.Elasticsearch.search` api
+    :arg slices: number of slices (and threads) to use
+    :arg queue_size: max number of fetched hits not consumed yet
+    Any additional keyword arguments will be passed to :func:`scan`.
+    """
+    if 'version' not in kwargs:
+        kwargs['version'] = _get_cached_version(client)
+
+    hits = Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                hits.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def scan_slice(slice_id):
+        try:
+            docs = scan(client, query, slice_id=slice_id, slice_max=slices, **kwargs)
+            try:
+                for hit in docs:
+                    if not put(hit):
+                        break
+            finally:
+                docs.close()
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    threads = [threading.Thread(target=scan_slice, args=(i, )) for i in range(slices)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        running = len(threads)
+        while running:
+            item = hits.get()
+            if item is done:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
 
-        # check if we have any errrors
-        if resp["_shards"]["failed"]:
-            logger.warning(
-                'Scroll request has failed on %d shards out of %d.',
-                resp['_shards']['failed'], resp['_shards']['total']
-            )
-            if raise_on_error:
-                raise ScanError(
-                    'Scroll request has failed on %d shards out of %d.' %
-                    (resp['_shards']['failed'], resp['_shards']['total'])
-                )
-
-        scroll_id = resp.get('_scroll_id')
-        # end of scroll
-        if scroll_id is None or not resp['hits']['hits']:
-            break
 
 def reindex(client, source_index, target_index, query=None, target_client=None,
         chunk_size=500, scroll='5m', scan_kwargs={}, bulk_kwargs={}):
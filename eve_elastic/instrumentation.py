@@ -0,0 +1,376 @@
+"""Instrumentation of data layer operations and elasticsearch requests.
+
+Register a callback to get an :class:`Event` for every elasticsearch request
+and every data layer operation::
+
+    from eve_elastic import instrumentation
+
+    def on_event(event):
+        if event.kind == instrumentation.OPERATION:
+            statsd.timing('elastic.%s.%s' % (event.resource, event.operation), event.duration * 1000)
+
+    instrumentation.subscribe(on_event)
+
+Request events have ``duration`` of the http request including serialization,
+operation events have ``duration`` of the whole data layer call including
+parsing of the response, ``took`` is the time reported by elastic. Requests
+are only measured if there is some callback registered.
+
+Every request is sent with ``X-Opaque-Id`` header, so it can be found in elastic
+slow logs and task list. Within flask request it's taken from ``X-Request-Id``
+header (configurable via ``ELASTICSEARCH_REQUEST_ID_HEADER``) or generated once
+per request, elsewhere it can be set via :func:`opaque_id`::
+
+    with instrumentation.opaque_id('import-job-42'):
+        app.data.bulk_insert('items', docs)
+"""
+
+import time
+import bisect
+import asyncio
+import logging
+import threading
+import contextvars
+
+from uuid import uuid4
+from functools import wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import current_app, request, has_request_context
+
+
+logger = logging.getLogger('elastic')
+
+#: event kind for single elasticsearch request
+REQUEST = 'request'
+
+#: event kind for data layer operation like ``find`` or ``insert``
+OPERATION = 'operation'
+
+#: header used to pass request id to elastic
+OPAQUE_ID_HEADER = 'X-Opaque-Id'
+
+#: default header with id of incoming request
+REQUEST_ID_HEADER = 'X-Request-Id'
+
+_ENVIRON_KEY = 'eve_elastic.opaque_id'
+
+
+
+class ContextLocal(object):
+    """Like ``threading.local`` but also separate for every asyncio task."""
+
+    def __init__(self, name):
+        object.__setattr__(self, '_values', ContextVar(name))
+
+    def __getattr__(self, name):
+        try:
+            return self._values.get()[name]
+        except (LookupError, KeyError):
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        values = dict(self._values.get({}))
+        values[name] = value
+        self._values.set(values)
+
+
+_listeners = []
+_local = ContextLocal('eve_elastic.instrumentation')
+_lock = threading.Lock()
+
+
+def subscribe(callback):
+    """Register callback called with every :class:`Event`."""
+    if callback not in _listeners:
+        _listeners.append(callback)
+
+
+def unsubscribe(callback):
+    """Remove registered callback."""
+    if callback in _listeners:
+        _listeners.remove(callback)
+
+
+def is_enabled():
+    """Test if there is any callback registered."""
+    return bool(_listeners)
+
+
+def emit(event):
+    """Call all registered callbacks with given event, errors are logged."""
+    for callback in list(_listeners):
+        try:
+            callback(event)
+        except Exception:
+            logger.exception('instrumentation callback failed')
+
+
+class Event(object):
+    """Elasticsearch request or data layer operation info."""
+
+    def __init__(self, kind, resource=None, operation=None, method=None, url=None, index=None):
+        self.kind = kind
+        self.resource = resource
+        self.operation = operation
+        self.method = method
+        self.url = url
+        self.index = index
+        self.duration = 0.0
+        self.took = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.hits = None
+        self.requests = 0
+        self.error = None
+        self.opaque_id = None
+
+    def __repr__(self):
+        return '<Event %s %s.%s index=%s duration=%.4f took=%s>' % (
+            self.kind, self.resource, self.operation, self.index, self.duration, self.took)
+
+
+def get_opaque_id():
+    """Get opaque id for requests made in current thread or task, ``None`` outside of request."""
+    value = getattr(_local, 'opaque_id', None)
+    if value is not None or not has_request_context():
+        return value
+
+    environ = request.environ
+    if _ENVIRON_KEY not in environ:
+        header = current_app.config.get('ELASTICSEARCH_REQUEST_ID_HEADER', REQUEST_ID_HEADER)
+        environ[_ENVIRON_KEY] = request.headers.get(header) or uuid4().hex
+    return environ[_ENVIRON_KEY]
+
+
+@contextmanager
+def opaque_id(value=None):
+    """Set opaque id for requests made in current thread or task, it's generated if not provided."""
+    previous = getattr(_local, 'opaque_id', None)
+    _local.opaque_id = value or uuid4().hex
+    try:
+        yield _local.opaque_id
+    finally:
+        _local.opaque_id = previous
+
+
+def copy_context():
+    """Get copy of current context with opaque id of current request set.
+
+    Requests made in other thread using it are attributed to current operation and request,
+    every thread needs its own copy::
+
+        executor.submit(instrumentation.copy_context().run, func, arg)
+    """
+    value = get_opaque_id()
+    context = contextvars.copy_context()
+    context.run(setattr, _local, 'opaque_id', value)
+    return context
+
+
+def current_operation():
+    """Get event for operation running in current thread if any."""
+    return getattr(_local, 'operation', None)
+
+
+def get_hits_count(data):
+    """Get number of hits/docs/items returned in response."""
+    if not isinstance(data, dict):
+        return None
+    for key in ('hits', 'docs', 'items'):
+        if key in data:
+            value = data[key]
+            if isinstance(value, dict):
+                value = value.get('hits', [])
+            return len(value)
+
+
+def get_index(url):
+    """Get index name from request url."""
+    part = url.lstrip('/').split('/', 1)[0]
+    if part and not part.startswith('_'):
+        return part
+
+
+class RequestTimer(object):
+    """Measure single elasticsearch request, used by :class:`~eve_elastic.transport.ElasticTransport`."""
+
+    def __init__(self, method, url, body, opaque_id=None):
+        operation = current_operation()
+        self.event = Event(REQUEST, method=method, url=url, index=get_index(url))
+        self.event.opaque_id = opaque_id
+        if operation is not None:
+            self.event.resource = operation.resource
+            self.event.operation = operation.operation
+        self.event.request_bytes = len(body) if body is not None else 0
+        _local.response_bytes = 0
+        self.started = time.time()
+
+    def finish(self, data=None, error=None):
+        event = self.event
+        event.duration = time.time() - self.started
+        event.response_bytes = getattr(_local, 'response_bytes', 0)
+        event.requests = 1
+        if error is not None:
+            event.error = error.__class__.__name__
+        elif isinstance(data, dict):
+            event.took = data.get('took')
+            event.hits = get_hits_count(data)
+
+        operation = current_operation()
+        if operation is not None:
+            # operation can make requests from multiple threads
+            with _lock:
+                operation.requests += 1
+                operation.request_bytes += event.request_bytes
+                operation.response_bytes += event.response_bytes
+                if event.took is not None:
+                    operation.took = (operation.took or 0) + event.took
+                if event.hits is not None:
+                    operation.hits = (operation.hits or 0) + event.hits
+                if operation.index is None:
+                    operation.index = event.index
+
+        emit(event)
+
+
+def record_response_size(size):
+    """Record size of response body received in current thread."""
+    _local.response_bytes = getattr(_local, 'response_bytes', 0) + size
+
+
+def reset_response_size():
+    """Reset size of response bodies received in current thread."""
+    _local.response_bytes = 0
+
+
+def get_response_size():
+    """Get size of response bodies received in current thread since last reset."""
+    return getattr(_local, 'response_bytes', 0)
+
+
+def _start_operation(resource, operation):
+    event = Event(OPERATION, resource=resource, operation=operation)
+    event.opaque_id = get_opaque_id()
+    _local.operation = event
+    return event
+
+
+def _finish_operation(event, started):
+    _local.operation = None
+    event.duration = time.time() - started
+    emit(event)
+
+
+def instrumented(func):
+    """Decorate data layer method taking resource as first argument to emit operation event.
+
+    Nested operations are reported as part of the outermost one. Coroutine methods
+    are measured until they return.
+    """
+    if asyncio.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(self, resource, *args, **kwargs):
+            if not _listeners or current_operation() is not None:
+                return await func(self, resource, *args, **kwargs)
+
+            event = _start_operation(resource, func.__name__)
+            started = time.time()
+            try:
+                return await func(self, resource, *args, **kwargs)
+            except Exception as e:
+                event.error = e.__class__.__name__
+                raise
+            finally:
+                _finish_operation(event, started)
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(self, resource, *args, **kwargs):
+        if not _listeners or current_operation() is not None:
+            return func(self, resource, *args, **kwargs)
+
+        event = _start_operation(resource, func.__name__)
+        started = time.time()
+        try:
+            return func(self, resource, *args, **kwargs)
+        except Exception as e:
+            event.error = e.__class__.__name__
+            raise
+        finally:
+            _finish_operation(event, started)
+    return wrapper
+
+
+class Histogram(object):
+    """Histogram with fixed buckets."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Get upper bound of the bucket containing given quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class HistogramCollector(object):
+    """Collect operation latencies into histograms per resource and operation.
+
+    It can be registered via :func:`subscribe`::
+
+        collector = HistogramCollector()
+        instrumentation.subscribe(collector)
+        collector.histograms[('items', 'find')].quantile(0.99)
+    """
+
+    #: bucket upper bounds in seconds
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None, kind=OPERATION):
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self.kind = kind
+        self.histograms = {}
+        self.took = {}
+        self.lock = threading.Lock()
+
+    def _histogram(self, histograms, key):
+        if key not in histograms:
+            histograms[key] = Histogram(self.buckets)
+        return histograms[key]
+
+    def __call__(self, event):
+        if event.kind != self.kind:
+            return
+        key = (event.resource, event.operation)
+        with self.lock:
+            self._histogram(self.histograms, key).observe(event.duration)
+            if event.took is not None:
+                self._histogram(self.took, key).observe(event.took / 1000.0)
+
+    def snapshot(self):
+        """Get summary of collected data per resource and operation."""
+        with self.lock:
+            return dict((key, {
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'p50': histogram.quantile(0.5),
+                'p99': histogram.quantile(0.99),
+                'took_p99': self.took[key].quantile(0.99) if key in self.took else None,
+            }) for key, histogram in self.histograms.items())
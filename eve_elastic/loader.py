@@ -0,0 +1,181 @@
+"""Batching of concurrent lookups and searches.
+
+Concurrent lookups by id are coalesced into ``mget`` requests, searches into ``msearch``.
+Lookups are identified by ``(resource, id, parent)`` keys, searches by :class:`SearchKey`.
+First call starts a batch and waits ``window`` seconds for others, then all keys collected
+are fetched at once via ``fetch(keys)`` which returns dict of key and result, exception
+can be used as result for single key. Same keys in a batch are fetched only once,
+every caller gets its own copy.
+
+Documents fetched within flask request can be kept in :class:`IdentityMap`,
+so reading same document again (etag check, hooks, embedding) doesn't hit elastic.
+"""
+
+import json
+import asyncio
+import threading
+
+from copy import deepcopy
+from concurrent.futures import Future
+from flask import request, has_request_context
+
+
+MISSING = object()
+
+_ENVIRON_KEY = 'eve_elastic.identity_map'
+
+
+class Batch(object):
+    """Keys waiting to be fetched together."""
+
+    def __init__(self):
+        self.futures = {}
+        self.waiters = {}
+
+    def add(self, key, future_class):
+        if key not in self.futures:
+            self.futures[key] = future_class()
+            self.waiters[key] = 0
+        self.waiters[key] += 1
+        return self.futures[key]
+
+    def resolve(self, results):
+        for key, future in self.futures.items():
+            result = results.get(key)
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def fail(self, error):
+        for future in self.futures.values():
+            future.set_exception(error)
+
+    def result(self, key, doc):
+        return deepcopy(doc) if self.waiters[key] > 1 and doc is not None else doc
+
+
+class BatchLoader(object):
+    """Coalesce lookups made concurrently from multiple threads.
+
+    :param fetch: function fetching results for list of keys
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.lock = threading.Lock()
+        self.batch = None
+
+    def load(self, key, window):
+        """Get result for key, waits up to ``window`` seconds for other lookups."""
+        with self.lock:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = Batch()
+            future = batch.add(key, Future)
+
+        if leader:
+            if window:
+                threading.Event().wait(window)
+            with self.lock:
+                self.batch = None
+            try:
+                batch.resolve(self.fetch(list(batch.futures)))
+            except Exception as e:
+                batch.fail(e)
+
+        return batch.result(key, future.result())
+
+
+class AsyncBatchLoader(object):
+    """Coalesce lookups made concurrently from tasks running in single event loop.
+
+    With ``window`` 0 lookups made before the first one yields to event loop are batched.
+
+    :param fetch: coroutine function fetching results for list of keys
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.batch = None
+
+    async def load(self, key, window):
+        """Get result for key, waits up to ``window`` seconds for other lookups."""
+        batch = self.batch
+        leader = batch is None
+        if leader:
+            batch = self.batch = Batch()
+        future = batch.add(key, asyncio.get_running_loop().create_future)
+
+        if leader:
+            await asyncio.sleep(window or 0)
+            self.batch = None
+            try:
+                batch.resolve(await self.fetch(list(batch.futures)))
+            except Exception as e:
+                batch.fail(e)
+
+        return batch.result(key, await future)
+
+
+class SearchKey(object):
+    """Search of resource, searches with same body and args are equal.
+
+    :param resource: resource name
+    :param query: search body
+    :param args: search args, see :meth:`~eve_elastic.elastic.Elastic._es_args`
+    :param page: page number used for slow query log
+    """
+
+    def __init__(self, resource, query, args, page=None):
+        self.resource = resource
+        self.query = query
+        self.args = args
+        self.page = page
+        self.key = (resource, json.dumps(query, sort_keys=True, default=str), json.dumps(args, sort_keys=True))
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, SearchKey) and self.key == other.key
+
+
+class IdentityMap(object):
+    """Documents fetched by id, ``None`` is kept for docs not found.
+
+    Docs are stored per index and id, so write via any resource using the index
+    invalidates them. Copies are stored and returned, callers can modify them.
+    """
+
+    def __init__(self):
+        self.docs = {}
+
+    def get(self, index, resource, _id):
+        """Get copy of doc, :data:`MISSING` if it's not in the map."""
+        doc = self.docs.get((index, str(_id)), {}).get(resource, MISSING)
+        return doc if doc is MISSING else deepcopy(doc)
+
+    def set(self, index, resource, _id, doc):
+        self.docs.setdefault((index, str(_id)), {})[resource] = deepcopy(doc)
+
+    def invalidate(self, index, _id=None):
+        """Remove doc from the map, all docs of index if ``_id`` is not set."""
+        if _id is not None:
+            self.docs.pop((index, str(_id)), None)
+            return
+        for key in [key for key in self.docs if key[0] == index]:
+            del self.docs[key]
+
+
+def get_identity_map(create=True):
+    """Get identity map for current flask request, ``None`` outside of request.
+
+    :param create: create it if it doesn't exist yet
+    """
+    if not has_request_context():
+        return None
+    if create:
+        return request.environ.setdefault(_ENVIRON_KEY, IdentityMap())
+    return request.environ.get(_ENVIRON_KEY)
@@ -0,0 +1,168 @@
+"""Cumulative data layer metrics exported in Prometheus text format.
+
+Every :class:`~eve_elastic.elastic.Elastic` instance records into :attr:`Elastic.metrics`,
+by default using module level :data:`REGISTRY`. Set ``ELASTICSEARCH_METRICS_URL``
+to serve it from the app or render it yourself::
+
+    from eve_elastic import metrics
+
+    app.add_url_rule('/metrics', 'metrics', metrics.get_metrics_view())
+
+To use other registry set ``app.data.metrics = DataLayerMetrics(registry)``
+before the first request.
+"""
+
+import threading
+
+from collections import OrderedDict
+
+
+#: content type of the text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric(object):
+    """Counter or gauge with values per label set."""
+
+    def __init__(self, name, documentation, type=COUNTER, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def set_max(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = max(self.values.get(key, value), value)
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation.replace('\\', '\\\\').replace('\n', '\\n')),
+            '# TYPE %s %s' % (self.name, self.type),
+        ]
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            labels = ','.join('%s="%s"' % (name, escape_label(label)) for name, label in zip(self.labelnames, key))
+            lines.append('%s%s %s' % (self.name, '{%s}' % labels if labels else '', format_value(value)))
+        return '\n'.join(lines)
+
+
+class Registry(object):
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Register metric, returns already registered one with the same name if any."""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Metric(name, documentation, COUNTER, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Metric(name, documentation, GAUGE, labelnames))
+
+    def get(self, name):
+        return self.metrics.get(name)
+
+    def render(self):
+        """Render all metrics in Prometheus text format."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return ''.join(metric.render() + '\n' for metric in metrics)
+
+
+#: default registry
+REGISTRY = Registry()
+
+
+class DataLayerMetrics(object):
+    """Metrics recorded by data layer, counters are per resource, request metrics per elastic prefix."""
+
+    def __init__(self, registry=None):
+        self.registry = registry if registry is not None else REGISTRY
+        self.docs_indexed = self.registry.counter(
+            'eve_elastic_docs_indexed_total', 'Documents indexed.', ('resource', ))
+        self.docs_failed = self.registry.counter(
+            'eve_elastic_docs_failed_total', 'Documents failed to index in bulk requests.', ('resource', ))
+        self.docs_retried = self.registry.counter(
+            'eve_elastic_docs_retried_total', 'Documents sent again after rejection in bulk response.',
+            ('resource', ))
+        self.searches = self.registry.counter(
+            'eve_elastic_searches_total', 'Search requests.', ('resource', ))
+        self.hits = self.registry.counter(
+            'eve_elastic_hits_total', 'Hits returned by search requests.', ('resource', ))
+        self.refreshes = self.registry.counter(
+            'eve_elastic_refreshes_total', 'Index refreshes issued.', ('resource', ))
+        self.response_bytes = self.registry.counter(
+            'eve_elastic_search_response_bytes_total', 'Size of decoded search responses.', ('resource', ))
+        self.max_response_bytes = self.registry.gauge(
+            'eve_elastic_search_response_bytes_max', 'Size of the biggest decoded search response.', ('resource', ))
+        self.limit_rejections = self.registry.counter(
+            'eve_elastic_limit_rejections_total', 'Searches rejected by size limits.', ('resource', 'limit'))
+        self.bulk_bytes = self.registry.counter(
+            'eve_elastic_bulk_bytes_total', 'Bytes sent in bulk request bodies.', ('prefix', ))
+        self.retryable_failures = self.registry.counter(
+            'eve_elastic_retryable_failures_total', 'Requests failed with error eligible for retry.', ('prefix', ))
+        self.in_flight = self.registry.gauge(
+            'eve_elastic_requests_in_flight', 'Requests waiting for response.', ('prefix', ))
+
+
+class BulkClient(object):
+    """Client proxy counting items in bulk responses, used to get number of retried docs."""
+
+    def __init__(self, client):
+        self.client = client
+        self.transport = client.transport
+        self.items = 0
+
+    def bulk(self, *args, **kwargs):
+        response = self.client.bulk(*args, **kwargs)
+        self.items += len(response.get('items', []))
+        return response
+
+
+def get_metrics_view(registry=None):
+    """Get flask view function rendering given registry, :data:`REGISTRY` by default."""
+    from flask import Response
+
+    def metrics_view():
+        return Response((registry or REGISTRY).render(), content_type=CONTENT_TYPE)
+    return metrics_view
@@ -0,0 +1,70 @@
+"""JSON serializers used for elastic requests and responses.
+
+:func:`get_serializer` returns :class:`FastJSONSerializer` when ``orjson``
+is installed (``pip install Eve-Elastic[orjson]``), :class:`ElasticJSONSerializer`
+otherwise. Both produce the same output for values stored via eve.
+"""
+
+import elasticsearch
+
+from bson import ObjectId
+from decimal import Decimal
+from elasticsearch.exceptions import SerializationError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ElasticJSONSerializer(elasticsearch.JSONSerializer):
+    """Customize the JSON serializer used in Elastic."""
+    def default(self, value):
+        """Convert mongo.ObjectId and sets."""
+        if isinstance(value, ObjectId):
+            return str(value)
+        if isinstance(value, (set, frozenset)):
+            return list(value)
+        return super(ElasticJSONSerializer, self).default(value)
+
+
+class FastJSONSerializer(ElasticJSONSerializer):
+    """Serializer using ``orjson``.
+
+    ``datetime`` and ``uuid`` are serialized by ``orjson``, ``ObjectId``,
+    ``Decimal`` and sets via :meth:`default`. Values ``orjson`` refuses,
+    eg. integers over 64 bits, are serialized by :class:`ElasticJSONSerializer`.
+    """
+
+    if orjson is not None:
+        options = orjson.OPT_NON_STR_KEYS
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError('orjson is required for FastJSONSerializer')
+
+    def default(self, value):
+        if isinstance(value, Decimal):
+            return float(value)
+        return super(FastJSONSerializer, self).default(value)
+
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data, default=self.default, option=self.options).decode('utf-8')
+        except orjson.JSONEncodeError:
+            return super(FastJSONSerializer, self).dumps(data)
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+
+def get_serializer():
+    """Get fastest serializer available."""
+    if orjson is not None:
+        return FastJSONSerializer()
+    return ElasticJSONSerializer()
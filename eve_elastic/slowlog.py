@@ -0,0 +1,92 @@
+"""Slow query log with normalized query fingerprints.
+
+Queries are normalized by replacing all literal values with ``?`` and sorting
+keys, so queries with same shape but different values share a fingerprint.
+"""
+
+import json
+import hashlib
+import logging
+import threading
+
+
+logger = logging.getLogger('elastic.slowlog')
+
+#: placeholder for literal values in normalized queries
+PLACEHOLDER = '?'
+
+
+def normalize_query(query):
+    """Replace literal values in query with placeholder.
+
+    Lists of literals are replaced by single placeholder so ``terms`` queries
+    with different number of values have the same shape.
+    """
+    if isinstance(query, dict):
+        return dict((key, normalize_query(value)) for key, value in query.items())
+    elif isinstance(query, (list, tuple)):
+        values = [normalize_query(value) for value in query]
+        if all(value == PLACEHOLDER for value in values):
+            return PLACEHOLDER
+        return values
+    return PLACEHOLDER
+
+
+def fingerprint(query):
+    """Get fingerprint for given query.
+
+    Returns tuple of short hash and normalized query as json string.
+    """
+    normalized = json.dumps(normalize_query(query), sort_keys=True, separators=(',', ':'))
+    return hashlib.md5(normalized.encode('utf-8')).hexdigest()[:16], normalized
+
+
+class SlowQueryLog(object):
+    """Log slow queries and keep aggregated stats per fingerprint.
+
+    :param max_fingerprints: max number of fingerprints to keep stats for,
+        queries with new fingerprints are only logged once it's reached
+    """
+
+    def __init__(self, max_fingerprints=1000):
+        self.max_fingerprints = max_fingerprints
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, resource, query, duration, took=None, page=None):
+        """Log slow query and update stats."""
+        key, normalized = fingerprint(query)
+        logger.warning('slow query resource=%s fingerprint=%s duration=%.3f took=%s page=%s query=%s',
+                       resource, key, duration, took, page, normalized)
+
+        with self.lock:
+            if key not in self.stats:
+                if len(self.stats) >= self.max_fingerprints:
+                    return
+                self.stats[key] = {
+                    'query': normalized,
+                    'resources': set(),
+                    'count': 0,
+                    'duration': 0.0,
+                    'max_duration': 0.0,
+                    'took': 0,
+                    'max_page': 0,
+                }
+            stats = self.stats[key]
+            stats['resources'].add(resource)
+            stats['count'] += 1
+            stats['duration'] += duration
+            stats['max_duration'] = max(stats['max_duration'], duration)
+            stats['took'] += took or 0
+            stats['max_page'] = max(stats['max_page'], page or 0)
+
+    def top(self, limit=10, key='duration'):
+        """Get stats for fingerprints sorted by given key, ``duration`` by default."""
+        with self.lock:
+            items = sorted(self.stats.items(), key=lambda item: item[1][key], reverse=True)
+            return [(fp, dict(stats)) for fp, stats in items[:limit]]
+
+    def clear(self):
+        """Remove collected stats."""
+        with self.lock:
+            self.stats.clear()
@@ -0,0 +1,252 @@
+"""Elasticsearch transport used by clients created via :func:`~eve_elastic.elastic.get_es`."""
+
+import gzip
+import time
+import elasticsearch
+
+from contextlib import contextmanager
+from elasticsearch.compat import urlencode
+from elasticsearch.connection import Urllib3HttpConnection
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout, SSLError
+from urllib3.exceptions import ReadTimeoutError, SSLError as UrllibSSLError
+from urllib3.util.retry import Retry
+
+from . import instrumentation
+
+
+_local = instrumentation.ContextLocal('eve_elastic.transport')
+
+
+class ResponseTooLarge(elasticsearch.ElasticsearchException):
+    """Response body is bigger than limit set via :func:`max_response_bytes`."""
+
+    def __init__(self, size, limit):
+        super(ResponseTooLarge, self).__init__('response size %d exceeds limit %d' % (size, limit))
+        self.size = size
+        self.limit = limit
+
+
+@contextmanager
+def max_response_bytes(limit):
+    """Limit size of responses received in current thread or task, bigger ones are not decoded."""
+    previous = getattr(_local, 'max_response_bytes', None)
+    _local.max_response_bytes = limit
+    try:
+        yield
+    finally:
+        _local.max_response_bytes = previous
+
+
+def read_limited(response, limit):
+    """Read body of urllib3 response streamed with ``preload_content=False``.
+
+    Raises :class:`ResponseTooLarge` without reading the rest of the body once it exceeds ``limit``,
+    or without reading it at all if ``Content-Length`` exceeds it. The connection is closed then.
+    """
+    length = response.headers.get('content-length')
+    if length and length.isdigit() and int(length) > limit:
+        response.close()
+        instrumentation.record_response_size(int(length))
+        raise ResponseTooLarge(int(length), limit)
+
+    chunks = []
+    size = 0
+    for chunk in response.stream(64 * 1024):
+        size += len(chunk)
+        if size > limit:
+            response.close()
+            instrumentation.record_response_size(size)
+            raise ResponseTooLarge(size, limit)
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+class SizeRecordingDeserializer(object):
+    """Deserializer wrapper recording size of response bodies and checking its limit."""
+
+    def __init__(self, deserializer):
+        self.deserializer = deserializer
+
+    def loads(self, s, mimetype=None):
+        instrumentation.record_response_size(len(s))
+        limit = getattr(_local, 'max_response_bytes', None)
+        if limit is not None and len(s) > limit:
+            raise ResponseTooLarge(len(s), limit)
+        return self.deserializer.loads(s, mimetype)
+
+
+class ElasticTransport(elasticsearch.Transport):
+    """Transport reporting every request to :mod:`~eve_elastic.instrumentation` and metrics.
+
+    It adds ``X-Opaque-Id`` header to every request made within flask request
+    or :func:`~eve_elastic.instrumentation.opaque_id` block.
+    """
+
+    #: :class:`~eve_elastic.metrics.DataLayerMetrics` set by data layer
+    metrics = None
+
+    #: elastic prefix used as metrics label
+    prefix = None
+
+    def __init__(self, *args, **kwargs):
+        super(ElasticTransport, self).__init__(*args, **kwargs)
+        self.deserializer = SizeRecordingDeserializer(self.deserializer)
+
+    def _encode(self, body):
+        """Serialize and encode body, transport won't do it again."""
+        body = self.serializer.dumps(body)
+        try:
+            return body.encode('utf-8', 'surrogatepass')
+        except (UnicodeDecodeError, AttributeError):
+            return body
+
+    def mark_dead(self, connection):
+        # it's only called when request failed with error which can be retried
+        if self.metrics is not None:
+            self.metrics.retryable_failures.inc(prefix=self.prefix)
+        super(ElasticTransport, self).mark_dead(connection)
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        opaque_id = instrumentation.get_opaque_id()
+        if opaque_id is not None:
+            headers = dict(headers or {})
+            headers.setdefault(instrumentation.OPAQUE_ID_HEADER, opaque_id)
+
+        metrics = self.metrics
+        if metrics is None:
+            return self._perform_request(method, url, headers, params, body)
+
+        if body is not None and url.endswith('_bulk'):
+            body = self._encode(body)
+            metrics.bulk_bytes.inc(len(body), prefix=self.prefix)
+
+        metrics.in_flight.inc(prefix=self.prefix)
+        try:
+            return self._perform_request(method, url, headers, params, body)
+        finally:
+            metrics.in_flight.dec(prefix=self.prefix)
+
+    def _perform_request(self, method, url, headers, params, body):
+        if not instrumentation.is_enabled():
+            return super(ElasticTransport, self).perform_request(method, url, headers, params, body)
+
+        # get body size before sending
+        if body is not None:
+            body = self._encode(body)
+
+        opaque_id = headers.get(instrumentation.OPAQUE_ID_HEADER) if headers else None
+        timer = instrumentation.RequestTimer(method, url, body, opaque_id)
+        try:
+            data = super(ElasticTransport, self).perform_request(method, url, headers, params, body)
+        except Exception as e:
+            timer.finish(error=e)
+            raise
+        timer.finish(data)
+        return data
+
+
+class KeepAlivePoolMixin(object):
+    """Connection pool mixin closing connections idle for more than ``keep_alive`` seconds before reuse."""
+
+    def __init__(self, *args, **kwargs):
+        self.keep_alive = kwargs.pop('keep_alive')
+        super(KeepAlivePoolMixin, self).__init__(*args, **kwargs)
+
+    def _get_conn(self, timeout=None):
+        conn = super(KeepAlivePoolMixin, self)._get_conn(timeout)
+        idle_since = getattr(conn, 'idle_since', None)
+        if idle_since is not None and time.time() - idle_since > self.keep_alive:
+            conn.close()
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.idle_since = time.time()
+        super(KeepAlivePoolMixin, self)._put_conn(conn)
+
+
+_keep_alive_pools = {}
+
+
+def get_keep_alive_pool_class(pool_class):
+    """Get ``pool_class`` subclass with :class:`KeepAlivePoolMixin`."""
+    if pool_class not in _keep_alive_pools:
+        _keep_alive_pools[pool_class] = type('KeepAlive' + pool_class.__name__, (KeepAlivePoolMixin, pool_class), {})
+    return _keep_alive_pools[pool_class]
+
+
+#: arguments ``Urllib3HttpConnection`` passes to https pool on top of connection kwargs
+HTTPS_POOL_ARGS = ('key_file', 'cert_file', 'cert_reqs', 'ca_certs', 'ssl_version', 'assert_hostname',
+                   'assert_fingerprint')
+
+
+def build_keep_alive_pool(pool, keep_alive):
+    """Build pool with :class:`KeepAlivePoolMixin` using same arguments as ``pool``, which is closed."""
+    kwargs = dict(pool.conn_kw)
+    kwargs.update((name, getattr(pool, name)) for name in HTTPS_POOL_ARGS if hasattr(pool, name))
+    pool_class = get_keep_alive_pool_class(type(pool))
+    keep_alive_pool = pool_class(pool.host, port=pool.port, timeout=pool.timeout, maxsize=pool.pool.maxsize,
+                                 keep_alive=keep_alive, **kwargs)
+    pool.close()
+    return keep_alive_pool
+
+
+class ElasticConnection(Urllib3HttpConnection):
+    """Urllib3 connection which can close pooled connections idle for more than ``keep_alive`` seconds.
+
+    With :func:`max_response_bytes` set responses are streamed and reading stops once they exceed it.
+
+    Set keep alive lower than idle timeout of elastic or proxy in front of it, so requests
+    are not sent over connections already closed by the other side.
+    """
+
+    def __init__(self, host='localhost', port=9200, keep_alive=None, **kwargs):
+        super(ElasticConnection, self).__init__(host=host, port=port, **kwargs)
+        if keep_alive is not None:
+            # pool is built by parent, replace it before it's used
+            self.pool = build_keep_alive_pool(self.pool, keep_alive)
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        """Perform request, response is streamed and rejected once it exceeds :func:`max_response_bytes`."""
+        limit = getattr(_local, 'max_response_bytes', None)
+        if limit is None:
+            return super(ElasticConnection, self).perform_request(method, url, params, body, timeout, ignore, headers)
+
+        url = self.url_prefix + url
+        if params:
+            url = '%s?%s' % (url, urlencode(params))
+        full_url = self.host + url
+
+        request_headers = self.headers
+        if headers:
+            request_headers = request_headers.copy()
+            request_headers.update(headers)
+        if self.http_compress and body:
+            body = gzip.compress(body)
+        kw = {'timeout': timeout} if timeout else {}
+
+        start = time.time()
+        try:
+            response = self.pool.urlopen(method, url, body, retries=Retry(False), headers=request_headers,
+                                         preload_content=False, **kw)
+            try:
+                raw_data = read_limited(response, limit).decode('utf-8')
+            finally:
+                response.release_conn()
+            duration = time.time() - start
+        except ResponseTooLarge:
+            raise
+        except Exception as e:
+            self.log_request_fail(method, full_url, url, body, time.time() - start, exception=e)
+            if isinstance(e, UrllibSSLError):
+                raise SSLError('N/A', str(e), e)
+            if isinstance(e, ReadTimeoutError):
+                raise ConnectionTimeout('TIMEOUT', str(e), e)
+            raise ConnectionError('N/A', str(e), e)
+
+        if not (200 <= response.status < 300) and response.status not in ignore:
+            self.log_request_fail(method, full_url, url, body, duration, response.status, raw_data)
+            self._raise_error(response.status, raw_data)
+
+        self.log_request_success(method, full_url, url, body, response.status, raw_data, duration)
+        return response.status, response.getheaders(), raw_data
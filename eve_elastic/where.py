@@ -0,0 +1,170 @@
+"""Translation of mongo like ``where`` into elastic filter clauses.
+
+Supported are field values and ``$eq``, ``$ne``, ``$in``, ``$nin``, ``$gt``, ``$gte``,
+``$lt``, ``$lte``, ``$exists``, ``$regex``, ``$all`` and ``$not`` operators, fields can
+be combined using ``$and``, ``$or`` and ``$nor``::
+
+    >>> translate_where({'uri': {'$in': ['a', 'b']}, 'count': {'$gte': 5, '$lt': 10}})
+    {'bool': {'filter': [{'terms': {'uri': ['a', 'b']}}, {'range': {'count': {'gte': 5, 'lt': 10}}}]}}
+
+``where`` can be json or python like expression parsed by eve. Translations are
+cached by :class:`WhereTranslator`.
+"""
+
+import json
+import threading
+
+from copy import deepcopy
+from collections import OrderedDict
+from eve.io.mongo.parser import parse
+
+
+RANGE_OPERATORS = {'$gt': 'gt', '$gte': 'gte', '$lt': 'lt', '$lte': 'lte'}
+
+
+def translate_where(where):
+    """Get filter clause for mongo like query, raises ``ValueError`` for unsupported operators.
+
+    :param where: mongo query dict
+    """
+    if not isinstance(where, dict):
+        raise ValueError('where must be an object')
+    clauses = []
+    for key, value in where.items():
+        if key in ('$and', '$or', '$nor'):
+            if not isinstance(value, list) or not value:
+                raise ValueError('%s must be non empty list' % key)
+            clauses.append(_combine(key, [translate_where(item) for item in value]))
+        elif key.startswith('$'):
+            raise ValueError('unsupported operator %s' % key)
+        else:
+            clauses.extend(_translate_field(key, value))
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'bool': {'filter': clauses}}
+
+
+def _combine(operator, clauses):
+    if operator == '$and':
+        return clauses[0] if len(clauses) == 1 else {'bool': {'filter': clauses}}
+    elif operator == '$or':
+        return clauses[0] if len(clauses) == 1 else {'bool': {'should': clauses, 'minimum_should_match': 1}}
+    return {'bool': {'must_not': clauses}}
+
+
+def _is_operators(value):
+    """Test if dict value contains operators, raises ``ValueError`` if it's empty or mixes them with fields."""
+    if not value:
+        raise ValueError('empty object is not supported')
+    operators = [key.startswith('$') for key in value]
+    if any(operators) and not all(operators):
+        raise ValueError('operators can not be mixed with fields')
+    return operators[0]
+
+
+def _regexp(pattern, options):
+    """Get ``regexp`` pattern matching like mongo ``$regex``, elastic anchors it to the whole value."""
+    if not isinstance(pattern, str):
+        raise ValueError('$regex must be a string')
+    if options:
+        raise ValueError('unsupported $options %s' % options)
+    start = pattern.startswith('^')
+    escapes = len(pattern[:-1]) - len(pattern[:-1].rstrip('\\'))
+    end = pattern.endswith('$') and escapes % 2 == 0
+    body = pattern[1 if start else 0:-1 if end else None]
+    if '|' in body and (start or end):
+        raise ValueError('anchored $regex with alternation is not supported')
+    if '|' in body:
+        body = '(%s)' % body
+    return ('' if start else '.*') + body + ('' if end else '.*')
+
+
+def _translate_field(field, value):
+    """Get list of clauses for field value."""
+    if isinstance(value, dict) and _is_operators(value):
+        return _translate_operators(field, value)
+    elif isinstance(value, dict):
+        # embedded document, match its fields
+        clauses = []
+        for key, subvalue in value.items():
+            clauses.extend(_translate_field('%s.%s' % (field, key), subvalue))
+        return clauses
+    return [_equals(field, value)]
+
+
+def _equals(field, value):
+    if value is None:
+        return {'bool': {'must_not': [{'exists': {'field': field}}]}}
+    elif isinstance(value, list):
+        return {'terms': {field: value}}
+    return {'term': {field: value}}
+
+
+def _translate_operators(field, operators):
+    clauses = []
+    must_not = []
+    bounds = {}
+    for operator, value in operators.items():
+        if operator in RANGE_OPERATORS:
+            bounds[RANGE_OPERATORS[operator]] = value
+        elif operator == '$eq':
+            clauses.append(_equals(field, value))
+        elif operator == '$ne':
+            must_not.append(_equals(field, value))
+        elif operator in ('$in', '$nin', '$all'):
+            if not isinstance(value, list):
+                raise ValueError('%s must be a list' % operator)
+            if operator == '$in':
+                clauses.append({'terms': {field: value}})
+            elif operator == '$nin':
+                must_not.append({'terms': {field: value}})
+            else:
+                clauses.extend({'term': {field: item}} for item in value)
+        elif operator == '$exists':
+            (clauses if value else must_not).append({'exists': {'field': field}})
+        elif operator == '$regex':
+            clauses.append({'regexp': {field: _regexp(value, operators.get('$options'))}})
+        elif operator == '$not':
+            must_not.extend(_translate_field(field, value))
+        elif operator != '$options' or '$regex' not in operators:
+            raise ValueError('unsupported operator %s' % operator)
+    if bounds:
+        clauses.append({'range': {field: bounds}})
+    if must_not:
+        clauses.append({'bool': {'must_not': must_not}})
+    return clauses
+
+
+class WhereTranslator(object):
+    """Translate ``where`` param into elastic filter clause.
+
+    Translations are kept in LRU cache of ``max_size`` items, copy is returned
+    so it can be modified by caller.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.translations = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __call__(self, where):
+        """Get filter clause for json or python like expression.
+
+        Raises ``ValueError`` if it can't be parsed or translated.
+        """
+        with self.lock:
+            if where in self.translations:
+                self.translations.move_to_end(where)
+                return deepcopy(self.translations[where])
+
+        try:
+            query = json.loads(where)
+        except ValueError:
+            query = parse(where)
+        clause = translate_where(query)
+
+        with self.lock:
+            self.translations[where] = clause
+            while len(self.translations) > self.max_size:
+                self.translations.popitem(last=False)
+        return deepcopy(clause)
@@ -21,6 +21,7 @@ setup(
     author_email='petr.jasek@sourcefabric.org',
     url='https://github.com/petrjasek/eve-elastic',
     packages=['eve_elastic'],
+    python_requires='>=3.7',
     test_suite='test.test_elastic',
     tests_require=['nose', 'flake8'],
     install_requires=[
@@ -30,6 +31,16 @@ setup(
         'ElasticSearch>=6.0.0, <=6.4.0',
         'Eve>=0.4',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'orjson': ['orjson'],
+        'async': ['aiohttp>=3.0'],
+    },
+    entry_points={
+        'console_scripts': [
+            'eve-elastic = eve_elastic.dump:main',
+        ],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
@@ -38,6 +49,7 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
     ],
 )
@@ -1,19 +1,39 @@
 # -*- coding: utf-8 -*-
 
+import io
+import os
+import csv
+import asyncio
 import eve
+import gzip
 import time
+import arrow
+import tempfile
+import urllib3
+import threading
 import elasticsearch
+import elasticsearch.helpers
 from unittest import TestCase
 from datetime import datetime
+from decimal import Decimal
 from copy import deepcopy
 from flask import json
 from eve.utils import config, ParsedRequest, parse_request
-from eve_elastic.elastic import parse_date, Elastic, get_indices, get_es, generate_index_name
+from eve_elastic import clients, fake, helpers, instrumentation, metrics, serializer, slowlog, transport
+from eve_elastic.aio import AsyncElastic
+from eve_elastic.dump import export_resource, import_resource
+from eve_elastic.cache import TTLCache
+from eve_elastic.loader import BatchLoader
+from eve_elastic.where import WhereTranslator, translate_where
+from eve_elastic.elastic import parse_date, Elastic, get_indices, get_es, generate_index_name, \
+    get_bucket_count, count_buckets, compile_transform, DateParser
 from nose.tools import raises
+from werkzeug.exceptions import BadRequest
+from bson import ObjectId
 try:
-    from unittest.mock import MagicMock
+    from unittest.mock import MagicMock, patch
 except ImportError:
-    from mock import MagicMock
+    from mock import MagicMock, patch
 
 
 def highlight_callback(query_string):
@@ -665,6 +685,43 @@ class TestElastic(TestCase):
             self.assertNotIn('retry_on_conflict', update_mock.call_args[1])
             self.app.data.elastic('items').update = original_method
 
+    def test_export_resource(self):
+        with self.app.app_context():
+            self.app.data.insert('items', [
+                {'uri': 'foo', 'firstcreated': '2012-10-10T11:12:13+0000'},
+                {'uri': 'bar'},
+            ])
+
+            path = os.path.join(tempfile.mkdtemp(), 'items')
+            files = export_resource(self.app.data, 'items', path, slices=2)
+            docs = []
+            for filename in files:
+                with gzip.open(filename) as f:
+                    docs.extend(json.loads(line) for line in f.read().decode('utf-8').splitlines())
+            self.assertEqual(['bar', 'foo'], sorted(doc['uri'] for doc in docs))
+            self.assertIn('2012-10-10T11:12:13+00:00', [doc.get('firstcreated') for doc in docs])
+
+            files = export_resource(self.app.data, 'items', path, format='csv', compression=None,
+                                    fields=['_id', 'uri'])
+            with open(files[0]) as f:
+                rows = list(csv.reader(f))
+            self.assertEqual(['_id', 'uri'], rows[0])
+            self.assertEqual(3, len(rows))
+
+    def test_import_resource(self):
+        with self.app.app_context():
+            self.app.data.insert('items', [{'_id': 'foo', 'uri': 'foo'}, {'_id': 'bar', 'uri': 'bar'}])
+            path = os.path.join(tempfile.mkdtemp(), 'items')
+            files = export_resource(self.app.data, 'items', path, compression=None)
+            self.app.data.remove('items', {'_id': 'foo'})
+            self.app.data.remove('items', {'_id': 'bar'})
+            self.assertTrue(self.app.data.is_empty('items'))
+
+            success, errors = import_resource(self.app.data, 'items', files[0])
+            self.assertEqual(2, success)
+            self.assertEqual([], errors)
+            self.assertEqual('foo', self.app.data.find_one('items', req=None, _id='foo')['uri'])
+
 
 class TestElasticSearchWithSettings(TestCase):
     """ As for ES 6.0 indeces cannot be created when fields are mapped that contain
@@ -1198,3 +1255,1353 @@ class TestElasticPrefix(TestCase):
             req = parse_request('persons')
             cursor = self.app.data.find('persons', req, None)
             self.assertEquals(0, cursor.count())
+
+
+class TestScan(TestCase):
+
+    def get_client(self, version, pages):
+        client = MagicMock()
+        client.info.return_value = {'version': {'number': version}}
+        client.search.return_value = pages[0]
+        client.scroll.side_effect = pages[1:]
+        return client
+
+    def page(self, ids, scroll_id='scroll', failed=0):
+        return {
+            '_scroll_id': scroll_id,
+            '_shards': {'total': 5, 'failed': failed},
+            'hits': {'hits': [{'_id': _id} for _id in ids]},
+        }
+
+    def test_scan_sorts_by_doc_and_clears_scroll(self):
+        client = self.get_client('6.4.0', [self.page(['a', 'b']), self.page(['c']), self.page([])])
+        hits = list(helpers.scan(client, {'query': {'match_all': {}}}, index='items'))
+        self.assertEqual(['a', 'b', 'c'], [hit['_id'] for hit in hits])
+        self.assertEqual(['_doc'], client.search.call_args[1]['body']['sort'])
+        self.assertNotIn('search_type', client.search.call_args[1])
+        client.clear_scroll.assert_called_once_with(body={'scroll_id': ['scroll']}, ignore=(404, ))
+
+    def test_scan_clears_scroll_on_close(self):
+        client = self.get_client('6.4.0', [self.page(['a', 'b']), self.page(['c'])])
+        hits = helpers.scan(client, index='items')
+        next(hits)
+        hits.close()
+        self.assertEqual(1, client.clear_scroll.call_count)
+
+    def test_scan_reports_shard_failures_after_all_hits(self):
+        client = self.get_client('6.4.0', [self.page(['a'], failed=1), self.page(['b']), self.page([])])
+        hits = helpers.scan(client, index='items')
+        self.assertEqual('a', next(hits)['_id'])
+        self.assertEqual('b', next(hits)['_id'])
+        self.assertRaises(helpers.ScanError, next, hits)
+        self.assertEqual(1, client.clear_scroll.call_count)
+
+        client = self.get_client('6.4.0', [self.page(['a'], failed=1), self.page([])])
+        self.assertEqual(1, len(list(helpers.scan(client, index='items', raise_on_error=False))))
+
+    def test_scan_uses_search_type_scan_on_old_cluster(self):
+        client = self.get_client('1.7.5', [self.page([]), self.page(['a']), self.page([])])
+        hits = list(helpers.scan(client, index='items'))
+        self.assertEqual(1, len(hits))
+        self.assertEqual('scan', client.search.call_args[1]['search_type'])
+
+    def test_scan_caches_version_per_client(self):
+        client = self.get_client('6.4.0', [self.page([])])
+        list(helpers.scan(client, index='items'))
+        client.search.return_value = self.page([])
+        list(helpers.scan(client, index='items'))
+        self.assertEqual(1, client.info.call_count)
+        self.assertEqual(2, client.search.call_count)
+
+    def test_scan_uses_point_in_time(self):
+        client = MagicMock()
+        client.info.return_value = {'version': {'number': '7.12.0'}}
+        client.transport.perform_request.return_value = {'id': 'pit1'}
+        pages = [
+            {'pit_id': 'pit2', 'hits': {'hits': [{'_id': 'a', 'sort': [1]}, {'_id': 'b', 'sort': [2]}]}},
+            {'pit_id': 'pit3', 'hits': {'hits': [{'_id': 'c', 'sort': [3]}]}},
+        ]
+        bodies = []
+
+        def search(body, **kwargs):
+            bodies.append(dict(body))
+            return pages[len(bodies) - 1]
+
+        client.search.side_effect = search
+        hits = list(helpers.scan(client, {'query': {'match_all': {}}}, index='items', doc_type='item', size=2))
+        self.assertEqual(['a', 'b', 'c'], [hit['_id'] for hit in hits])
+        self.assertNotIn('index', client.search.call_args[1])
+        self.assertNotIn('doc_type', client.search.call_args[1])
+        self.assertEqual([{'_shard_doc': 'asc'}], bodies[0]['sort'])
+        self.assertEqual({'id': 'pit1', 'keep_alive': '5m'}, bodies[0]['pit'])
+        self.assertNotIn('search_after', bodies[0])
+        self.assertEqual({'id': 'pit2', 'keep_alive': '5m'}, bodies[1]['pit'])
+        self.assertEqual([2], bodies[1]['search_after'])
+        client.transport.perform_request.assert_any_call('POST', '/items/_pit', params={'keep_alive': '5m'})
+        client.transport.perform_request.assert_called_with('DELETE', '/_pit', body={'id': 'pit3'},
+                                                            params={'ignore': 404})
+        client.scroll.assert_not_called()
+
+    def test_scan_closes_point_in_time_on_close(self):
+        client = MagicMock()
+        client.info.return_value = {'version': {'number': '7.12.0'}}
+        client.transport.perform_request.return_value = {'id': 'pit1'}
+        client.search.return_value = {'hits': {'hits': [{'_id': 'a', 'sort': [1]}, {'_id': 'b', 'sort': [2]}]}}
+        hits = helpers.scan(client, index='items', size=2)
+        next(hits)
+        hits.close()
+        client.transport.perform_request.assert_called_with('DELETE', '/_pit', body={'id': 'pit1'},
+                                                            params={'ignore': 404})
+
+    def test_parallel_scan(self):
+        client = self.get_client('6.4.0', [self.page([])])
+
+        def search(body, **kwargs):
+            slice_id = body['slice']['id']
+            return self.page(['%d-%d' % (slice_id, i) for i in range(3)], scroll_id='s%d' % slice_id)
+
+        client.search.side_effect = search
+        client.scroll.side_effect = None
+        client.scroll.return_value = self.page([])
+        hits = list(helpers.parallel_scan(client, index='items', slices=3))
+        self.assertEqual(9, len(hits))
+        self.assertEqual(set('%d-%d' % (s, i) for s in range(3) for i in range(3)), set(h['_id'] for h in hits))
+        self.assertEqual(1, client.info.call_count)
+        self.assertEqual({0, 1, 2}, set(call[1]['body']['slice']['id'] for call in client.search.call_args_list))
+        self.assertEqual(3, client.clear_scroll.call_count)
+
+    def test_parallel_scan_raises_worker_error(self):
+        client = self.get_client('6.4.0', [self.page([])])
+
+        def search(body, **kwargs):
+            if body['slice']['id'] == 1:
+                raise elasticsearch.TransportError(500, 'error')
+            return self.page(['a', 'b'])
+
+        client.search.side_effect = search
+        client.scroll.side_effect = None
+        client.scroll.return_value = self.page(['c', 'd'])  # never ending scroll
+        hits = helpers.parallel_scan(client, index='items', slices=3, queue_size=2)
+        with self.assertRaises(elasticsearch.TransportError):
+            for hit in hits:
+                pass
+        # other slices were stopped and released their scroll
+        self.assertEqual(2, client.clear_scroll.call_count)
+
+
+class TestNdjsonBulk(TestCase):
+
+    def test_chunk_ndjson(self):
+        buffer = b'{"a":1}\n{"a":2}\n{"a":3}'
+        chunks = list(helpers._chunk_ndjson(buffer, 2, 1000))
+        self.assertEqual([2, 1], [count for count, body in chunks])
+        self.assertEqual(b'{"index":{}}\n{"a":1}\n{"index":{}}\n{"a":2}\n', chunks[0][1])
+        self.assertEqual(b'{"index":{}}\n{"a":3}\n', chunks[1][1])
+
+    def test_chunk_ndjson_by_size_with_ids(self):
+        buffer = b'{"_id":"foo","a":1}\n{"_id":"bar"}\n'
+        chunks = list(helpers._chunk_ndjson(buffer, 500, 10, op_type='create', id_prefix=True))
+        self.assertEqual(2, len(chunks))
+        self.assertEqual(b'{"create":{"_id":"foo"}}\n{"a":1}\n', chunks[0][1])
+        self.assertEqual(b'{"create":{"_id":"bar"}}\n{}\n', chunks[1][1])
+
+    def test_chunk_ndjson_skips_blank_lines(self):
+        buffer = b'{"a":1}\n\n  \n{"a":2}\n'
+        chunks = list(helpers._chunk_ndjson(buffer, 500, 1000))
+        self.assertEqual([(2, b'{"index":{}}\n{"a":1}\n{"index":{}}\n{"a":2}\n')], chunks)
+
+    def test_ndjson_bulk_reads_chunks_lazily(self):
+        path = os.path.join(tempfile.mkdtemp(), 'items.ndjson')
+        with open(path, 'wb') as f:
+            f.write(b''.join(b'{"a":%d}\n' % i for i in range(200)))
+        chunks = []
+        sent = []
+        _chunk_ndjson = helpers._chunk_ndjson
+
+        def chunk_ndjson(*args):
+            for chunk in _chunk_ndjson(*args):
+                chunks.append(chunk)
+                yield chunk
+
+        def process_bulk_body(client, count, body, *args, **kwargs):
+            time.sleep(0.005)
+            sent.append(body)
+            return [(True, {'index': {}})] * count
+
+        with patch.object(helpers, '_chunk_ndjson', chunk_ndjson), \
+                patch.object(helpers, '_process_bulk_body', process_bulk_body):
+            results = helpers.ndjson_bulk(None, path, chunk_size=1, thread_count=2)
+            next(results)
+            self.assertLessEqual(len(chunks), 5)
+            results.close()
+            self.assertLess(len(sent), 10)
+            self.assertEqual(200, len(list(helpers.ndjson_bulk(None, path, chunk_size=1, thread_count=2))))
+
+
+class CannedConnection(elasticsearch.Connection):
+    """Connection returning same response for every request."""
+
+    response = {'took': 3, 'hits': {'total': 1, 'hits': [{'_id': 'foo', '_source': {'name': 'foo'}}]}}
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        return 200, {}, json.dumps(self.response)
+
+
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        self.app = eve.Eve(settings={'DOMAIN': DOMAIN, 'FOO_URL': 'http://localhost:9200'}, data=Elastic)
+        self.app.data.kwargs['connection_class'] = CannedConnection
+        self.events = []
+        instrumentation.subscribe(self.events.append)
+
+    def tearDown(self):
+        instrumentation.unsubscribe(self.events.append)
+
+    def test_find_emits_request_and_operation_events(self):
+        with self.app.app_context():
+            req = ParsedRequest()
+            req.args = {}
+            self.app.data.find('items', req, None)
+
+        self.assertEqual([instrumentation.REQUEST, instrumentation.OPERATION], [e.kind for e in self.events])
+        request, operation = self.events
+        self.assertEqual(('items', 'find', 'items'), (request.resource, request.operation, request.index))
+        self.assertEqual(3, operation.took)
+        self.assertEqual(1, operation.hits)
+        self.assertEqual(1, operation.requests)
+        self.assertGreater(operation.request_bytes, 0)
+        self.assertGreater(operation.response_bytes, 0)
+        self.assertGreaterEqual(operation.duration, request.duration)
+
+    def test_histogram_collector(self):
+        collector = instrumentation.HistogramCollector()
+        instrumentation.subscribe(collector)
+        try:
+            with self.app.app_context():
+                self.app.data.find_one('items', req=None, _id='foo')
+        finally:
+            instrumentation.unsubscribe(collector)
+        self.assertEqual(1, collector.snapshot()[('items', 'find_one')]['count'])
+
+
+class TestSlowQueryLog(TestCase):
+
+    def test_fingerprint_ignores_values_and_key_order(self):
+        query_a = {'query': {'bool': {'filter': [{'term': {'uri': 'foo'}}, {'terms': {'tag': ['a', 'b']}}]}},
+                   'size': 25}
+        query_b = {'size': 10, 'query': {'bool': {'filter': [{'term': {'uri': 'bar'}}, {'terms': {'tag': ['c']}}]}}}
+        self.assertEqual(slowlog.fingerprint(query_a), slowlog.fingerprint(query_b))
+        self.assertNotEqual(slowlog.fingerprint(query_a), slowlog.fingerprint({'query': {'match_all': {}}}))
+
+    def test_slow_find_is_recorded(self):
+        app = eve.Eve(settings={'DOMAIN': DOMAIN, 'FOO_URL': 'http://localhost:9200'}, data=Elastic)
+        app.data.kwargs['connection_class'] = CannedConnection
+        app.config['ELASTICSEARCH_SLOW_QUERY_THRESHOLD'] = 0
+        with app.app_context():
+            req = ParsedRequest()
+            req.args = {'q': 'foo'}
+            app.data.find('items', req, None)
+            req.args = {'q': 'bar'}
+            app.data.find('items', req, None)
+
+        top = app.data.slow_queries.top()
+        self.assertEqual(1, len(top))
+        self.assertEqual(2, top[0][1]['count'])
+        self.assertEqual(6, top[0][1]['took'])
+        self.assertNotIn('foo', top[0][1]['query'])
+
+
+class TestProfile(TestCase):
+
+    profile = {'shards': [{
+        'id': '[node][items][0]',
+        'searches': [{
+            'query': [{'type': 'TermQuery', 'description': 'uri:foo', 'time_in_nanos': 2000000}],
+            'rewrite_time': 1000000,
+            'collector': [{'name': 'SimpleTopScoreDocCollector', 'time_in_nanos': 500000}],
+        }],
+        'aggregations': [{'type': 'TermsAggregator', 'time_in_nanos': 3000000}],
+    }]}
+
+    def setUp(self):
+        self.app = eve.Eve(settings={'DOMAIN': DOMAIN, 'FOO_URL': 'http://localhost:9200'}, data=Elastic)
+
+    def test_should_profile(self):
+        with self.app.app_context():
+            req = ParsedRequest()
+            req.args = {'profile': 1}
+            self.assertFalse(self.app.data.should_profile(req))
+            self.app.config['ELASTICSEARCH_PROFILE'] = True
+            self.assertTrue(self.app.data.should_profile(req))
+            req.args = {'profile': '0'}
+            self.assertFalse(self.app.data.should_profile(req))
+
+    def test_profile_summary_in_extra(self):
+        self.app.config['ELASTICSEARCH_PROFILE'] = True
+        search = MagicMock(return_value={'hits': {'total': 0, 'hits': []}, 'profile': self.profile})
+        with self.app.app_context():
+            self.app.data.elastic('items').search = search
+            req = ParsedRequest()
+            req.args = {'profile': 1, 'q': 'foo'}
+            cursor = self.app.data.find('items', req, None)
+
+        self.assertTrue(search.call_args[1]['body']['profile'])
+        response = {}
+        cursor.extra(response)
+        shard = response['_profile']['shards'][0]
+        self.assertEqual(2.0, shard['query'])
+        self.assertEqual(1.0, shard['rewrite'])
+        self.assertEqual(0.5, shard['collector'])
+        self.assertEqual(3.0, shard['aggregations'])
+        self.assertEqual('TermQuery', shard['queries'][0]['type'])
+        self.assertEqual(search.call_args[1]['body'], response['_profile']['body'])
+
+
+def create_fake_app(data=Elastic, **settings):
+    """Create app using fake cluster for both default and ``FOO`` prefix."""
+    fake.reset_clusters()
+    app_settings = {
+        'DOMAIN': DOMAIN,
+        'ELASTICSEARCH_URL': 'fake://localhost:9200',
+        'ELASTICSEARCH_INDEX': 'fake_index',
+        'FOO_URL': 'fake://localhost:9200',
+        'FOO_INDEX': 'fake_foo',
+    }
+    app_settings.update(settings)
+    return eve.Eve(settings=app_settings, data=data)
+
+
+class FakeAppTestCase(TestCase):
+    """Test case with app using fake cluster, set ``settings`` for extra config."""
+
+    settings = {}
+    data_layer = Elastic
+
+    def setUp(self):
+        self.app = create_fake_app(self.data_layer, **self.settings)
+        self.cluster = fake.get_cluster('localhost', 9200)
+        if self.data_layer is Elastic:
+            with self.app.app_context():
+                self.app.data.init_index()
+
+
+class TestFakeConnection(FakeAppTestCase):
+
+    def test_crud(self):
+        with self.app.app_context():
+            ids = self.app.data.insert('items', [{'uri': 'foo', 'name': 'Foo bar'}, {'uri': 'bar', 'name': 'baz'}])
+            self.assertEqual('Foo bar', self.app.data.find_one('items', None, _id=ids[0])['name'])
+
+            req = ParsedRequest()
+            req.args = {'q': 'foo'}
+            self.assertEqual(1, self.app.data.find('items', req, None).count())
+            req.args = {'filter': json.dumps({'term': {'uri': 'bar'}})}
+            self.assertEqual(ids[1], self.app.data.find('items', req, None)[0]['_id'])
+
+            self.app.data.update('items', ids[0], {'name': 'updated'}, {})
+            self.assertEqual('updated', self.app.data.find_one('items', None, _id=ids[0])['name'])
+            self.app.data.remove('items', {'_id': ids[1]})
+            self.assertIsNone(self.app.data.find_one('items', None, _id=ids[1]))
+
+    def test_bulk_with_injected_failures(self):
+        cluster = fake.get_cluster('localhost', 9200)
+        cluster.fail_next(2, status=429)
+        with self.app.app_context():
+            es = self.app.data.elastic('items')
+            actions = ({'_index': 'fake_foo', '_type': 'doc', '_id': str(i), 'uri': str(i)} for i in range(10))
+            results = list(elasticsearch.helpers.streaming_bulk(es, actions, chunk_size=4, max_retries=3,
+                                                                initial_backoff=0))
+            self.assertTrue(all(ok for ok, item in results))
+            self.assertEqual(10, es.count(index='fake_foo')['count'])
+
+            cluster.fail_next(1, timeout=True)
+            with self.assertRaises(elasticsearch.ConnectionTimeout):
+                es.count(index='fake_foo')
+
+    def test_query_matching(self):
+        doc = {'_id': '1', '_source': {'uri': 'foo', 'count': 5, 'name': 'Foo Bar', 'tags': ['a', 'b']}}
+        self.assertTrue(fake.matches(doc, {'bool': {
+            'must': [{'query_string': {'query': 'bar', 'default_operator': 'AND'}}],
+            'filter': [{'terms': {'tags': ['b', 'c']}}, {'range': {'count': {'gte': 5, 'lt': 10}}}],
+            'must_not': [{'exists': {'field': 'missing'}}],
+        }}))
+        self.assertFalse(fake.matches(doc, {'bool': {
+            'should': [{'term': {'uri': 'bar'}}, {'ids': {'values': ['2']}}],
+        }}))
+        self.assertTrue(fake.matches(doc, translate_where({'name': {'$regex': 'Bar$'}})))
+        self.assertFalse(fake.matches(doc, translate_where({'name': {'$regex': '^Bar'}})))
+
+    def test_sliced_search(self):
+        with self.app.app_context():
+            self.app.data.insert('items', [{'uri': str(i)} for i in range(10)])
+            es = self.app.data.elastic('items')
+            index = self.app.data._resource_index('items')
+            uris = []
+            for slice_id in range(3):
+                body = {'query': {'match_all': {}}, 'size': 10, 'slice': {'id': slice_id, 'max': 3}}
+                uris.extend(hit['_source']['uri'] for hit in es.search(index=index, body=body)['hits']['hits'])
+            self.assertEqual([str(i) for i in range(10)], sorted(uris, key=int))
+
+            with self.assertRaises(elasticsearch.RequestError):
+                es.search(index=index, body={'query': {'match_all': {}}, 'post_filter': {}})
+
+    def test_export_slices(self):
+        with self.app.app_context():
+            self.app.data.insert('items', [{'uri': 'foo'}, {'uri': 'bar'}])
+            files = export_resource(self.app.data, 'items', os.path.join(tempfile.mkdtemp(), 'items'), slices=2)
+            docs = []
+            for filename in files:
+                with gzip.open(filename) as f:
+                    docs.extend(json.loads(line) for line in f.read().decode('utf-8').splitlines())
+            self.assertEqual(['bar', 'foo'], sorted(doc['uri'] for doc in docs))
+
+
+class TestMetrics(TestCase):
+
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = registry.counter('docs_total', 'Docs.', ('resource', ))
+        counter.inc(2, resource='items')
+        counter.inc(resource='a"b')
+        registry.gauge('in_flight', 'In flight.').set(1.5)
+        self.assertIs(counter, registry.counter('docs_total', 'Docs.', ('resource', )))
+        self.assertEqual('\n'.join([
+            '# HELP docs_total Docs.',
+            '# TYPE docs_total counter',
+            'docs_total{resource="a\\"b"} 1',
+            'docs_total{resource="items"} 2',
+            '# HELP in_flight In flight.',
+            '# TYPE in_flight gauge',
+            'in_flight 1.5',
+        ]) + '\n', registry.render())
+
+    def test_data_layer_metrics(self):
+        app = create_fake_app(ELASTICSEARCH_BULK_MAX_RETRIES=1, ELASTICSEARCH_METRICS_URL='/metrics')
+        app.data.metrics = metrics.DataLayerMetrics(metrics.Registry())
+        data_metrics = app.data.metrics
+        with app.app_context():
+            app.data.init_index()
+            fake.get_cluster('localhost', 9200).reject_next_items(2)
+            app.data.bulk_insert('items', [{'uri': str(i)} for i in range(5)], initial_backoff=0)
+            req = ParsedRequest()
+            req.args = {}
+            app.data.find('items', req, None)
+
+        self.assertEqual(5, data_metrics.docs_indexed.get(resource='items'))
+        self.assertEqual(2, data_metrics.docs_retried.get(resource='items'))
+        self.assertEqual(0, data_metrics.docs_failed.get(resource='items'))
+        self.assertEqual(1, data_metrics.searches.get(resource='items'))
+        self.assertEqual(5, data_metrics.hits.get(resource='items'))
+        self.assertEqual(1, data_metrics.refreshes.get(resource='items'))
+        self.assertLess(0, data_metrics.bulk_bytes.get(prefix='ELASTICSEARCH'))
+        self.assertEqual(0, data_metrics.in_flight.get(prefix='ELASTICSEARCH'))
+
+        response = app.test_client().get('/metrics')
+        self.assertEqual(metrics.CONTENT_TYPE, response.headers['Content-Type'])
+        self.assertIn(b'eve_elastic_docs_indexed_total{resource="items"} 5', response.data)
+
+
+class HeadersConnection(CannedConnection):
+    """Canned connection recording request headers."""
+
+    headers = []
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        self.headers.append(headers or {})
+        return super(HeadersConnection, self).perform_request(method, url, params, body, timeout, ignore, headers)
+
+
+class TestOpaqueId(TestCase):
+
+    def setUp(self):
+        HeadersConnection.headers = []
+        self.app = eve.Eve(settings={'DOMAIN': DOMAIN, 'FOO_URL': 'http://localhost:9200'}, data=Elastic)
+        self.app.data.kwargs['connection_class'] = HeadersConnection
+        self.events = []
+        instrumentation.subscribe(self.events.append)
+
+    def tearDown(self):
+        instrumentation.unsubscribe(self.events.append)
+
+    def test_request_id_header(self):
+        with self.app.test_request_context('/items', headers={'X-Request-Id': 'req-1'}):
+            self.app.data.find_one('items', req=None, _id='foo')
+            self.app.data.find_one('items', req=None, _id='bar')
+
+        self.assertEqual(['req-1', 'req-1'], [h.get('X-Opaque-Id') for h in HeadersConnection.headers])
+        self.assertEqual(['req-1'] * 4, [event.opaque_id for event in self.events])
+
+    def test_generated_per_request(self):
+        for i in range(2):
+            with self.app.test_request_context('/items'):
+                self.app.data.find_one('items', req=None, _id='foo')
+
+        ids = [h.get('X-Opaque-Id') for h in HeadersConnection.headers]
+        self.assertTrue(all(ids))
+        self.assertNotEqual(ids[0], ids[1])
+
+    def test_opaque_id_outside_request(self):
+        with self.app.app_context():
+            self.app.data.find_one('items', req=None, _id='foo')
+            with instrumentation.opaque_id('job-1'):
+                self.app.data.find_one('items', req=None, _id='foo')
+
+        self.assertEqual([None, 'job-1'], [h.get('X-Opaque-Id') for h in HeadersConnection.headers])
+
+
+class TestSearchLimits(TestCase):
+
+    def setUp(self):
+        self.app = eve.Eve(settings={'DOMAIN': DOMAIN, 'FOO_URL': 'http://localhost:9200'}, data=Elastic)
+        self.app.data.kwargs['connection_class'] = CannedConnection
+        self.app.data.metrics = metrics.DataLayerMetrics(metrics.Registry())
+
+    def find(self, max_results=25, page=1, **args):
+        with self.app.app_context():
+            req = ParsedRequest()
+            req.args = args
+            req.max_results = max_results
+            req.page = page
+            return self.app.data.find('items', req, None)
+
+    def test_max_size_and_window(self):
+        self.app.config['ELASTICSEARCH_MAX_SIZE'] = 50
+        self.app.config['ELASTICSEARCH_MAX_RESULT_WINDOW'] = 100
+        self.assertEqual(1, self.find(max_results=50, page=2).count())
+        with self.assertRaises(BadRequest):
+            self.find(max_results=51)
+        with self.assertRaises(BadRequest):
+            self.find(max_results=50, page=3)
+        self.assertEqual(1, self.app.data.metrics.limit_rejections.get(resource='items', limit='max_size'))
+
+    def test_bucket_count(self):
+        aggs = {
+            'type': {'terms': {'field': 'type', 'size': 20}, 'aggs': {'day': {'date_histogram': {'field': 'x'}}}},
+            'source': {'terms': {'field': 'source'}},
+            'ranges': {'range': {'field': 'priority', 'ranges': [{'to': 3}, {'from': 3}]}},
+        }
+        self.assertEqual(20 + 20 + 10 + 2, get_bucket_count(aggs))
+        self.assertEqual(3, count_buckets({
+            'type': {'buckets': [{'key': 'text', 'day': {'buckets': [{'key': 1}]}}, {'key': 'picture'}]},
+            'count': {'value': 5},
+        }))
+
+    def test_max_buckets(self):
+        self.app.config['ELASTICSEARCH_MAX_BUCKETS'] = 10
+        source = {'query': {'filter': {'match_all': {}}}, 'aggs': {'type': {'terms': {'field': 'type', 'size': 11}}}}
+        with self.assertRaises(BadRequest):
+            self.find(source=json.dumps(source))
+
+    def test_max_response_bytes(self):
+        cursor = self.find()
+        size = self.app.data.metrics.max_response_bytes.get(resource='items')
+        self.assertEqual(len(json.dumps(CannedConnection.response)), size)
+        self.assertEqual(1, cursor.count())
+
+        self.app.config['ELASTICSEARCH_MAX_RESPONSE_BYTES'] = size - 1
+        with self.assertRaises(BadRequest):
+            self.find()
+
+
+class TestCompileTransform(TestCase):
+
+    schema = {
+        'name': {'type': 'string'},
+        'count': {'type': 'integer'},
+        'user': {'type': 'objectid'},
+        'embargo': {'type': 'datetime'},
+        'dateline': {'type': 'dict', 'schema': {'date': {'type': 'datetime'}, 'text': {'type': 'string'}}},
+        'schedule': {'type': 'list', 'schema': {'type': 'datetime'}},
+        'versions': {'type': 'list', 'schema': {'type': 'dict', 'schema': {
+            'created': {'type': 'datetime'},
+            'number': {'type': 'integer'},
+        }}},
+    }
+
+    def test_nested_fields(self):
+        transform = compile_transform(self.schema, Elastic.serializers)
+        user = ObjectId()
+        doc = {
+            'name': 'foo',
+            'count': '5',
+            'user': str(user),
+            'embargo': None,
+            'dateline': {'date': '2018-10-10T11:12:13+0000', 'text': 'Prague'},
+            'schedule': ['2018-10-10T11:12:13+0000', '2018-10-11T11:12:13+0000'],
+            'versions': [{'created': '2018-10-10T11:12:13+0000', 'number': 'x'}],
+        }
+        dateline = doc['dateline']
+        self.assertIs(doc, transform(doc))
+        self.assertIs(dateline, doc['dateline'])
+        self.assertEqual(5, doc['count'])
+        self.assertEqual(user, doc['user'])
+        self.assertIsNone(doc['embargo'])
+        self.assertEqual(10, doc['dateline']['date'].day)
+        self.assertEqual([10, 11], [date.day for date in doc['schedule']])
+        self.assertEqual(10, doc['versions'][0]['created'].day)
+        self.assertEqual('x', doc['versions'][0]['number'])
+
+    def test_nothing_to_convert(self):
+        self.assertIsNone(compile_transform({'name': {'type': 'string'}, 'extra': {'type': 'dict'}},
+                                            Elastic.serializers))
+        self.assertIsNone(compile_transform({'tags': {'type': ['string', 'list']}}, Elastic.serializers))
+
+    def test_multiple_types(self):
+        transform = compile_transform({'when': {'type': ['datetime', 'string']}}, Elastic.serializers)
+        self.assertEqual(10, transform({'when': '2018-10-10T11:12:13+0000'})['when'].day)
+        self.assertEqual('soon', transform({'when': 'soon'})['when'])
+        self.assertEqual([1], transform({'when': [1]})['when'])
+
+
+class TestDateParser(TestCase):
+
+    def test_memo(self):
+        parser = DateParser(max_size=2)
+        self.assertEqual(parse_date('2018-10-10T11:12:13+0000'), parser('2018-10-10T11:12:13+0000'))
+        self.assertEqual({}, parser.dates)
+        with patch('eve_elastic.elastic.ciso8601.parse_datetime', side_effect=ValueError):
+            date = parser('2018-10-10T11:12:13+0000')
+            self.assertIs(date, parser('2018-10-10T11:12:13+0000'))
+            parser('2018-10-11T11:12:13+0000')
+            parser('2018-10-12T11:12:13+0000')
+        self.assertEqual(1, len(parser.dates))
+
+    def test_bad_value_skips_arrow(self):
+        parser = DateParser()
+        with patch('eve_elastic.elastic.arrow.get', side_effect=arrow.parser.ParserError) as arrow_get:
+            self.assertIsNone(parser('10 Oct 2018'))
+            self.assertIsNone(parser('10 Oct 2018'))
+            self.assertEqual(1, arrow_get.call_count)
+        self.assertIsNone(parser('2018-13-01'))
+        self.assertEqual(12, parser('2018-12-01').month)
+        self.assertIsNone(parser(''))
+        self.assertIsNone(parser(None))
+
+    def test_bad_value_does_not_block_same_format(self):
+        parser = DateParser()
+        with patch('eve_elastic.elastic.ciso8601.parse_datetime', side_effect=ValueError):
+            self.assertIsNone(parser.parse('2018-99-10T11:12:13+0000'))
+            self.assertEqual(10, parser.parse('2018-10-10T11:12:13+0000').day)
+
+
+class TestFastSerializer(TestCase):
+
+    def setUp(self):
+        if serializer.orjson is None:
+            self.skipTest('orjson not installed')
+
+    def test_same_output(self):
+        doc = {
+            '_id': ObjectId('5bbdb0d2b1a0a30ff0e7a0c8'),
+            'name': u'žluťoučký kůň',
+            'created': datetime(2018, 10, 10, 11, 12, 13),
+            'updated': datetime(2018, 10, 10, 11, 12, 13, 500, tzinfo=arrow.get().tzinfo),
+            'price': Decimal('1.5'),
+            'tags': {'foo'},
+            'count': 2 ** 70,
+            1: None,
+        }
+        fast = serializer.FastJSONSerializer()
+        self.assertEqual(json.loads(serializer.ElasticJSONSerializer().dumps(doc)), json.loads(fast.dumps(doc)))
+        self.assertEqual('{"foo": 1}', fast.dumps('{"foo": 1}'))
+        self.assertEqual({'foo': 1}, fast.loads('{"foo": 1}'))
+
+    @raises(elasticsearch.exceptions.SerializationError)
+    def test_loads_error(self):
+        serializer.FastJSONSerializer().loads('{')
+
+    def test_get_es(self):
+        es = get_es('http://localhost:9200')
+        self.assertIsInstance(es.transport.serializer, serializer.FastJSONSerializer)
+        with patch('eve_elastic.serializer.orjson', None):
+            self.assertIsInstance(serializer.get_serializer(), serializer.ElasticJSONSerializer)
+
+
+class TestAsyncElastic(FakeAppTestCase):
+
+    data_layer = AsyncElastic
+
+    def run_async(self, coro_func):
+        async def run():
+            try:
+                await self.app.data.init_index()
+                return await coro_func(self.app.data)
+            finally:
+                await self.app.data.close()
+        with self.app.app_context():
+            return asyncio.run(run())
+
+    def test_crud(self):
+        async def crud(data):
+            ids = await data.insert('items', [{'uri': 'foo', 'name': 'Foo bar'}, {'uri': 'bar', 'name': 'baz'}])
+            self.assertEqual('Foo bar', (await data.find_one('items', None, _id=ids[0]))['name'])
+            self.assertEqual(ids[1], (await data.find_one('items', None, uri='bar'))['_id'])
+            self.assertEqual(['Foo bar', 'baz'], [doc['name'] for doc in await data.find_list_of_ids('items', ids)])
+
+            req = ParsedRequest()
+            req.args = {'q': 'foo'}
+            self.assertEqual(1, (await data.find('items', req, None)).count())
+
+            await data.update('items', ids[0], {'name': 'updated'}, {})
+            self.assertEqual('updated', (await data.find_one('items', None, _id=ids[0]))['name'])
+            await data.remove('items', {'_id': ids[1]})
+            self.assertIsNone(await data.find_one('items', None, _id=ids[1]))
+            self.assertFalse(await data.is_empty('items'))
+        self.run_async(crud)
+
+    def test_concurrent_finds(self):
+        async def find_many(data):
+            fake.get_cluster('localhost', 9200).latency = 0.05
+            started = time.time()
+            cursors = await asyncio.gather(*[data.find('items', ParsedRequest(), None) for i in range(50)])
+            self.assertEqual(50, len(cursors))
+            self.assertLess(time.time() - started, 1)
+        self.run_async(find_many)
+
+    def test_bulk_insert_retries(self):
+        async def bulk_insert(data):
+            retried = data.metrics.docs_retried.get(resource='items')
+            fake.get_cluster('localhost', 9200).reject_next_items(2)
+            docs = [{'_id': str(i), 'uri': str(i)} for i in range(5)]
+            self.assertEqual((5, []), await data.bulk_insert('items', docs, max_retries=2, initial_backoff=0))
+            self.assertEqual(retried + 2, data.metrics.docs_retried.get(resource='items'))
+
+            fake.get_cluster('localhost', 9200).reject_next_items(1)
+            with self.assertRaises(elasticsearch.helpers.BulkIndexError):
+                await data.bulk_insert('items', [{'uri': 'foo'}])
+        self.run_async(bulk_insert)
+
+
+class TestClientRegistry(TestCase):
+
+    def setUp(self):
+        self.app = eve.Eve(settings={
+            'DOMAIN': DOMAIN,
+            'ELASTICSEARCH_URL': 'fake://localhost:9200/',
+            'FOO_URL': 'fake://LOCALHOST:9200',
+        }, data=Elastic)
+
+    def test_prefixes_share_connections(self):
+        with self.app.app_context():
+            es = self.app.data.elastic('items')
+            foo = self.app.data.elastic('items_foo')
+            self.assertIs(es, self.app.data.es)
+            self.assertIsNot(es, foo)
+            self.assertIs(es.transport.connection_pool, foo.transport.connection_pool)
+            self.assertEqual('FOO', foo.transport.prefix)
+
+    def test_client_options(self):
+        self.app.config['FOO_POOL_SIZE'] = 5
+        self.app.config['FOO_KEEP_ALIVE'] = 30
+        with self.app.app_context():
+            es = self.app.data.elastic('items')
+            foo = self.app.data.elastic('items_foo')
+            self.assertIsNot(es.transport.connection_pool, foo.transport.connection_pool)
+            self.assertEqual(5, foo.transport.kwargs['maxsize'])
+            self.assertEqual(30, foo.transport.kwargs['keep_alive'])
+
+    def test_fork(self):
+        with self.app.app_context():
+            es = self.app.data.elastic('items')
+            with patch('eve_elastic.clients.os.getpid', return_value=-1):
+                self.assertIsNot(es.transport.connection_pool, self.app.data.elastic('items').transport.connection_pool)
+
+    def test_thread_safety(self):
+        factory = MagicMock(side_effect=lambda url, **options: time.sleep(0.01) or MagicMock())
+        registry = clients.ClientRegistry(factory)
+        threads = [threading.Thread(target=registry.create, args=('px', 'http://localhost:9200')) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, factory.call_count)
+
+    def test_thread_safety_after_fork(self):
+        factory = MagicMock(side_effect=lambda url, **options: MagicMock())
+        registry = clients.ClientRegistry(factory)
+        reset = registry._reset
+        resets = []
+
+        def slow_reset():
+            resets.append(1)
+            time.sleep(0.005 * len(resets))
+            reset()
+
+        def get_client():
+            registry.get('px') or registry.create('px', 'http://localhost:9200')
+
+        with patch.object(registry, '_reset', slow_reset), patch('eve_elastic.clients.os.getpid', return_value=-1):
+            threads = [threading.Thread(target=get_client) for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(1, factory.call_count)
+            self.assertIs(registry.all()[0], registry.get('px'))
+
+    def test_keep_alive(self):
+        connection = transport.ElasticConnection(keep_alive=5)
+        conn = connection.pool._get_conn()
+        connection.pool._put_conn(conn)
+        with patch.object(conn, 'close') as close, \
+                patch('urllib3.connectionpool.is_connection_dropped', return_value=False):
+            connection.pool._put_conn(connection.pool._get_conn())
+            self.assertEqual(0, close.call_count)
+            conn.idle_since = time.time() - 10
+            connection.pool._get_conn()
+            self.assertEqual(1, close.call_count)
+
+    def test_keep_alive_https_pool(self):
+        connection = transport.ElasticConnection(use_ssl=True, ca_certs='/tmp/ca.pem', maxsize=3, keep_alive=5)
+        self.assertIsInstance(connection.pool, urllib3.HTTPSConnectionPool)
+        self.assertIsInstance(connection.pool, transport.KeepAlivePoolMixin)
+        pool = connection.pool
+        self.assertEqual(('/tmp/ca.pem', 'CERT_REQUIRED'), (pool.ca_certs, pool.cert_reqs))
+        self.assertEqual((3, 5), (pool.pool.maxsize, pool.keep_alive))
+
+
+class CountingBody(io.BytesIO):
+    """Response body counting bytes read."""
+
+    bytes_read = 0
+
+    def read(self, *args):
+        data = super(CountingBody, self).read(*args)
+        self.bytes_read += len(data)
+        return data
+
+
+class TestElasticConnection(TestCase):
+
+    def urlopen(self, body, headers=None):
+        self.body = CountingBody(body)
+        response = urllib3.HTTPResponse(body=self.body, headers=headers, status=200, preload_content=False)
+        return patch.object(self.connection.pool, 'urlopen', return_value=response)
+
+    def setUp(self):
+        self.connection = transport.ElasticConnection()
+
+    def test_response_within_limit(self):
+        with self.urlopen(b'{"took": 1}'), transport.max_response_bytes(100):
+            status, headers, data = self.connection.perform_request('GET', '/_search')
+        self.assertEqual('{"took": 1}', data)
+
+    def test_stops_reading_over_limit(self):
+        with self.urlopen(b'x' * 1024 * 1024), transport.max_response_bytes(100):
+            with self.assertRaises(transport.ResponseTooLarge):
+                self.connection.perform_request('GET', '/_search')
+        self.assertLess(self.body.bytes_read, 1024 * 1024)
+
+    def test_content_length_over_limit(self):
+        with self.urlopen(b'x' * 1000, {'content-length': '1000'}), transport.max_response_bytes(100):
+            with self.assertRaises(transport.ResponseTooLarge) as error:
+                self.connection.perform_request('GET', '/_search')
+        self.assertEqual(1000, error.exception.size)
+        self.assertEqual(0, self.body.bytes_read)
+
+
+class TestIdLoader(FakeAppTestCase):
+
+    settings = {'ELASTICSEARCH_BATCH_WINDOW': 0.05}
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            self.ids = self.app.data.insert('items', [{'uri': str(i)} for i in range(3)])
+
+    def test_concurrent_find_one_uses_mget(self):
+        cluster = fake.get_cluster('localhost', 9200)
+        requests = cluster.requests
+        ids = self.ids + self.ids + ['missing']
+        results = {}
+
+        def find_one(i):
+            with self.app.app_context():
+                results[i] = self.app.data.find_one('items', None, _id=ids[i])
+
+        threads = [threading.Thread(target=find_one, args=(i, )) for i in range(len(ids))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(requests + 1, cluster.requests)
+        self.assertEqual(['0', '1', '2', '0', '1', '2'], [results[i]['uri'] for i in range(6)])
+        self.assertIsNot(results[0], results[3])
+        self.assertIsNone(results[6])
+
+    def test_fetch_error(self):
+        loader = BatchLoader(MagicMock(side_effect=elasticsearch.ConnectionError('N/A', 'failed', None)))
+        errors = []
+
+        def load(key):
+            try:
+                loader.load(key, 0.05)
+            except elasticsearch.ConnectionError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=load, args=(('items', i, None), )) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(3, len(errors))
+        self.assertEqual(1, loader.fetch.call_count)
+
+    def test_async_find_one(self):
+        self.app.data = AsyncElastic(self.app)
+        self.app.config['ELASTICSEARCH_BATCH_WINDOW'] = 0
+        cluster = fake.get_cluster('localhost', 9200)
+
+        async def find_many(data):
+            requests = cluster.requests
+            docs = await asyncio.gather(*[data.find_one_raw('items', _id) for _id in self.ids + ['missing']])
+            self.assertEqual(requests + 1, cluster.requests)
+            self.assertEqual(['0', '1', '2'], [doc['uri'] for doc in docs[:3]])
+            self.assertIsNone(docs[3])
+            await data.close()
+
+        with self.app.app_context():
+            asyncio.run(find_many(self.app.data))
+
+
+class TestIdentityMap(FakeAppTestCase):
+
+    settings = {'ELASTICSEARCH_REQUEST_CACHE': True}
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            self.ids = self.app.data.insert('items', [{'uri': str(i)} for i in range(2)])
+
+    def requests(self, func, *args, **kwargs):
+        requests = self.cluster.requests
+        result = func(*args, **kwargs)
+        return self.cluster.requests - requests, result
+
+    def test_find_one_within_request(self):
+        with self.app.test_request_context():
+            doc = self.app.data.find_one('items', None, _id=self.ids[0])
+            doc['uri'] = 'changed'
+            count, cached = self.requests(self.app.data.find_one_raw, 'items', self.ids[0])
+            self.assertEqual(0, count)
+            self.assertEqual('0', cached['uri'])
+
+            self.app.data.update('items', self.ids[0], {'uri': 'updated'})
+            count, doc = self.requests(self.app.data.find_one, 'items', None, _id=self.ids[0])
+            self.assertEqual(1, count)
+            self.assertEqual('updated', doc['uri'])
+
+        with self.app.test_request_context():
+            self.assertEqual(1, self.requests(self.app.data.find_one_raw, 'items', self.ids[0])[0])
+
+    def test_find_list_of_ids(self):
+        with self.app.test_request_context():
+            self.app.data.find_one_raw('items', self.ids[0])
+            self.assertIsNone(self.app.data.find_one_raw('items', 'missing'))
+            ids = [self.ids[1], 'missing', self.ids[0]]
+            count, cursor = self.requests(self.app.data.find_list_of_ids, 'items', ids)
+            self.assertEqual(1, count)
+            self.assertEqual(['1', '0'], [doc['uri'] for doc in cursor])
+            self.assertEqual(2, cursor.count())
+            self.assertEqual(0, self.requests(self.app.data.find_list_of_ids, 'items', ids)[0])
+
+            self.app.data.insert('items', [{'_id': 'missing', 'uri': 'new'}])
+            self.assertEqual('new', self.app.data.find_one_raw('items', 'missing')['uri'])
+
+    def test_outside_of_request(self):
+        with self.app.app_context():
+            self.app.data.find_one_raw('items', self.ids[0])
+            self.assertEqual(1, self.requests(self.app.data.find_one_raw, 'items', self.ids[0])[0])
+
+
+class TestMultiSearch(FakeAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            self.app.data.insert('items', [{'uri': 'foo', 'name': 'foo'}, {'uri': 'bar', 'name': 'bar'}])
+            self.app.data.insert('items_foo', [{'uri': 'baz', 'name': 'baz'}])
+
+    def get_req(self, **args):
+        req = ParsedRequest()
+        req.args = args
+        return req
+
+    def test_find_many(self):
+        invalid = self.get_req()
+        invalid.where = 'name:{'
+        queries = [
+            ('items', self.get_req(q='foo'), None),
+            ('items', self.get_req(projections='["uri"]'), None),
+            ('items', invalid, None),
+            ('items_foo', self.get_req(), None),
+        ]
+        with self.app.app_context():
+            requests = self.cluster.requests
+            results = self.app.data.find_many(queries)
+            self.assertEqual(requests + 2, self.cluster.requests)
+
+            self.assertEqual(1, results[0].count())
+            self.assertEqual('foo', results[0][0]['uri'])
+            self.assertEqual(2, results[1].count())
+            self.assertNotIn('name', results[1][0])
+            self.assertIsInstance(results[2], BadRequest)
+            self.assertEqual('baz', results[3][0]['uri'])
+
+            self.app.data.elastic('items_foo').indices.delete('items_foo')
+            results = self.app.data.find_many(queries[:1] + queries[3:])
+            self.assertEqual(1, results[0].count())
+            self.assertIsInstance(results[1], elasticsearch.NotFoundError)
+
+    def test_find_many_no_mapping_error(self):
+        error = {
+            'type': 'search_phase_execution_exception',
+            'reason': 'all shards failed',
+            'root_cause': [
+                {'type': 'query_shard_exception', 'reason': 'No mapping found for [foo] in order to sort on'},
+            ],
+        }
+        response = {'responses': [{'error': error, 'status': 400}]}
+        with self.app.app_context():
+            with patch.object(elasticsearch.Elasticsearch, 'msearch', return_value=response):
+                results = self.app.data.find_many([('items', self.get_req(), None)])
+            self.assertEqual(0, results[0].count())
+
+    def test_max_response_bytes(self):
+        self.app.config['ELASTICSEARCH_MAX_RESPONSE_BYTES'] = 50
+        self.app.config['ELASTICSEARCH_MSEARCH_WINDOW'] = 0
+        with self.app.app_context():
+            with self.assertRaises(BadRequest):
+                self.app.data.find('items', self.get_req(), None)
+            results = self.app.data.find_many([('items', self.get_req(), None), ('items', self.get_req(), None)])
+            self.assertIsInstance(results[0], BadRequest)
+            self.assertIsInstance(results[1], BadRequest)
+
+    def test_concurrent_finds_use_msearch(self):
+        self.app.config['ELASTICSEARCH_MSEARCH_WINDOW'] = 0.05
+        counts = {}
+
+        def find(q):
+            with self.app.app_context():
+                counts[q] = self.app.data.find('items', self.get_req(q=q), None).count()
+
+        requests = self.cluster.requests
+        threads = [threading.Thread(target=find, args=(q, )) for q in ('foo', 'bar', 'foo', 'missing')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(requests + 1, self.cluster.requests)
+        self.assertEqual({'foo': 1, 'bar': 1, 'missing': 0}, counts)
+
+    def test_async_find_many(self):
+        self.app.data = AsyncElastic(self.app)
+
+        async def find_many(data):
+            results = await data.find_many([('items', self.get_req(q='bar'), None), ('items', self.get_req(), None)])
+            self.assertEqual([1, 2], [cursor.count() for cursor in results])
+            await data.close()
+
+        with self.app.app_context():
+            asyncio.run(find_many(self.app.data))
+
+
+class TestMgetChunks(FakeAppTestCase):
+
+    settings = {
+        'ELASTICSEARCH_MGET_CHUNK_SIZE': 3,
+        'ELASTICSEARCH_MGET_CONCURRENCY': 2,
+    }
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            self.ids = self.app.data.insert('items', [{'uri': str(i), 'name': 'item %d' % i} for i in range(7)])
+
+    def test_find_list_of_ids(self):
+        ids = list(reversed(self.ids)) + ['missing', self.ids[0]]
+        with self.app.app_context():
+            requests = self.cluster.requests
+            cursor = self.app.data.find_list_of_ids('items', ids)
+            self.assertEqual(requests + 3, self.cluster.requests)
+            self.assertEqual(['6', '5', '4', '3', '2', '1', '0', '0'], [doc['uri'] for doc in cursor])
+            self.assertEqual(8, cursor.count())
+
+    def test_projection(self):
+        with self.app.app_context():
+            docs = list(self.app.data.find_list_of_ids('items', self.ids[:2], {'uri': 1}))
+            self.assertEqual('0', docs[0]['uri'])
+            self.assertNotIn('name', docs[0])
+            docs = list(self.app.data.find_list_of_ids('items', self.ids[:2], {'name': 0}))
+            self.assertEqual('1', docs[1]['uri'])
+            self.assertNotIn('name', docs[1])
+
+    def test_iter_list_of_ids(self):
+        self.app.config['ELASTICSEARCH_MGET_CONCURRENCY'] = 1
+        with self.app.app_context():
+            requests = self.cluster.requests
+            docs = self.app.data.iter_list_of_ids('items', self.ids)
+            self.assertEqual('0', next(docs)['uri'])
+            self.assertEqual(requests + 1, self.cluster.requests)
+            self.assertEqual(6, len(list(docs)))
+            self.assertEqual(requests + 3, self.cluster.requests)
+
+    def test_concurrent_chunks_instrumentation(self):
+        events = []
+        instrumentation.subscribe(events.append)
+        try:
+            with self.app.test_request_context(headers={'X-Request-Id': 'req-1'}):
+                self.assertEqual(7, self.app.data.find_list_of_ids('items', self.ids).count())
+        finally:
+            instrumentation.unsubscribe(events.append)
+        requests = [event for event in events if event.kind == instrumentation.REQUEST]
+        operation, = [event for event in events if event.kind == instrumentation.OPERATION]
+        self.assertEqual(3, len(requests))
+        for event in requests:
+            self.assertEqual(('items', 'find_list_of_ids', 'req-1'), (event.resource, event.operation, event.opaque_id))
+        self.assertEqual(3, operation.requests)
+        self.assertEqual('req-1', operation.opaque_id)
+
+    def test_async_find_list_of_ids(self):
+        self.app.data = AsyncElastic(self.app)
+
+        async def find_list_of_ids(data):
+            requests = self.cluster.requests
+            cursor = await data.find_list_of_ids('items', list(reversed(self.ids)) + ['missing'])
+            self.assertEqual(requests + 3, self.cluster.requests)
+            self.assertEqual(['6', '5', '4', '3', '2', '1', '0'], [doc['uri'] for doc in cursor])
+            await data.close()
+
+        with self.app.app_context():
+            asyncio.run(find_list_of_ids(self.app.data))
+
+    def test_async_iter_list_of_ids(self):
+        self.app.data = AsyncElastic(self.app)
+
+        async def iter_list_of_ids(data):
+            requests = self.cluster.requests
+            docs = data.iter_list_of_ids('items', list(reversed(self.ids)) + ['missing'])
+            self.assertEqual('6', (await docs.__anext__())['uri'])
+            self.assertEqual(['5', '4', '3', '2', '1', '0'], [doc['uri'] async for doc in docs])
+            self.assertEqual(requests + 3, self.cluster.requests)
+            await data.close()
+
+        with self.app.app_context():
+            asyncio.run(iter_list_of_ids(self.app.data))
+
+
+class TestCountOnly(FakeAppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            self.app.data.insert('items', [{'uri': 'foo', 'name': 'foo'}, {'uri': 'bar', 'name': 'bar'}])
+
+    def get_req(self, **args):
+        req = ParsedRequest()
+        req.args = args
+        req.sort = '[("uri", 1)]'
+        return req
+
+    def test_find_count(self):
+        with self.app.app_context():
+            req = self.get_req(count='1', es_highlight='1', projections='["uri"]')
+            query, args = self.app.data._find_query('items', req, None)
+            self.assertEqual(0, query['size'])
+            self.assertFalse(query['_source'])
+            self.assertTrue(query['track_total_hits'])
+            self.assertNotIn('sort', query)
+            self.assertNotIn('aggs', query)
+            self.assertNotIn('_source', args)
+
+            cursor = self.app.data.find('items', req, None)
+            self.assertEqual(2, cursor.count())
+            self.assertEqual(0, len(cursor.docs))
+
+    def test_track_total_hits(self):
+        self.app.config['ELASTICSEARCH_TRACK_TOTAL_HITS'] = False
+        with self.app.app_context():
+            query, args = self.app.data._find_query('items', self.get_req(), None)
+            self.assertFalse(query['track_total_hits'])
+            self.assertEqual(-1, self.app.data.find('items', self.get_req(), None).count())
+            self.assertEqual(2, self.app.data.find('items', self.get_req(count='1'), None).count())
+
+    def test_is_empty(self):
+        with self.app.app_context():
+            es = self.app.data.elastic('items')
+            with patch.object(es, 'count', wraps=es.count) as count:
+                self.assertFalse(self.app.data.is_empty('items'))
+                self.assertEqual(1, count.call_args[1]['terminate_after'])
+            self.assertTrue(self.app.data.is_empty('items_foo'))
+
+
+class TestAggregationsCache(FakeAppTestCase):
+
+    settings = {
+        'ELASTICSEARCH_AGGREGATIONS_FIRST_PAGE': True,
+        'ELASTICSEARCH_AGGREGATIONS_CACHE_TTL': 60,
+    }
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            self.app.data.insert('items_with_description', [
+                {'uri': 'foo', 'name': 'foo', 'description': 'foo'},
+                {'uri': 'bar', 'name': 'bar', 'description': 'bar'},
+            ])
+
+    def get_req(self, page=1, **args):
+        req = ParsedRequest()
+        req.args = args
+        req.page = page
+        req.max_results = 1
+        return req
+
+    def test_first_page(self):
+        with self.app.app_context():
+            query, args = self.app.data._find_query('items_with_description', self.get_req(), None)
+            self.assertIn('aggs', query)
+            query, args = self.app.data._find_query('items_with_description', self.get_req(page=2), None)
+            self.assertNotIn('aggs', query)
+            query, args = self.app.data._find_query('items_with_description', self.get_req(2, aggregations='1'), None)
+            self.assertIn('aggs', query)
+
+    def test_cached_aggregations(self):
+        with self.app.app_context():
+            es = self.app.data.elastic('items_with_description')
+            with patch.object(es, 'search', wraps=es.search) as search:
+                first = self.app.data.find('items_with_description', self.get_req(), None)
+                self.assertIn('aggs', search.call_args[1]['body'])
+                second = self.app.data.find('items_with_description', self.get_req(2, aggregations='1'), None)
+                self.assertNotIn('aggs', search.call_args[1]['body'])
+                self.assertEqual(first.hits['aggregations'], second.hits['aggregations'])
+                self.assertEqual(2, second.count())
+                self.assertEqual(1, len(second.docs))
+
+                self.app.data.find('items_with_description', self.get_req(q='foo'), None)
+                self.assertIn('aggs', search.call_args[1]['body'])
+
+    def test_ttl_cache(self):
+        cache = TTLCache(max_size=2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 0)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        cache.set('c', 3, 60)
+        cache.set('d', 4, 60)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+
+
+class TestFilterContext(FakeAppTestCase):
+
+    def get_query(self, lookup=None):
+        req = ParsedRequest()
+        req.args = {
+            'q': 'foo',
+            'filter': json.dumps({'range': {'count': {'gte': 5}}}),
+            'filters': [{'match': {'name': 'foo'}}, {'bool': {'must_not': [{'exists': {'field': 'x'}}]}}],
+        }
+        return self.app.data._find_query('items', req, lookup)[0]['query']['bool']
+
+    def test_filter_clauses(self):
+        with self.app.app_context():
+            query = self.get_query({'uri': 'foo', 'tags': ['a', 'b']})
+            self.assertEqual(['query_string', 'match'], [list(clause)[0] for clause in query['must']])
+            self.assertIn({'term': {'uri': 'foo'}}, query['filter'])
+            self.assertIn({'terms': {'tags': ['a', 'b']}}, query['filter'])
+            self.assertIn({'range': {'count': {'gte': 5}}}, query['filter'])
+            self.assertIn({'bool': {'must_not': [{'exists': {'field': 'x'}}]}}, query['filter'])
+
+    def test_legacy_filters(self):
+        self.app.config['ELASTICSEARCH_LEGACY_FILTERS'] = True
+        with self.app.app_context():
+            query = self.get_query({'uri': 'foo'})
+            self.assertEqual(5, len(query['must']))
+            self.assertIn({'term': {'uri': 'foo'}}, query['must'])
+            self.assertNotIn('filter', query)
+
+    def test_find_sub_resource(self):
+        with self.app.app_context():
+            self.app.data.init_index()
+            self.app.data.insert('items', [{'uri': 'foo', 'name': 'foo'}, {'uri': 'bar', 'name': 'bar'}])
+            cursor = self.app.data.find('items', ParsedRequest(), {'uri': 'bar'})
+            self.assertEqual(1, cursor.count())
+            self.assertEqual('bar', cursor[0]['name'])
+
+
+class TestWhere(TestCase):
+
+    def test_translate_where(self):
+        self.assertEqual({'term': {'uri': 'foo'}}, translate_where({'uri': 'foo'}))
+        self.assertEqual({'bool': {'filter': [
+            {'terms': {'uri': ['a', 'b']}},
+            {'range': {'count': {'gte': 5, 'lt': 10}}},
+        ]}}, translate_where({'uri': {'$in': ['a', 'b']}, 'count': {'$gte': 5, '$lt': 10}}))
+        self.assertEqual({'bool': {'should': [
+            {'term': {'uri': 'foo'}},
+            {'bool': {'filter': [
+                {'bool': {'must_not': [{'term': {'name': 'bar'}}]}},
+                {'bool': {'must_not': [{'exists': {'field': 'tags'}}]}},
+            ]}},
+        ], 'minimum_should_match': 1}}, translate_where({'$or': [
+            {'uri': 'foo'},
+            {'name': {'$ne': 'bar'}, 'tags': {'$exists': False}},
+        ]}))
+        self.assertEqual({'bool': {'must_not': [{'exists': {'field': 'name'}}]}}, translate_where({'name': None}))
+        self.assertEqual({'term': {'author.name': 'foo'}}, translate_where({'author': {'name': 'foo'}}))
+        with self.assertRaises(ValueError):
+            translate_where({'tags': {'$size': 2}})
+
+    def test_translate_regex(self):
+        self.assertEqual({'regexp': {'uri': '.*fo+.*'}}, translate_where({'uri': {'$regex': 'fo+'}}))
+        self.assertEqual({'regexp': {'uri': 'foo.*'}}, translate_where({'uri': {'$regex': '^foo'}}))
+        self.assertEqual({'regexp': {'uri': '.*foo'}}, translate_where({'uri': {'$regex': 'foo$'}}))
+        self.assertEqual({'regexp': {'uri': '.*foo\\$.*'}}, translate_where({'uri': {'$regex': 'foo\\$'}}))
+        self.assertEqual({'regexp': {'uri': '.*(a|b).*'}}, translate_where({'uri': {'$regex': 'a|b'}}))
+        for operators in ({'$regex': 'foo', '$options': 'i'}, {'$regex': '^a|b'}, {'$options': ''}):
+            with self.assertRaises(ValueError):
+                translate_where({'uri': operators})
+
+    def test_translate_invalid_objects(self):
+        with self.assertRaises(ValueError):
+            translate_where({'count': {'$gt': 1, 'x': 2}})
+        with self.assertRaises(ValueError):
+            translate_where({'count': {}})
+        with self.assertRaises(ValueError):
+            translate_where({'author': {'name': {}}})
+
+    def test_translator_cache(self):
+        translator = WhereTranslator(max_size=2)
+        clause = translator('{"uri": "foo"}')
+        clause['term']['uri'] = 'bar'
+        self.assertEqual({'term': {'uri': 'foo'}}, translator('{"uri": "foo"}'))
+        self.assertEqual({'range': {'count': {'gt': 1}}}, translator('count > 1'))
+        translator('{"uri": "bar"}')
+        self.assertEqual(['count > 1', '{"uri": "bar"}'], list(translator.translations))
+        with self.assertRaises(ValueError):
+            translator('count >')
+
+    def test_find_where(self):
+        app = create_fake_app()
+        with app.app_context():
+            app.data.init_index()
+            app.data.insert('items', [
+                {'uri': 'foo', 'name': 'foo', 'count': 1},
+                {'uri': 'bar', 'name': 'bar', 'count': 5},
+                {'uri': 'baz', 'name': 'baz'},
+            ])
+
+            def find(where):
+                req = ParsedRequest()
+                req.where = where
+                return sorted(doc['uri'] for doc in app.data.find('items', req, None))
+
+            self.assertEqual(['bar', 'foo'], find('{"uri": {"$in": ["foo", "bar"]}}'))
+            self.assertEqual(['bar'], find('{"count": {"$gte": 2}}'))
+            self.assertEqual(['baz', 'foo'], find('{"$or": [{"uri": "foo"}, {"count": {"$exists": false}}]}'))
+            self.assertEqual(['bar', 'baz'], find('uri != "foo"'))
+            with self.assertRaises(BadRequest):
+                find('{"count": {"$size": 1}}')